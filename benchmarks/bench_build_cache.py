@@ -0,0 +1,79 @@
+'''
+Measure how much the build cache of build_oz_tree speeds up a rebuild, on a synthetic tree with a
+fake OneZoom parts folder (see synthetic_tree.py).
+
+It times a build without the cache, a first build filling the cache, a rebuild with nothing changed,
+and a rebuild after editing a single .PHY file, and checks that the output of the last one is the
+same as a build without the cache. It also reports the size of the cache, compared with the output.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.build_oz_tree import build_oz_tree
+from oz_tree_build.get_open_trees_from_one_zoom import extract_trees_from_open_tree_file, \
+    get_inclusions_and_exclusions_from_one_zoom_files
+
+__author__ = "David Ebbo"
+
+def get_folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--part_count', type=int, default=20, help='the number of OneZoom files in the parts folder')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        parts_folder = os.path.join(temp_dir, 'parts')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file, '--parts_folder', parts_folder,
+                        '--part_count', str(args.part_count)], check=True)
+
+        oz_parts_folder = os.path.join(parts_folder, 'oz')
+        ot_parts_folder = os.path.join(parts_folder, 'ot')
+        base_file = os.path.join(oz_parts_folder, 'Base.PHY')
+        oz_files = [os.path.join(oz_parts_folder, file) for file in os.listdir(oz_parts_folder)]
+        included_otts, excluded_otts = get_inclusions_and_exclusions_from_one_zoom_files(oz_files)
+        extract_trees_from_open_tree_file(tree_file, ot_parts_folder, included_otts, excluded_otts)
+
+        cache_dir = os.path.join(temp_dir, 'cache')
+        output_file = os.path.join(temp_dir, 'built_tree.tre')
+
+        def build(label, cache_dir=None):
+            start = time.time()
+            with open(output_file, 'w', encoding="utf8") as output:
+                build_oz_tree(base_file, ot_parts_folder, output, cache_dir=cache_dir)
+            elapsed = time.time() - start
+            print(f"{label:>30}: {elapsed:.2f}s")
+            with open(output_file, 'r', encoding="utf8") as f:
+                return f.read()
+
+        build('no cache')
+        build('first build with the cache', cache_dir)
+        build('rebuild, nothing changed', cache_dir)
+
+        # Edit the edge length of the leaf at the end of one of the parts
+        edited_file = next(file for file in sorted(oz_files) if file != base_file)
+        with open(edited_file, 'r', encoding="utf8") as f:
+            part = f.read()
+        with open(edited_file, 'w', encoding="utf8") as f:
+            f.write(part.replace(':1.5,', ':2.5,').replace(':1.5)', ':2.5)'))
+
+        output = build(f'rebuild, {os.path.basename(edited_file)} edited', cache_dir)
+        expected = build('no cache, after the edit')
+        assert output == expected, "Different output with the build cache"
+
+        output_size = os.path.getsize(output_file)
+        cache_size = get_folder_size(cache_dir)
+        print(f"Output: {output_size / 1024 / 1024:.1f} MB, cache: {cache_size / 1024 / 1024:.1f} MB "
+              f"({cache_size / output_size:.2f}x the output)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Compare the wall time and peak memory of parsing and extracting from a large synthetic tree,
+when it's read as a string, read as bytes, or memory mapped.
+
+Each mode runs in its own process, so that the peak RSS numbers are independent.
+'''
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.newick.extract_trees import extract_trees
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+
+__author__ = "David Ebbo"
+
+modes = ['str', 'bytes', 'mmap']
+
+def run_mode(mode, tree_file):
+    start = time.time()
+    if mode == 'str':
+        with open(tree_file, 'r', encoding="utf8") as f:
+            tree = f.read()
+    else:
+        with open(tree_file, 'rb') as f:
+            tree = f.read() if mode == 'bytes' else map_tree_file(f)
+
+    node_count = sum(1 for node in parse_tree(tree))
+    parse_time = time.time() - start
+
+    start = time.time()
+    extract_trees(tree, {str(ott) for ott in range(2, 12)}, excluded_taxa={str(ott) for ott in range(20, 40)})
+    extract_time = time.time() - start
+
+    # On Linux, ru_maxrss is in KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'mode': mode, 'nodes': node_count, 'parse_seconds': parse_time,
+            'extract_seconds': extract_time, 'peak_rss_mb': peak_rss_mb}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--run', nargs=2, metavar=('MODE', 'TREEFILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_mode(*args.run)))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        # Generate the tree in a separate process, since the peak RSS of this process is inherited by its children
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+        print(f"Tree size: {os.path.getsize(tree_file) / 1024 / 1024:.1f} MB")
+
+        for mode in modes:
+            output = subprocess.run([sys.executable, __file__, '--run', mode, tree_file],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            print(f"{mode:>6}: {result['nodes']} nodes, parse {result['parse_seconds']:.2f}s, "
+                  f"extract {result['extract_seconds']:.2f}s, peak RSS {result['peak_rss_mb']:.1f} MB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Compare reading a large synthetic tree from a plain text file and from gzip, bzip2 and xz files,
+and from a gzip file with a seek index.
+
+For each file, it measures the throughput of reading the whole tree (in MB/s of uncompressed
+tree), and the time to extract a few subtrees with an index_open_tree index. Without a seek
+index, a compressed tree can't use the index, and is parsed in full instead.
+'''
+
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.newick.extract_trees import extract_trees_from_file
+from oz_tree_build.newick.index_open_tree import build_index
+from oz_tree_build.utilities.compressed_files import DEFAULT_MEMBER_SIZE, open_tree_file, write_seekable_gzip
+
+__author__ = "David Ebbo"
+
+def write_compressed_file(tree_file, compressed_file, open_compressed):
+    with open(tree_file, 'rb') as f, open_compressed(compressed_file, 'wb') as out:
+        while chunk := f.read(1024 * 1024):
+            out.write(chunk)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=300000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--member_size', type=int, default=DEFAULT_MEMBER_SIZE, help='the size of the gzip members in the seekable file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+        tree_size = os.path.getsize(tree_file)
+
+        files = {'plain': tree_file}
+        for name, open_compressed in [('gzip', gzip.open), ('bzip2', bz2.open), ('xz', lzma.open)]:
+            files[name] = os.path.join(temp_dir, f'tree.tre.{name}')
+            write_compressed_file(tree_file, files[name], open_compressed)
+        files['seekable gzip'] = os.path.join(temp_dir, 'seekable.tre.gz')
+        write_seekable_gzip(tree_file, files['seekable gzip'], args.member_size)
+
+        # Clade otts are numbered from 1
+        target_taxa = {str(ott) for ott in range(2, args.tips // 2, args.tips // 20)}
+        excluded_taxa = {str(ott) for ott in range(1000000, 1000000 + args.tips, 101)}
+
+        expected = None
+        for name, file in files.items():
+            start = time.time()
+            with open_tree_file(file) as f:
+                while f.read(1024 * 1024):
+                    pass
+            read_time = time.time() - start
+
+            build_index(file)
+            start = time.time()
+            result = extract_trees_from_file(file, target_taxa, excluded_taxa)
+            extract_time = time.time() - start
+
+            expected = expected or result
+            assert result == expected, f"Different result with the {name} file"
+            print(f"{name}: {os.path.getsize(file) / 1e6:.1f}MB, read {tree_size / 1e6 / read_time:.1f}MB/s, "
+                  f"indexed extraction of {len(result)} trees {extract_time:.3f}s")
+
+if __name__ == '__main__':
+    main()
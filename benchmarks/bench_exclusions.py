@@ -0,0 +1,79 @@
+'''
+Measure how extract_trees scales with the number of target and excluded taxa, on a large synthetic tree.
+
+For the smaller sizes, it also runs with the previous way of handling the exclusions (keeping them all,
+re-sorting them after each one, and scanning all of them for each target), and checks that the output
+is the same.
+'''
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from oz_tree_build.newick.extract_trees import extract_trees
+from oz_tree_build.newick.newick_parser import parse_tree
+
+__author__ = "David Ebbo"
+
+class SortedExcludedRanges(list):
+    '''The previous handling of the exclusions, with the same interface as ExcludedRanges'''
+    def add(self, excluded_range, taxa=()):
+        self.append(excluded_range)
+        self.sort(key=lambda x: x[0])
+
+    def inside(self, node_start_index, node_end_index):
+        return self
+
+    def taxa_inside(self, node_start_index, node_end_index):
+        return set()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=300000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--sizes', '-n', type=int, nargs='+', default=[10000, 30000, 100000],
+                        help='the numbers of target and excluded taxa to measure')
+    parser.add_argument('--max_sorted_size', type=int, default=10000,
+                        help='the largest size to also measure with the previous handling of the exclusions')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+        with open(tree_file, encoding='utf-8') as f:
+            tree = f.read()
+
+    clade_otts, otts = [], []
+    for node in parse_tree(tree):
+        otts.append(node['ott'])
+        if not node['is_leaf']:
+            clade_otts.append(node['ott'])
+
+    start = time.time()
+    extract_trees(tree, {'not_in_the_tree'})
+    print(f"{len(otts)} nodes, parsing alone: {time.time() - start:.2f}s")
+
+    rng = random.Random(0)
+    for size in args.sizes:
+        target_taxa = set(rng.sample(clade_otts, min(size, len(clade_otts))))
+        excluded_taxa = set(rng.sample(otts, min(size, len(otts))))
+
+        start = time.time()
+        result = extract_trees(tree, target_taxa, excluded_taxa)
+        print(f"{size} targets and exclusions: {time.time() - start:.2f}s ({len(result)} trees)", end='')
+
+        if size <= args.max_sorted_size:
+            with mock.patch('oz_tree_build.newick.extract_trees.ExcludedRanges', SortedExcludedRanges):
+                start = time.time()
+                sorted_result = extract_trees(tree, target_taxa, excluded_taxa)
+                print(f", previously: {time.time() - start:.2f}s", end='')
+            assert result == sorted_result, "Different result with the previous handling of the exclusions"
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''
+Compare the time find_in_file takes to search a large synthetic tree, reading it in chunks, and
+memory mapping it, with one or more processes.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.utilities.find_in_file import chunks_from_file, get_mapped_matches, get_matches_with_text
+
+__author__ = "David Ebbo"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--regex', default=r'Species_[0-9]*7_ott', help='the regex to search for')
+    parser.add_argument('--processes', '-j', type=int, nargs='+', default=[2, 4], help='the process counts to measure with mmap')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+        tree_size_mb = os.path.getsize(tree_file) / 1024 / 1024
+
+        def measure(name, get_matches):
+            start = time.time()
+            matches = list(get_matches())
+            elapsed = time.time() - start
+            print(f"{name}: {elapsed:.2f}s, {tree_size_mb / elapsed:.1f} MB/s ({len(matches)} matches)")
+            return matches
+
+        def chunked_matches():
+            with open(tree_file, 'r', encoding="utf8") as f:
+                yield from get_matches_with_text(chunks_from_file(f, 10000), args.regex, 100)
+
+        expected = measure("chunks of 10000", chunked_matches)
+        assert measure("mmap, chunks of 10000", lambda: get_mapped_matches(tree_file, args.regex, 100, 10000)) == expected
+
+        chunk_size, max_match_length = 16 * 1024 * 1024, 10000
+        mapped = measure("mmap, chunks of 16MB", lambda: get_mapped_matches(tree_file, args.regex, 100, chunk_size, max_match_length))
+        for processes in args.processes:
+            assert measure(f"mmap, chunks of 1MB, {processes} processes",
+                           lambda: get_mapped_matches(tree_file, args.regex, 100, 1024 * 1024, max_match_length, processes)) == mapped
+
+if __name__ == '__main__':
+    main()
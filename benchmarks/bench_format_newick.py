@@ -0,0 +1,86 @@
+'''
+Measure the throughput of format_newick on a large synthetic tree, in MB/s of input, compared with
+the previous version, which read the whole tree and wrote each token separately.
+'''
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.newick.format_newick import format_stream
+
+__author__ = "David Ebbo"
+
+whole_token_regex = re.compile('[^(),;]+')
+
+def previous_format(newick_tree, output_stream, indent_spaces=2):
+    '''The previous version of format_newick.format, for comparison'''
+    indent_string = ' ' * indent_spaces
+
+    index = 0
+    depth = 0
+
+    while index < len(newick_tree):
+
+        if newick_tree[index] == '(':
+            index += 1
+            output_stream.write(indent_string * depth)
+            output_stream.write('(\n')
+            depth += 1
+            continue
+
+        closed_brace = newick_tree[index] == ')'
+        if closed_brace:
+            index += 1
+            depth -= 1
+            output_stream.write('\n')
+            output_stream.write(indent_string * depth)
+            output_stream.write(')')
+
+        if match_full_name := whole_token_regex.match(newick_tree, index):
+            index = match_full_name.end()
+            if not closed_brace:
+                output_stream.write(indent_string * depth)
+            output_stream.write(match_full_name.group())
+
+        if newick_tree[index] == ',':
+            output_stream.write(newick_tree[index] + '\n')
+            index += 1
+
+        if newick_tree[index] == ';':
+            output_stream.write(newick_tree[index] + '\n')
+            break
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--max_depth', '-d', type=int, nargs='+', default=[10], help='the --max_depth values to also measure')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+        tree_size_mb = os.path.getsize(tree_file) / 1024 / 1024
+
+        def measure(name, format_file):
+            output_file = os.path.join(temp_dir, 'formatted.tre')
+            start = time.time()
+            with open(tree_file, 'r', encoding="utf8") as f, open(output_file, 'w', encoding="utf8") as output:
+                format_file(f, output)
+            elapsed = time.time() - start
+            print(f"{name}: {elapsed:.2f}s, {tree_size_mb / elapsed:.1f} MB/s")
+            with open(output_file, 'r', encoding="utf8") as f:
+                return f.read()
+
+        previous = measure("previous", lambda f, output: previous_format(f.read(), output))
+        assert measure("streaming", format_stream) == previous, "Different output from the previous version"
+        for max_depth in args.max_depth:
+            measure(f"streaming, max depth {max_depth}", lambda f, output: format_stream(f, output, max_depth=max_depth))
+
+if __name__ == '__main__':
+    main()
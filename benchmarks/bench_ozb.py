@@ -0,0 +1,74 @@
+'''
+Compare the time and peak memory of loading a large synthetic tree as a CompactTree, by parsing
+the newick text, and by loading a .ozb file made from it. It also times a full pass over the
+node columns, to include the cost of paging in the memory mapped file.
+
+Each mode runs in its own process, so that the peak RSS numbers are independent.
+'''
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.newick.compact_tree import CompactTree
+from oz_tree_build.newick.newick_parser import map_tree_file
+from oz_tree_build.newick.ozb_file import load_ozb
+
+__author__ = "David Ebbo"
+
+modes = ['newick', 'ozb']
+
+def run_mode(mode, tree_file):
+    start = time.time()
+    if mode == 'newick':
+        with open(tree_file, 'rb') as f:
+            tree = CompactTree.from_newick(map_tree_file(f))
+    else:
+        tree = load_ozb(tree_file)
+    load_time = time.time() - start
+
+    start = time.time()
+    leaf_count = sum(tree.leaf_flags)
+    max_depth = max(tree.depths)
+    scan_time = time.time() - start
+
+    # On Linux, ru_maxrss is in KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'mode': mode, 'nodes': len(tree), 'leaves': leaf_count, 'max_depth': max_depth,
+            'load_seconds': load_time, 'scan_seconds': scan_time, 'peak_rss_mb': peak_rss_mb}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--run', nargs=2, metavar=('MODE', 'TREEFILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_mode(*args.run)))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        # Generate the tree in a separate process, since the peak RSS of this process is inherited by its children
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+
+        ozb_file = os.path.join(temp_dir, 'tree.ozb')
+        subprocess.run([sys.executable, '-m', 'oz_tree_build.newick.ozb_file', tree_file, ozb_file], check=True)
+        print(f"Tree size: {os.path.getsize(tree_file) / 1024 / 1024:.1f} MB, "
+              f".ozb size: {os.path.getsize(ozb_file) / 1024 / 1024:.1f} MB")
+
+        for mode, file in zip(modes, [tree_file, ozb_file]):
+            output = subprocess.run([sys.executable, __file__, '--run', mode, file],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            print(f"{mode:>6}: {result['nodes']} nodes, load {result['load_seconds']:.2f}s, "
+                  f"scan {result['scan_seconds']:.2f}s, peak RSS {result['peak_rss_mb']:.1f} MB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''
+Measure the speedup of extract_trees with several worker processes, on a large synthetic tree.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.newick.extract_trees import extract_trees
+from oz_tree_build.newick.newick_parser import map_tree_file
+
+__author__ = "David Ebbo"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--workers', '-j', type=int, nargs='+', default=[1, 2, 4, 8], help='the worker counts to measure')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+
+        with open(tree_file, 'rb') as f:
+            tree = map_tree_file(f)
+
+        # Clade otts are numbered from 1, and species otts from 1000000
+        target_taxa = {str(ott) for ott in range(2, args.tips // 2, 997)}
+        excluded_taxa = {str(ott) for ott in range(1000000, 1000000 + args.tips, 101)}
+
+        # Extract the trees once before timing, so that the first run doesn't also pay for loading the
+        # tree into the page cache, and for growing the heap of the process
+        extract_trees(tree, target_taxa, excluded_taxa)
+
+        serial_result = None
+        for workers in args.workers:
+            start = time.time()
+            result = extract_trees(tree, target_taxa, excluded_taxa, workers=workers)
+            elapsed = time.time() - start
+
+            if serial_result is None:
+                serial_result, serial_time = result, elapsed
+            assert result == serial_result, f"Different result with {workers} workers"
+            print(f"{workers} workers: {elapsed:.2f}s, speedup {serial_time / elapsed:.2f}x ({len(result)} trees)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Compare the node throughput of parse_tree on a large synthetic tree, for each kind of node it can
+return: dictionaries (string trees), BytesNode objects (bytes trees), and tuples of a few fields
+(fields=...), enumerated in a loop or passed to a visitor (visit_tree).
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from oz_tree_build.newick.newick_parser import node_fields, parse_tree, visit_tree
+
+__author__ = "David Ebbo"
+
+offset_fields = ('start', 'end')
+name_fields = ('taxon', 'ott', 'start', 'end')
+
+def count_nodes(nodes):
+    count = 0
+    for node in nodes:
+        count += 1
+    return count
+
+def count_visited_nodes(tree, fields):
+    count = 0
+    def visitor(node):
+        nonlocal count
+        count += 1
+    visit_tree(tree, visitor, fields)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=2000000, help='the number of tips in the synthetic tree')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file], check=True)
+        with open(tree_file, 'rb') as f:
+            tree_bytes = f.read()
+        tree_string = tree_bytes.decode('utf-8')
+
+    modes = [
+        ('str, dicts', lambda: count_nodes(parse_tree(tree_string))),
+        ('str, all fields', lambda: count_nodes(parse_tree(tree_string, node_fields))),
+        ('str, taxon/ott/offsets', lambda: count_nodes(parse_tree(tree_string, name_fields))),
+        ('str, offsets', lambda: count_nodes(parse_tree(tree_string, offset_fields))),
+        ('str, offsets, visitor', lambda: count_visited_nodes(tree_string, offset_fields)),
+        ('bytes, BytesNode', lambda: count_nodes(parse_tree(tree_bytes))),
+        ('bytes, taxon/ott/offsets', lambda: count_nodes(parse_tree(tree_bytes, name_fields))),
+        ('bytes, offsets', lambda: count_nodes(parse_tree(tree_bytes, offset_fields))),
+        ('bytes, offsets, visitor', lambda: count_visited_nodes(tree_bytes, offset_fields)),
+    ]
+    for name, run in modes:
+        start = time.time()
+        node_count = run()
+        elapsed = time.time() - start
+        print(f"{name:>26}: {node_count} nodes, {elapsed:.2f}s, {node_count / elapsed / 1000000:.2f}M nodes/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+'''
+Run the main tools on a synthetic Open Tree scale tree (see synthetic_tree.py), and report the wall
+time, MB/s, nodes/s and peak RSS of each one. The results can be saved as JSON, and compared with
+a baseline saved by an earlier run, to catch performance regressions.
+
+Each tool runs in its own process, so that the peak RSS numbers are independent.
+'''
+
+'''
+For example, save a baseline, then compare with it after making changes:
+python3 benchmarks/run_benchmarks.py --tips 1000000 --save baseline.json
+python3 benchmarks/run_benchmarks.py --tips 1000000 --baseline baseline.json
+
+The exit code is 1 if a tool is slower than in the baseline by more than --tolerance.
+'''
+
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = "David Ebbo"
+
+tools = ['parse_tree', 'analyze_tree', 'extract_trees', 'extract_minimal_tree', 'format_newick', 'find_in_file',
+         'get_open_trees_from_one_zoom', 'build_oz_tree']
+
+def run_tool(tool, temp_dir):
+    '''
+    Run a tool on the files in temp_dir, and return the time it took. Returns the file the tool processed,
+    which is the tree file, except for build_oz_tree, where it's the built tree.
+    '''
+    # Import the tools here, so that the runner process doesn't load them
+    from oz_tree_build.build_oz_tree import build_oz_tree
+    from oz_tree_build.get_open_trees_from_one_zoom import extract_trees_from_open_tree_file, \
+        get_inclusions_and_exclusions_from_one_zoom_files
+    from oz_tree_build.newick.analyze_tree import analyze_tree
+    from oz_tree_build.newick.extract_minimal_tree import extract_minimal_tree
+    from oz_tree_build.newick.extract_trees import extract_trees
+    from oz_tree_build.newick.format_newick import format_stream
+    from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+    from oz_tree_build.utilities.find_in_file import chunks_from_file, get_matches
+
+    tree_file = os.path.join(temp_dir, 'tree.tre')
+    oz_parts_folder = os.path.join(temp_dir, 'parts', 'oz')
+    ot_parts_folder = os.path.join(temp_dir, 'parts', 'ot')
+
+    f = open(tree_file, 'rb')
+    tree = map_tree_file(f)
+    if tool == 'extract_minimal_tree':
+        # Use a few tips spread over the tree, found before starting the clock
+        tip_otts = [match.group(1).decode() for match in re.finditer(rb'Species_\d+_ott(\d+)', tree)]
+        target_taxa = set(tip_otts[len(tip_otts) // 20::len(tip_otts) // 10 or 1])
+
+    start = time.time()
+    if tool == 'parse_tree':
+        for node in parse_tree(tree):
+            pass
+    elif tool == 'analyze_tree':
+        analyze_tree(tree)
+    elif tool == 'extract_trees':
+        # Include the root (ott 1), so that the whole tree is parsed
+        extract_trees(tree, {str(ott) for ott in range(1, 12)}, excluded_taxa={str(ott) for ott in range(20, 40)})
+    elif tool == 'extract_minimal_tree':
+        extract_minimal_tree(tree, target_taxa)
+    elif tool == 'format_newick':
+        with open(tree_file, 'r', encoding="utf8") as input, open(os.devnull, 'w') as output:
+            format_stream(input, output)
+    elif tool == 'find_in_file':
+        with open(tree_file, 'r', encoding="utf8") as input:
+            for match in get_matches(chunks_from_file(input, 1024 * 1024), r'Species_[0-9]*7_ott', 100):
+                pass
+    elif tool == 'get_open_trees_from_one_zoom':
+        oz_files = [os.path.join(oz_parts_folder, file) for file in os.listdir(oz_parts_folder)]
+        included_otts, excluded_otts = get_inclusions_and_exclusions_from_one_zoom_files(oz_files)
+        extract_trees_from_open_tree_file(tree_file, ot_parts_folder, included_otts, excluded_otts)
+    elif tool == 'build_oz_tree':
+        tree_file = os.path.join(temp_dir, 'built_tree.tre')
+        with open(tree_file, 'w', encoding="utf8") as output:
+            build_oz_tree(os.path.join(oz_parts_folder, 'Base.PHY'), ot_parts_folder, output)
+            output.write(';')
+    else:
+        raise ValueError(f"Unknown tool {tool}")
+    elapsed = time.time() - start
+
+    # On Linux, ru_maxrss is in KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'file': tree_file, 'seconds': elapsed, 'peak_rss_mb': peak_rss_mb}
+
+def get_tree_size(tree_file, chunk_size=1024 * 1024):
+    '''
+    The size in MB and number of nodes of a tree file, read in chunks to keep the memory of this
+    process low. Every node but the root follows an open brace or a comma (names don't contain any).
+    '''
+    node_count = 1
+    with open(tree_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            node_count += chunk.count(b'(') + chunk.count(b',')
+    return os.path.getsize(tree_file) / 1024 / 1024, node_count
+
+def compare_with_baseline(results, baseline, tolerance):
+    '''Print the time of each tool relative to the baseline, and return whether any of them regressed'''
+    regressed = False
+    for tool, result in results['tools'].items():
+        baseline_result = baseline['tools'].get(tool)
+        if not baseline_result:
+            continue
+        ratio = result['seconds'] / baseline_result['seconds']
+        rss_ratio = result['peak_rss_mb'] / baseline_result['peak_rss_mb']
+        status = ''
+        if ratio > 1 + tolerance:
+            status = 'SLOWER'
+            regressed = True
+        elif ratio < 1 - tolerance:
+            status = 'faster'
+        print(f"{tool:>30}: {ratio:.2f}x the baseline time, {rss_ratio:.2f}x its peak RSS {status}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tips', '-t', type=int, default=1000000, help='the number of tips in the synthetic tree')
+    parser.add_argument('--seed', '-s', type=int, default=0, help='the random seed of the synthetic tree')
+    parser.add_argument('--quoted', type=float, default=0.01, help='the probability of a tip having a quoted name')
+    parser.add_argument('--caterpillars', type=float, default=0.0001, help='the probability of a clade starting a caterpillar chain')
+    parser.add_argument('--polytomies', type=float, default=0.001, help='the probability of a clade being a polytomy')
+    parser.add_argument('--tools', nargs='+', choices=tools, default=tools, help='the tools to run')
+    parser.add_argument('--save', help='a JSON file in which to save the results')
+    parser.add_argument('--baseline', help='a JSON file saved by an earlier run, to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='the fraction by which a tool can be slower than the baseline')
+    parser.add_argument('--run', nargs=2, metavar=('TOOL', 'FOLDER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_tool(*args.run)))
+        return
+
+    tree_options = {'tips': args.tips, 'seed': args.seed, 'quoted': args.quoted,
+                    'caterpillars': args.caterpillars, 'polytomies': args.polytomies}
+    results = {'tree': tree_options, 'tools': {}}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree_file = os.path.join(temp_dir, 'tree.tre')
+        # Generate the tree in a separate process, since the peak RSS of this process is inherited by its children
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_tree.py')
+        subprocess.run([sys.executable, generator, str(args.tips), tree_file, '--seed', str(args.seed),
+                        '--quoted', str(args.quoted), '--caterpillars', str(args.caterpillars),
+                        '--polytomies', str(args.polytomies), '--parts_folder', os.path.join(temp_dir, 'parts')], check=True)
+        tree_size_mb, node_count = get_tree_size(tree_file)
+        print(f"Tree size: {tree_size_mb:.1f} MB, {node_count} nodes")
+
+        # build_oz_tree needs the Open Tree parts extracted by get_open_trees_from_one_zoom
+        selected_tools = [tool for tool in tools if tool in args.tools]
+        if 'build_oz_tree' in selected_tools and 'get_open_trees_from_one_zoom' not in selected_tools:
+            subprocess.run([sys.executable, __file__, '--run', 'get_open_trees_from_one_zoom', temp_dir],
+                           check=True, capture_output=True)
+
+        for tool in selected_tools:
+            output = subprocess.run([sys.executable, __file__, '--run', tool, temp_dir],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            size_mb, nodes = get_tree_size(result.pop('file'))
+            result.update({'mb_per_second': size_mb / result['seconds'], 'nodes_per_second': nodes / result['seconds']})
+            results['tools'][tool] = result
+            print(f"{tool:>30}: {result['seconds']:.2f}s, {result['mb_per_second']:.1f} MB/s, "
+                  f"{result['nodes_per_second'] / 1000000:.2f}M nodes/s, peak RSS {result['peak_rss_mb']:.1f} MB")
+
+    if args.save:
+        with open(args.save, 'w', encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding="utf8") as f:
+            baseline = json.load(f)
+        if baseline['tree'] != tree_options:
+            print(f"Warning: the baseline was run on a different tree: {baseline['tree']}")
+        if compare_with_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+'''
+Generate a random synthetic Newick tree, for benchmarking the tools on large trees
+without needing the real Open Tree file.
+'''
+
+'''
+The tree is deterministic for a given seed and set of options. Besides the default bifurcating
+to 4-way splits with Name_ott123 labels and edge lengths, it can include quoted names (with
+spaces and punctuation), deep caterpillar chains (one tip split off at each level), and wide
+polytomies, which are the shapes that stress the parsers the most.
+
+It's written out a piece at a time, so trees with 10^7 tips don't need to fit in memory as a
+list of strings.
+
+With --parts_folder, it also creates a fake OneZoom parts folder, with a base file including
+OneZoom files through their tokens (e.g. AMORPHEA@), which include clades of the synthetic tree
+(e.g. Clade_12_ott12@). The Open Tree parts for these can then be extracted from the tree with
+get_open_trees_from_one_zoom, and the whole tree built with build_oz_tree.
+
+For example:
+python3 synthetic_tree.py 1000000 tree.tre --quoted 0.01 --caterpillars 0.001 --parts_folder parts
+'''
+
+import argparse
+import os
+import random
+import sys
+
+from oz_tree_build.token_to_oz_tree_file_mapping import token_to_file_map
+
+__author__ = "David Ebbo"
+
+def generate_tree_pieces(tip_count, seed=0, quoted=0.0, caterpillars=0.0, caterpillar_length=1000,
+                         polytomies=0.0, polytomy_size=100, clade_sizes=None):
+    '''
+    Enumerate the pieces of a random tree with tip_count tips. quoted, caterpillars and polytomies
+    are the probabilities of a tip having a quoted name, and of a clade starting a caterpillar chain
+    (of up to caterpillar_length levels) or being a polytomy (with up to polytomy_size children).
+    If clade_sizes is a dictionary, it gets the number of tips of each clade, indexed by ott.
+    '''
+    rng = random.Random(seed)
+    piece_count = 0
+    clade_count = 0
+
+    # Use an explicit stack rather than recursion, so that deep trees don't hit the recursion limit.
+    # It contains tip counts of clades still to generate (with the caterpillar levels left to generate
+    # below them, if any), and strings to output as-is.
+    stack = [(tip_count, 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            piece = item
+        elif item[0] == 1:
+            name = f"Species_{piece_count}_ott{piece_count + 1000000}"
+            if quoted and rng.random() < quoted:
+                name = f"'Species {piece_count} var. alba/{piece_count % 7}_ott{piece_count + 1000000}'"
+            piece = f"{name}:{rng.uniform(0, 10):.3f}"
+        else:
+            item, caterpillar_levels = item
+            if caterpillar_levels == 0 and caterpillars and rng.random() < caterpillars:
+                caterpillar_levels = caterpillar_length
+
+            if caterpillar_levels > 0:
+                # Split off a single tip, and carry on the chain in the other child
+                sizes = [(1, 0), (item - 1, caterpillar_levels - 1)]
+            else:
+                if polytomies and item > 4 and rng.random() < polytomies:
+                    child_count = rng.randint(5, min(item, polytomy_size))
+                else:
+                    # Split the tips between 2 to 4 children
+                    child_count = rng.randint(2, min(item, 4))
+                splits = sorted(rng.sample(range(1, item), child_count - 1))
+                sizes = [(end - start, 0) for start, end in zip([0] + splits, splits + [item])]
+
+            clade_count += 1
+            if clade_sizes is not None:
+                clade_sizes[clade_count] = item
+            piece = '('
+            stack.append(f")Clade_{clade_count}_ott{clade_count}:{rng.uniform(0, 10):.3f}")
+            for i, size in reversed(list(enumerate(sizes))):
+                stack.append(size)
+                if i > 0:
+                    stack.append(',')
+
+        yield piece
+        piece_count += 1
+
+    yield ';'
+
+def generate_tree(tip_count, seed=0, **options):
+    return ''.join(generate_tree_pieces(tip_count, seed, **options))
+
+def write_tree(output_stream, tip_count, seed=0, batch_size=100000, **options):
+    '''Write a random tree to a text stream, in batches of pieces'''
+    batch = []
+    for piece in generate_tree_pieces(tip_count, seed, **options):
+        batch.append(piece)
+        if len(batch) == batch_size:
+            output_stream.write(''.join(batch))
+            batch.clear()
+    output_stream.write(''.join(batch))
+
+def create_parts_folder(parts_folder, clade_sizes, part_count=20, seed=0):
+    '''
+    Create a fake OneZoom parts folder, with a Base.PHY file including part_count OneZoom files,
+    which include clades of the synthetic tree, sized to cover about half of it together. Returns the
+    base file, and the (empty) folder for the Open Tree parts.
+    '''
+    rng = random.Random(seed)
+    oz_parts_folder = os.path.join(parts_folder, 'oz')
+    ot_parts_folder = os.path.join(parts_folder, 'ot')
+    os.makedirs(oz_parts_folder, exist_ok=True)
+    os.makedirs(ot_parts_folder, exist_ok=True)
+
+    # Pick clades with between 1/4 and 1/2 of the tips of a part, to spread the parts around the tree
+    tip_count = max(clade_sizes.values(), default=1)
+    part_tips = max(tip_count // (2 * part_count), 1)
+    candidates = [ott for ott, size in clade_sizes.items() if part_tips // 4 <= size <= part_tips // 2]
+    clades = rng.sample(candidates, min(len(candidates), part_count * 3))
+
+    # Use the tokens of the real OneZoom files, skipping the ones sharing a file
+    tokens = {}
+    for token, entry in token_to_file_map.items():
+        if entry['file'] not in tokens.values() and len(tokens) < part_count:
+            tokens[token] = entry['file']
+
+    for part_index, (token, oz_file) in enumerate(tokens.items()):
+        children = [f"Clade_{ott}_ott{ott}@:{rng.uniform(0, 10):.3f}" for ott in clades[part_index::len(tokens)]]
+        children.append(f"Leaf_{part_index}:1.5")
+        with open(os.path.join(oz_parts_folder, oz_file), 'w', encoding="utf8") as f:
+            f.write(f"[Synthetic part {part_index}]\n({','.join(children)})Part_{part_index}:{rng.uniform(0, 10):.3f};\n")
+
+    base_file = os.path.join(oz_parts_folder, 'Base.PHY')
+    with open(base_file, 'w', encoding="utf8") as f:
+        f.write(f"[Synthetic base]\n({','.join(token + '@' for token in tokens)})Root;\n")
+
+    return base_file, ot_parts_folder
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('tip_count', type=int, help='The number of tips in the tree')
+    parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='The output tree file')
+    parser.add_argument('--seed', '-s', type=int, default=0, help='the random seed')
+    parser.add_argument('--quoted', type=float, default=0.0, help='the probability of a tip having a quoted name')
+    parser.add_argument('--caterpillars', type=float, default=0.0, help='the probability of a clade starting a caterpillar chain')
+    parser.add_argument('--caterpillar_length', type=int, default=1000, help='the number of levels of the caterpillar chains')
+    parser.add_argument('--polytomies', type=float, default=0.0, help='the probability of a clade being a polytomy')
+    parser.add_argument('--polytomy_size', type=int, default=100, help='the maximum number of children of a polytomy')
+    parser.add_argument('--parts_folder', help='a folder in which to also create a fake OneZoom parts folder, including clades of the tree')
+    parser.add_argument('--part_count', type=int, default=20, help='the number of OneZoom files in the parts folder')
+    args = parser.parse_args()
+
+    clade_sizes = {} if args.parts_folder else None
+    write_tree(args.outfile, args.tip_count, args.seed, quoted=args.quoted, caterpillars=args.caterpillars,
+               caterpillar_length=args.caterpillar_length, polytomies=args.polytomies,
+               polytomy_size=args.polytomy_size, clade_sizes=clade_sizes)
+    args.outfile.close()
+
+    if args.parts_folder:
+        create_parts_folder(args.parts_folder, clade_sizes, args.part_count, args.seed)
+
+if __name__ == '__main__':
+    main()
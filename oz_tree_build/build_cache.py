@@ -0,0 +1,192 @@
+'''
+Persistent cache for build_oz_tree, so that a rebuild only re-expands the parts of the tree that changed.
+
+The cache keeps the expanded form of each OneZoom (.PHY) subtree, i.e. what build_oz_tree writes
+for it, keyed by a hash of everything the expansion depends on: the content of the file, its
+expansion parameters, and the keys of the subtrees it includes. So if a part file changes, only
+the subtrees including it (directly or not) get a new key and are expanded again, and the others
+are copied from the cache as is.
+
+Each expansion is only stored once: the cache file of a subtree has the text between the OneZoom
+subtrees it includes, and these are referred to by their keys, so a cached subtree is written by
+copying its own text, and the cached expansions of its subtrees in between. When the output has a
+binary stream under it (e.g. a file), the cached text is copied to it as bytes, without decoding
+it, which is a lot faster than reading the part files again.
+
+Hashing a large file means reading it, so the content hashes are also cached, and only computed
+again when the size or modification time of the file changes.
+'''
+
+import codecs
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+from oz_tree_build.newick.index_open_tree import get_file_checksum
+
+__author__ = "David Ebbo"
+
+# Change this when the way build_oz_tree expands the files changes, to invalidate all the cached expansions
+BUILD_CACHE_VERSION = 2
+
+class BuildCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.file_hashes_file = os.path.join(cache_dir, 'file_hashes.json')
+        self.file_hashes = {}
+        if os.path.exists(self.file_hashes_file):
+            with open(self.file_hashes_file, 'r', encoding="utf8") as f:
+                self.file_hashes = json.load(f)
+
+        # The parts of each cached expansion: the lengths in bytes of the pieces of text in its cache
+        # file, and the keys of the subtrees in between
+        self.expansions_file = os.path.join(cache_dir, 'expansions.json')
+        self.expansions = {}
+        if os.path.exists(self.expansions_file):
+            with open(self.expansions_file, 'r', encoding="utf8") as f:
+                expansions = json.load(f)
+            if expansions.get('version') == BUILD_CACHE_VERSION:
+                self.expansions = expansions['expansions']
+
+        # What this build used, so that the rest can be dropped when saving. The keys of all the
+        # current subtrees are kept, even the ones inside a cached subtree, which aren't expanded.
+        self.used_file_hashes = {}
+        self.used_keys = set()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_file_hash(self, file):
+        '''
+        The hash of the file content, or None if the file doesn't exist
+        '''
+        if not os.path.exists(file):
+            return None
+
+        stat = os.stat(file)
+        path = os.path.abspath(file)
+        entry = self.file_hashes.get(path)
+        if not entry or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            entry = [stat.st_size, stat.st_mtime_ns, get_file_checksum(file).hex()]
+        self.used_file_hashes[path] = entry
+        return entry[2]
+
+    def get_key(self, *parts):
+        key = hashlib.sha256(repr((BUILD_CACHE_VERSION,) + parts).encode('utf-8')).hexdigest()
+        self.used_keys.add(key)
+        return key
+
+    def get_expansion_file(self, key):
+        return os.path.join(self.cache_dir, key + '.nwk')
+
+    def has_expansion(self, key):
+        '''
+        Whether the cache has the expansion for the key, and those of the subtrees it includes
+        '''
+        parts = self.expansions.get(key)
+        if parts is None or not os.path.exists(self.get_expansion_file(key)):
+            return False
+        return all(self.has_expansion(part) for part in parts if isinstance(part, str))
+
+    def splice(self, key, output_stream):
+        '''
+        Write the cached expansion for the key to the output, and return whether there was one
+        '''
+        if not self.has_expansion(key):
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        buffer = getattr(output_stream, 'buffer', None)
+        if buffer is not None:
+            # Write the bytes after what the text stream has buffered
+            output_stream.flush()
+            self.write_expansion(key, buffer.write)
+        else:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            self.write_expansion(key, lambda data: output_stream.write(decoder.decode(data)))
+        return True
+
+    def write_expansion(self, key, write_bytes, chunk_size=1024 * 1024):
+        with open(self.get_expansion_file(key), 'rb') as f:
+            for part in self.expansions[key]:
+                if isinstance(part, str):
+                    self.write_expansion(part, write_bytes, chunk_size)
+                    continue
+
+                # Copy the next piece of text, which can be large if it includes Open Tree subtrees
+                while part > 0:
+                    data = f.read(min(part, chunk_size))
+                    write_bytes(data)
+                    part -= len(data)
+
+    @contextmanager
+    def record(self, key):
+        '''
+        Return an ExpansionRecording in which to write the expansion for the key. The expansion is
+        only saved if the block completes, and the recording wasn't discarded.
+        '''
+        expansion_file = self.get_expansion_file(key)
+        try:
+            with open(expansion_file + '.tmp', 'wb') as f:
+                recording = ExpansionRecording(f)
+                yield recording
+        except BaseException:
+            os.remove(expansion_file + '.tmp')
+            raise
+
+        if recording.discarded:
+            os.remove(expansion_file + '.tmp')
+        else:
+            os.replace(expansion_file + '.tmp', expansion_file)
+            self.expansions[key] = recording.parts
+
+    def save(self):
+        '''
+        Save the file hashes and the parts of the expansions, and delete the cached expansions that
+        this build didn't use
+        '''
+        with open(self.file_hashes_file + '.tmp', 'w', encoding="utf8") as f:
+            json.dump(self.used_file_hashes, f)
+        os.replace(self.file_hashes_file + '.tmp', self.file_hashes_file)
+
+        expansions = {key: parts for key, parts in self.expansions.items() if key in self.used_keys}
+        with open(self.expansions_file + '.tmp', 'w', encoding="utf8") as f:
+            json.dump({'version': BUILD_CACHE_VERSION, 'expansions': expansions}, f)
+        os.replace(self.expansions_file + '.tmp', self.expansions_file)
+
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.nwk') and file[:-len('.nwk')] not in self.used_keys:
+                os.remove(os.path.join(self.cache_dir, file))
+
+        logging.info(f"Build cache: {self.hits} hits, {self.misses} misses")
+
+class ExpansionRecording:
+    '''
+    The expansion of a subtree being written to its (binary) cache file: the text written to it, and the
+    keys of the subtrees added in between
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.parts = []
+        self.discarded = False
+
+    def write(self, text):
+        if not text:
+            return
+        data = text.encode('utf-8')
+        self.stream.write(data)
+        if self.parts and isinstance(self.parts[-1], int):
+            self.parts[-1] += len(data)
+        else:
+            self.parts.append(len(data))
+
+    def add_subtree(self, key):
+        self.parts.append(key)
+
+    def discard(self):
+        self.discarded = True
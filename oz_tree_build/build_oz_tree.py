@@ -4,72 +4,273 @@ Build the entire OneZoom tree from the saved parts.
 
 It does this in one pass, by starting with the base file (e.g. base.PHY) and
 recursively expanding any OneZoom tokens it finds.
+
+With --jobs, the part files are read ahead of time by a pool of threads, which follow the
+tokens to find the files to read, so the build doesn't wait on each file in turn. --read_ahead
+limits how many files can be read ahead and not used yet, to bound the memory this takes.
+
+With --cache_dir, the expanded OneZoom subtrees are kept in a cache (see build_cache), and
+a rebuild only expands again the subtrees that include a changed file.
+
+With --token_manifest, the tokens found in each part file are kept in a manifest (see
+token_manifest), shared with get_open_trees_from_one_zoom, and only the changed files are
+scanned again. Either way, the whole include graph is checked before the build starts, so
+all the missing files and unmapped tokens are reported at once.
+
+With --metrics, the time spent reading, scanning and writing, the counts of files and tokens, and
+the time spent on each include file are saved as JSON (see metrics), so slow parts stand out.
 '''
 
 import argparse
 import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from oz_tree_build.oz_tokens import enumerate_one_zoom_tokens
+from oz_tree_build.build_cache import BuildCache
+from oz_tree_build.token_manifest import TokenManifest, get_sub_file, read_tree_file
 from oz_tree_build.token_to_oz_tree_file_mapping import token_to_file_map
+from oz_tree_build.utilities.metrics import MeteredStream, Metrics
 
 __author__ = "David Ebbo"
 
-def trim_tree(tree):
-    # Skip the comment block at the start of the file, if any
-    if '[' in tree:
-        tree = tree[tree.index(']')+1:]
+# The default number of part files that can be read ahead of time, and not used yet, per job
+DEFAULT_READ_AHEAD_PER_JOB = 4
+
+class TreeFilePrefetcher:
+    '''
+    Reads and trims tree files in a thread pool, ahead of when they are needed. Reading a OneZoom
+    file queues the files for its tokens, so the whole include graph gets read in the background.
+    At most max_read_ahead files are read ahead and not used yet, so that the build doesn't hold
+    most of the include graph in memory when the reads get ahead of it.
+    '''
+    def __init__(self, executor, oz_parts_folder, ot_parts_folder, token_manifest, max_read_ahead, is_cached=None):
+        self.executor = executor
+        self.token_manifest = token_manifest
+        self.oz_parts_folder = oz_parts_folder
+        self.ot_parts_folder = ot_parts_folder
+        self.max_read_ahead = max_read_ahead
+
+        # Tells whether the subtree for a OneZoom file (with the name and edge length it has in its
+        # parent) is in the build cache, in which case we don't need any of its files
+        self.is_cached = is_cached or (lambda file, node_name_in_parent, edge_length_in_parent: False)
+
+        # The files being read or read and not used yet, and the files queued until there is room for them
+        self.futures = {}
+        self.queued_files = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, file, expand_nodes=False, fallback_file=None):
+        with self.lock:
+            if file not in self.futures and file not in self.queued_files:
+                self.queued_files[file] = (expand_nodes, fallback_file)
+            self.submit_queued_files()
+
+    def submit_queued_files(self):
+        # Called with the lock held
+        while self.queued_files and len(self.futures) < self.max_read_ahead:
+            file = next(iter(self.queued_files))
+            self.futures[file] = self.executor.submit(self.load, file, *self.queued_files.pop(file))
+
+    def load(self, file, expand_nodes, fallback_file):
+        tree = read_tree_file(file)
+        if tree is None and fallback_file:
+            # Queue the fallback before returning, so that it's there when the caller looks for it
+            self.prefetch(fallback_file)
+        elif tree is not None and expand_nodes:
+            for result in self.token_manifest.get_tokens(file, tree):
+                if 'base_ott' in result:
+                    self.prefetch(os.path.join(self.ot_parts_folder, f'{result["base_ott"]}.phy'),
+                                  fallback_file=os.path.join(self.ot_parts_folder, f'{result["base_ott"]}.nwk'))
+                elif result['full_name'] in token_to_file_map:
+                    sub_file = os.path.join(self.oz_parts_folder, token_to_file_map[result['full_name']]['file'])
+                    if not self.is_cached(sub_file, result['full_name'], result['edge_length']):
+                        self.prefetch(sub_file, True)
+        return tree
+
+    def exists(self, file):
+        with self.lock:
+            future = self.futures.get(file)
+        if future is None:
+            return os.path.exists(file)
+        if future.result() is not None:
+            return True
 
-    # Trim any whitespace
-    tree = tree.strip()
+        # A missing file is never read, so make room for another one
+        with self.lock:
+            self.futures.pop(file, None)
+            self.submit_queued_files()
+        return False
 
-    # Strip the trailing semicolon
-    if tree[-1] == ';':
-        tree = tree[:-1]
+    def read_tree(self, file):
+        # Each file is normally only needed once, so don't keep it around
+        with self.lock:
+            future = self.futures.pop(file, None)
+            queued_file = self.queued_files.pop(file, None) if future is None else None
+            self.submit_queued_files()
+        if future:
+            return future.result()
+
+        # Read a queued file now, still queuing the files it includes
+        return self.load(file, *queued_file) if queued_file else read_tree_file(file)
 
-    return tree
-    
 '''
 Copy the input file to the output file, recursively expanding any OneZoom tokens
 '''
-def build_oz_tree(base_file, ot_parts_folder, output_stream):
+def build_oz_tree(base_file, ot_parts_folder, output_stream, jobs=1, cache_dir=None, metrics=None, token_manifest=None,
+                  read_ahead=None):
+    # Assume that the base file is in the same folder as the OneZoom parts
+    oz_parts_folder = os.path.dirname(base_file)
+
+    metrics = metrics or Metrics()
+    output_stream = MeteredStream(output_stream, metrics)
+
+    # Report all the missing files and unmapped tokens before starting
+    token_manifest = token_manifest or TokenManifest()
+    with metrics.timed('check include graph'):
+        token_manifest.check_include_graph(base_file, ot_parts_folder)
+
+    cache = BuildCache(cache_dir) if cache_dir else None
+    subtree_keys = {}
+    if cache:
+        with metrics.timed('cache keys'):
+            subtree_keys = get_subtree_keys(base_file, oz_parts_folder, ot_parts_folder, cache, token_manifest)
+    def is_cached(file, node_name_in_parent, edge_length_in_parent):
+        key = subtree_keys.get((file, node_name_in_parent, edge_length_in_parent))
+        return key is not None and cache.has_expansion(key)
+
+    if jobs > 1:
+        with ThreadPoolExecutor(jobs) as executor:
+            prefetcher = TreeFilePrefetcher(executor, oz_parts_folder, ot_parts_folder, token_manifest,
+                                            read_ahead or DEFAULT_READ_AHEAD_PER_JOB * jobs, is_cached)
+            if not is_cached(base_file, None, None):
+                prefetcher.prefetch(base_file, expand_nodes=True)
+            expand_tree_files(base_file, oz_parts_folder, ot_parts_folder, output_stream,
+                              prefetcher.read_tree, prefetcher.exists, cache, subtree_keys, metrics, token_manifest)
+    else:
+        expand_tree_files(base_file, oz_parts_folder, ot_parts_folder, output_stream,
+                          read_tree_file, os.path.exists, cache, subtree_keys, metrics, token_manifest)
+
+    token_manifest.save()
+    metrics.count('files scanned for tokens', token_manifest.scanned_count)
+
+    if cache:
+        cache.save()
+        metrics.count('cache hits', cache.hits)
+        metrics.count('cache misses', cache.misses)
+    metrics.report()
+
+def get_subtree_keys(base_file, oz_parts_folder, ot_parts_folder, cache, token_manifest):
+    '''
+    Go through the include graph, and compute the build cache key of each OneZoom subtree. Returns a dictionary
+    of the keys, indexed by the file, and the name and edge length it has in its parent.
+    '''
+    subtree_keys = {}
+
+    def get_subtree_key(file, node_name_in_parent=None, edge_length_in_parent=None,
+                        mapping_entry=None, expand_nodes=False):
+        key_parts = [cache.get_file_hash(file), node_name_in_parent, edge_length_in_parent, mapping_entry, expand_nodes]
+
+        # The expansion of a OneZoom file also depends on all the files it includes
+        if expand_nodes and key_parts[0]:
+            for result in token_manifest.get_tokens(file):
+                sub_file, child_mapping_entry, expand_child_nodes = get_sub_file(result, oz_parts_folder, ot_parts_folder, os.path.exists)
+                key_parts.append(get_subtree_key(sub_file, result["full_name"], result['edge_length'], child_mapping_entry, expand_child_nodes))
+
+        key = cache.get_key(*key_parts)
+        if expand_nodes and key_parts[0]:
+            subtree_keys[(file, node_name_in_parent, edge_length_in_parent)] = key
+        return key
+
+    get_subtree_key(base_file, expand_nodes=True)
+    return subtree_keys
+
+def expand_tree_files(base_file, oz_parts_folder, ot_parts_folder, output_stream, read_tree, file_exists,
+                      cache=None, subtree_keys={}, metrics=None, token_manifest=None):
+    metrics = metrics or Metrics()
+    token_manifest = token_manifest or TokenManifest()
+
+    # The time spent on the children of the files being processed, to get the time spent on each file itself
+    children_seconds = []
+
     def process_newick(file, node_name_in_parent=None, edge_length_in_parent=None,
                        mapping_entry=None, expand_nodes=False):
+        start = time.perf_counter()
+        children_seconds.append(0)
+        try:
+            return process_cached_newick(file, node_name_in_parent, edge_length_in_parent, mapping_entry, expand_nodes)
+        finally:
+            seconds = time.perf_counter() - start
+            self_seconds = seconds - children_seconds.pop()
+            if children_seconds:
+                children_seconds[-1] += seconds
+            metrics.count_file(file, seconds=seconds, self_seconds=self_seconds)
+
+    # The recordings of the subtrees being expanded into the cache, innermost last
+    recordings = []
+
+    def write(text):
+        output_stream.write(text)
+        if recordings:
+            recordings[-1].write(text)
+
+    def process_cached_newick(file, node_name_in_parent, edge_length_in_parent, mapping_entry, expand_nodes):
+        # Use the cached expansion of the subtree if we have it, and otherwise save it in the cache as we write it.
+        # Either way, the subtree is only referred to by its key in the cached expansion of its parent.
+        key = subtree_keys.get((file, node_name_in_parent, edge_length_in_parent)) if expand_nodes else None
+        if not key:
+            return expand_newick(file, node_name_in_parent, edge_length_in_parent, mapping_entry, expand_nodes)
+
+        if cache.splice(key, output_stream):
+            logging.debug(f'Using cached expansion of {file}')
+            metrics.count_file(file, cached=1)
+            found = True
+        else:
+            with cache.record(key) as recording:
+                recordings.append(recording)
+                try:
+                    found = expand_newick(file, node_name_in_parent, edge_length_in_parent, mapping_entry, expand_nodes)
+                finally:
+                    recordings.pop()
+                if not found:
+                    recording.discard()
+
+        if found and recordings:
+            recordings[-1].add_subtree(key)
+        return found
+
+    def expand_newick(file, node_name_in_parent, edge_length_in_parent, mapping_entry, expand_nodes):
         logging.debug(f'Processing {file}')
 
-        if not os.path.exists(file):
-            logging.warning(f"Subtree file {file} does not exist")
+        with metrics.timed('read'):
+            tree = read_tree(file)
+        if tree is None:
+            # This was reported when checking the include graph
+            logging.debug(f"Subtree file {file} does not exist")
+            metrics.count('files missing')
             return False
 
-        with open(file, 'r', encoding="utf8") as stream:
-            tree = stream.read()
+        metrics.count('files read')
+        metrics.count('characters read', len(tree))
+        metrics.count_file(file, characters=len(tree))
 
-        tree = trim_tree(tree)
         index = 0
 
         # We only need to look for children if it's a OneZoom file (i.e. .PHY extension)
         if expand_nodes:
-            for result in enumerate_one_zoom_tokens(tree):
+            with metrics.timed('scan tokens'):
+                results = token_manifest.get_tokens(file, tree)
+            metrics.count('tokens expanded', len(results))
+            metrics.count_file(file, tokens=len(results))
+
+            for result in results:
                 # Write the part of the tree before the child
-                output_stream.write(tree[index:result['start']])
+                write(tree[index:result['start']])
 
                 child_full_name = result["full_name"]
-
-                # Check if OneZoom token has a base ott (e.g. 123 in foobar_ott123~456-789-111)
-                if 'base_ott' in result:
-                    # It's an extracted Open Tree file, e.g. 123.phy
-                    sub_file = os.path.join(ot_parts_folder, f'{result["base_ott"]}.phy')
-                    if not os.path.exists(sub_file):
-                        # Fall back to .nwk, which happens for additional copied files
-                        sub_file = os.path.join(ot_parts_folder, f'{result["base_ott"]}.nwk')
-                    expand_child_nodes = False
-                    child_mapping_entry = None
-                else:
-                    # Otherwise, it's a OneZoom file, e.g. AMORPHEA@ --> Amorphea.PHY
-                    child_mapping_entry = token_to_file_map[child_full_name]
-                    sub_file = os.path.join(oz_parts_folder, child_mapping_entry['file'])
-                    expand_child_nodes = True
+                sub_file, child_mapping_entry, expand_child_nodes = get_sub_file(result, oz_parts_folder, ot_parts_folder, file_exists)
 
                 if process_newick(sub_file, child_full_name, result['edge_length'], child_mapping_entry, expand_child_nodes):
                     index = result['end']
@@ -82,7 +283,7 @@ def build_oz_tree(base_file, ot_parts_folder, output_stream):
 
         # Write the last chunk, but exclude the last name:edge_length, which needs special handling
         last_closed_bracket = last_chunk.rfind(')')
-        output_stream.write(last_chunk[:last_closed_bracket+1])
+        write(last_chunk[:last_closed_bracket+1])
 
         # Parse the last token into the node name and edge length
         last_token = last_chunk[last_closed_bracket+1:]
@@ -104,23 +305,25 @@ def build_oz_tree(base_file, ot_parts_folder, output_stream):
             # DISCUSS: is there a logical reason for this?
             node_name = node_name_in_parent or last_token_name
 
-        output_stream.write(node_name)
+        write(node_name)
         if edge_length:
-            output_stream.write(f":{edge_length}")
+            write(f":{edge_length}")
 
         return True
 
-    # Assume that the base file is in the same folder as the OneZoom parts
-    oz_parts_folder = os.path.dirname(base_file)
-
     process_newick(base_file, expand_nodes=True)
-    
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
     parser.add_argument('treefile', help='The base tree file in newick form')
     parser.add_argument('ot_parts_folder', help='The folder containing the Open Tree parts')
     parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='The output tree file')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='the number of threads reading the part files ahead of time')
+    parser.add_argument('--read_ahead', type=int, help=f'with --jobs, the maximum number of part files read ahead of time and not used yet (default: {DEFAULT_READ_AHEAD_PER_JOB} per job)')
+    parser.add_argument('--cache_dir', help='a folder in which to cache the expanded subtrees, to speed up later builds')
+    parser.add_argument('--token_manifest', help='a JSON file in which to keep the tokens of the part files, to only scan the changed files')
+    parser.add_argument('--metrics', help='a JSON file in which to save the time spent in each phase and on each file, and other metrics of the build')
     args = parser.parse_args()
 
     if args.verbosity==0:
@@ -130,8 +333,18 @@ def main():
     elif args.verbosity==2:
         logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
-    build_oz_tree(args.treefile, args.ot_parts_folder, args.outfile)
+    metrics = Metrics()
+    token_manifest = TokenManifest(args.token_manifest)
+    build_oz_tree(args.treefile, args.ot_parts_folder, args.outfile, args.jobs, args.cache_dir, metrics, token_manifest,
+                  args.read_ahead)
     args.outfile.write(';')
+    if args.outfile is sys.stdout:
+        args.outfile.flush()
+    else:
+        args.outfile.close()
+
+    if args.metrics:
+        metrics.save(args.metrics)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
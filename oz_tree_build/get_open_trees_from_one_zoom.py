@@ -20,59 +20,242 @@ foobar_ott~456-789-111@ means create a node named foobar without any OTT number,
 
 The actual inclusion is done by the build_oz_tree.py. This script merely creates the
 files to include. It does this by extracting the relevant subtree from the full OpenTree 
+
+With --token_manifest, the tokens found in the OneZoom files are kept in a manifest shared with
+build_oz_tree (see token_manifest), so that only the files that changed are scanned again.
 '''
 
 import argparse
+import hashlib
+import json
 import logging
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from oz_tree_build.oz_tokens import enumerate_one_zoom_tokens
-from oz_tree_build.newick.extract_trees import extract_trees
+from oz_tree_build.newick.extract_trees import generate_subtrees_from_open_tree, open_tree_for_extraction
+from oz_tree_build.newick.index_open_tree import get_file_checksum
+from oz_tree_build.token_manifest import TokenManifest, read_tree_file
+from oz_tree_build.utilities.metrics import Metrics
 
 __author__ = "David Ebbo"
 
+MANIFEST_FILE = 'open_tree_manifest.json'
+MANIFEST_VERSION = 1
+
 '''
 Find all the included and excluded ott numbers in a OneZoom files, and add them to the sets
 '''
-def get_inclusions_and_exclusions_from_one_zoom_file(file, all_included_otts, all_excluded_otts):
-    with open(file, 'r', encoding="utf8") as stream:
-        tree = stream.read()
+def get_inclusions_and_exclusions_from_one_zoom_file(file, all_included_otts, all_excluded_otts, metrics=None,
+                                                    token_manifest=None):
+    if token_manifest:
+        # The manifest only scans the file again if it changed
+        results = token_manifest.get_tokens(file)
+    else:
+        # Scan the trimmed tree, as the manifest does, so that a token in the comment at the start is ignored either way
+        tree = read_tree_file(file)
+        results = None
+        if tree is not None:
+            if metrics:
+                metrics.count('one zoom files scanned')
+                metrics.count('characters read', len(tree))
+            results = enumerate_one_zoom_tokens(tree)
 
-    for result in enumerate_one_zoom_tokens(tree):
+    if results is None:
+        raise FileNotFoundError(f"Could not find the OneZoom file {file}")
+
+    for result in results:
         # Check if the result has a base ott (won't have it if it's inserting another OZ file)
         if 'base_ott' in result:
             all_included_otts.add(result['base_ott'])
             all_excluded_otts.update(result['excluded_otts'])
 
 '''
-Extract the subtrees from the Open Tree file, based on the list of included/excluded otts
+Find all the included and excluded ott numbers in a list of OneZoom files, scanning them in a pool of threads
 '''
-def extract_trees_from_open_tree_file(open_tree_file, output_dir, all_included_otts, all_excluded_otts):
-    # Read the contents of the open tree file into a string
-    with open(open_tree_file, 'r', encoding="utf8") as f:
-        fulltree = f.read()
+def get_inclusions_and_exclusions_from_one_zoom_files(files, threads=1, metrics=None, token_manifest=None):
+    def scan(file):
+        logging.info(f"== Processing One Zoom file {file}")
+        included_otts, excluded_otts = set(), set()
+        get_inclusions_and_exclusions_from_one_zoom_file(file, included_otts, excluded_otts, metrics, token_manifest)
+        return included_otts, excluded_otts
 
-    trees = extract_trees(fulltree, all_included_otts, excluded_taxa=all_excluded_otts)
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(scan, files))
 
-    logging.info(f"Extracted {len(trees)} trees from Open Tree file")
+    # Note that excluded ott numbers don't need to be specifically associated with an included ott number
+    all_included_otts, all_excluded_otts = set(), set()
+    for included_otts, excluded_otts in results:
+        all_included_otts |= included_otts
+        all_excluded_otts |= excluded_otts
+    return all_included_otts, all_excluded_otts
 
-    # Save each tree to a file named after the taxon
-    for ott, tree in trees.items():
-        file = os.path.join(output_dir, ott + ".phy")
+def write_file_atomically(file, content):
+    # Write to a temporary file first, so that an interrupted run doesn't leave a truncated tree
+    with open(file + '.tmp', "wb") as f:
+        f.write(content)
+    os.replace(file + '.tmp', file)
+
+class TreeFileWriter:
+    '''
+    Writes files in a pool of threads, so that the writes overlap with the extraction. The number of
+    pending writes is bounded, so that the extracted trees don't pile up in memory if the disk is slow.
+    '''
+    def __init__(self, threads, metrics):
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending_writes = threading.BoundedSemaphore(threads * 2)
+        self.futures = []
+
+    def write(self, file, content):
+        # Waiting for the pending writes when there are too many is part of the time spent writing
+        with self.metrics.timed('write'):
+            self.pending_writes.acquire()
+        future = self.executor.submit(self.write_file, file, content)
+        future.add_done_callback(lambda future: self.pending_writes.release())
+        self.futures.append(future)
+
+    def write_file(self, file, content):
         logging.debug(f'Writing file: {file}')
-        with open(file, "w", encoding="utf8") as f:
-            f.write(tree)
-            f.write(";\n")
+        with self.metrics.timed('write'):
+            write_file_atomically(file, content)
+        self.metrics.count('bytes written', len(content))
+
+    def close(self):
+        '''Wait for all the writes, raising the first error if any failed'''
+        self.executor.shutdown()
+        for future in self.futures:
+            future.result()
+
+'''
+Extract the subtrees from the Open Tree file, based on the list of included/excluded otts.
+
+A manifest in the output directory records the Open Tree file that the subtrees were extracted from,
+and for each subtree, the excluded otts that were cut out of it and a checksum of its content. On the
+next run, only the subtrees that are new, or that may have changed, are extracted again, and the files
+whose content is unchanged are not rewritten, so their modification time stays the same.
+'''
+def extract_trees_from_open_tree_file(open_tree_file, output_dir, all_included_otts, all_excluded_otts, workers=1,
+                                      threads=1, metrics=None):
+    metrics = metrics or Metrics()
+    with metrics.timed('read'):
+        manifest = load_manifest(output_dir)
+        open_tree_entry = get_open_tree_entry(open_tree_file, manifest.get('open_tree_file'))
+    all_excluded_otts = set(all_excluded_otts)
+
+    # Any subtree may contain a newly excluded ott, so we need to extract them all, and the same goes for
+    # a new version of the Open Tree. Otherwise, only new subtrees and those that had an exclusion removed
+    # can change.
+    tree_entries = manifest.get('trees', {})
+    previously_excluded_otts = set(manifest.get('excluded_otts', []))
+    open_tree_changed = open_tree_entry['checksum'] != manifest.get('open_tree_file', {}).get('checksum')
+    if open_tree_changed or all_excluded_otts - previously_excluded_otts:
+        otts_to_extract = set(all_included_otts)
+    else:
+        removed_excluded_otts = previously_excluded_otts - all_excluded_otts
+        otts_to_extract = {ott for ott in all_included_otts
+                           if ott not in tree_entries or removed_excluded_otts.intersection(tree_entries[ott]['excluded_otts'])
+                           or (tree_entries[ott]['checksum'] and not os.path.exists(os.path.join(output_dir, ott + ".phy")))}
+
+    written_count, skipped_count, deleted_count = 0, len(set(all_included_otts) - otts_to_extract), 0
+    new_tree_entries = {ott: tree_entries[ott] for ott in all_included_otts if ott not in otts_to_extract}
+    if not otts_to_extract:
+        tree_stream = None
+    else:
+        # This loads the index of the open tree file if there is one, or memory maps the file otherwise
+        with metrics.timed('read'):
+            tree_stream, index, newick_tree = open_tree_for_extraction(open_tree_file)
 
+    writer = TreeFileWriter(threads, metrics)
+    try:
+        # The trees are written as they are found, while the extraction goes on
+        subtrees = generate_subtrees_from_open_tree(tree_stream, index, newick_tree, otts_to_extract,
+                                                    excluded_taxa=all_excluded_otts, workers=workers,
+                                                    metrics=metrics) if tree_stream else []
+        for subtree in metrics.timed_iter(subtrees, 'extract'):
+            with metrics.timed('extract'):
+                ott = subtree['ott'] or subtree['name']
+                file = os.path.join(output_dir, ott + ".phy")
+                tree = subtree['tree_string'] + b";\n"
+                checksum = hashlib.sha256(tree).hexdigest()
+                new_tree_entries[ott] = {'excluded_otts': sorted(subtree['excluded_taxa']), 'checksum': checksum}
+
+            if ott in tree_entries and tree_entries[ott]['checksum'] == checksum and os.path.exists(file):
+                skipped_count += 1
+            else:
+                # Save each tree to a file named after the taxon
+                writer.write(file, tree)
+                written_count += 1
+    finally:
+        with metrics.timed('wait for writes'):
+            writer.close()
+        if tree_stream:
+            tree_stream.close()
+
+    for ott in otts_to_extract - set(new_tree_entries):
+        # The ott is no longer in the tree, so drop any file we wrote for it before
+        new_tree_entries[ott] = {'excluded_otts': [], 'checksum': None}
+        file = os.path.join(output_dir, ott + ".phy")
+        if ott in tree_entries and os.path.exists(file):
+            os.remove(file)
+            deleted_count += 1
+
+    # Drop the files for the otts that are no longer included
+    for ott in set(tree_entries) - set(all_included_otts):
+        file = os.path.join(output_dir, ott + ".phy")
+        if os.path.exists(file):
+            os.remove(file)
+            deleted_count += 1
+
+    save_manifest(output_dir, {'open_tree_file': open_tree_entry, 'excluded_otts': sorted(all_excluded_otts), 'trees': new_tree_entries})
+
+    logging.info(f"Wrote {written_count} files, skipped {skipped_count} unchanged files, and deleted {deleted_count} stale files")
+    metrics.count('files written', written_count)
+    metrics.count('files skipped', skipped_count)
+    metrics.count('files deleted', deleted_count)
+    metrics.report()
+    return written_count, skipped_count, deleted_count
+
+def get_manifest_file(output_dir):
+    return os.path.join(output_dir, MANIFEST_FILE)
+
+def load_manifest(output_dir):
+    manifest_file = get_manifest_file(output_dir)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r', encoding="utf8") as f:
+        manifest = json.load(f)
+    return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+def save_manifest(output_dir, manifest):
+    manifest_file = get_manifest_file(output_dir)
+    with open(manifest_file + '.tmp', 'w', encoding="utf8") as f:
+        json.dump({'version': MANIFEST_VERSION, **manifest}, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def get_open_tree_entry(open_tree_file, previous_entry):
+    '''
+    Describe the Open Tree file for the manifest. The checksum is only computed if the size or
+    modification time changed, since it means reading the whole file.
+    '''
+    stat = os.stat(open_tree_file)
+    if previous_entry and previous_entry['size'] == stat.st_size and previous_entry['mtime_ns'] == stat.st_mtime_ns:
+        return previous_entry
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'checksum': get_file_checksum(open_tree_file).hex()}
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('--workers', '-j', type=int, default=1, help='the number of worker processes to use when parsing the Open Tree file')
+    parser.add_argument('--threads', '-t', type=int, default=1, help='the number of threads scanning the OneZoom files, and writing the subtree files')
     parser.add_argument('open_tree_file', help='Path to the Open Tree newick file')
     parser.add_argument('output_dir', help='Path to the directory in which to save the OpenTree subtrees')
     parser.add_argument('parse_files', nargs='+', help='A list of newick files to parse for OTT numbers, giving the subtrees to extract')
+    parser.add_argument('--token_manifest', help='a JSON file in which to keep the tokens of the OneZoom files, to only scan the changed files')
+    parser.add_argument('--metrics', help='a JSON file in which to save the time spent in each phase, and other metrics of the run')
     args = parser.parse_args()
 
     if args.verbosity==0:
@@ -87,17 +270,23 @@ def main():
         logging.warning("Could not find the OpenTree file {}".format(args.open_tree_file))
 
     # Go through all the OneZoom files, and gather all the ott numbers to include and exclude
-    # Note that excluded ott numbers don't need to be specifically associated with an included ott number
-    included_otts = set()
-    excluded_otts = set()
-    for file in args.parse_files:
-        logging.info(f"== Processing One Zoom file {file}")
-        get_inclusions_and_exclusions_from_one_zoom_file(file, included_otts, excluded_otts)
-    
-    extract_trees_from_open_tree_file(args.open_tree_file, args.output_dir, included_otts, excluded_otts)
+    metrics = Metrics()
+    token_manifest = TokenManifest(args.token_manifest) if args.token_manifest else None
+    with metrics.timed('scan'):
+        included_otts, excluded_otts = get_inclusions_and_exclusions_from_one_zoom_files(args.parse_files, args.threads, metrics,
+                                                                                         token_manifest)
+    if token_manifest:
+        token_manifest.save()
+        metrics.count('one zoom files scanned', token_manifest.scanned_count)
+
+    extract_trees_from_open_tree_file(args.open_tree_file, args.output_dir, included_otts, excluded_otts, args.workers,
+                                      args.threads, metrics)
     
     end = time.time()
     logging.debug("Time taken: {} seconds".format(end - start))
 
+    if args.metrics:
+        metrics.save(args.metrics)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
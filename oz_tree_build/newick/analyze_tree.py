@@ -0,0 +1,294 @@
+'''
+Compute statistics of a Newick tree in a single pass, and output them as JSON, e.g. to track how
+the Open Tree changes from one release to the next.
+'''
+
+'''
+The statistics are the number of nodes and tips, the histogram of the tip depths, the number of
+children of the internal nodes (to see the polytomies), the distribution of the edge lengths (by
+power of 10), how many nodes have an OTT id, the kinds of taxon names (higher taxa, species and
+subspecies, guessed from the number of underscores), and the largest clades by number of tips.
+
+With --workers, the tree is split into chunks between sibling clades (see split_tree), which are
+analyzed in separate processes. The statistics that depend on whole clades (the number of children
+and tips of a node) are completed when merging the chunks, for the clades spanning several chunks.
+
+For example:
+analyze_tree tree.tre stats.json --workers 4 --top_clades 20
+'''
+
+import argparse
+import heapq
+import json
+import logging
+import math
+import multiprocessing
+import sys
+from collections import Counter
+
+from oz_tree_build.newick.newick_parser import is_tree_stream, map_tree_file, parse_tree
+from oz_tree_build.newick.split_tree import TreeChunk, match_chunk_braces, split_tree
+from oz_tree_build.utilities.metrics import Metrics
+
+__author__ = "David Ebbo"
+
+DEFAULT_TOP_CLADE_COUNT = 10
+
+analyzed_fields = ('taxon', 'ott', 'edge_length', 'start', 'depth', 'is_leaf')
+
+def get_edge_length_bucket(exponent):
+    '''The name of an edge length histogram bucket, e.g. '1e-2' for 0.01 <= edge_length < 0.1'''
+    return exponent if isinstance(exponent, str) else f"1e{exponent}"
+
+def edge_length_bucket_order(exponent):
+    return (0, 0) if exponent == 'negative' else (1, 0) if exponent == 'zero' else (2, exponent)
+
+# The kinds of taxon names, by number of underscores (e.g. Homo_sapiens is a species)
+name_kinds_by_underscore_count = {-1: 'unnamed', 0: 'higher taxa', 1: 'species', 2: 'subspecies'}
+
+class TreeStats:
+    '''
+    The statistics of a tree, or of a chunk of a tree (see TreeChunk). For a chunk, the depths are
+    relative to its start, and the nodes whose start is in an earlier chunk can't be completed until
+    the chunks are merged: their number of children and tips only include the nodes in the chunk.
+    '''
+    def __init__(self, top_clade_count=DEFAULT_TOP_CLADE_COUNT):
+        self.top_clade_count = top_clade_count
+        self.node_count = 0
+        self.tip_depths = Counter()
+        self.child_counts = Counter()
+        self.ott_counts = Counter()
+
+        # The edge lengths by power of 10 (or 'zero' and 'negative'), and the names by number of underscores
+        self.edge_lengths = Counter()
+        self.edge_length_total = 0.0
+        self.edge_length_min = None
+        self.edge_length_max = None
+        self.underscore_counts = Counter()
+
+        # A min heap of the largest clades, as (tip count, -start, taxon, ott, depth)
+        self.largest_clades = []
+
+        # The nodes whose start is in an earlier chunk, as (taxon, ott, depth, child count, tip count)
+        self.partial_nodes = []
+
+        # The number of children and tips found so far for the nodes still open, by depth of the children
+        self.open_child_counts = Counter()
+        self.open_tip_counts = Counter()
+
+    def add_nodes(self, nodes):
+        '''Add the nodes returned by parse_tree with the analyzed_fields, in post-order'''
+        tip_depths = self.tip_depths
+        child_counts = self.child_counts
+        ott_counts = self.ott_counts
+        edge_lengths = self.edge_lengths
+        underscore_counts = self.underscore_counts
+        open_child_counts = self.open_child_counts
+        open_tip_counts = self.open_tip_counts
+        log10, floor = math.log10, math.floor
+        edge_length_total = 0.0
+        edge_length_min = math.inf if self.edge_length_min is None else self.edge_length_min
+        edge_length_max = -math.inf if self.edge_length_max is None else self.edge_length_max
+        node_count = 0
+
+        for taxon, ott, edge_length, start, depth, is_leaf in nodes:
+            node_count += 1
+            if is_leaf:
+                tip_depths[depth] += 1
+                tip_count = 1
+                if ott:
+                    ott_counts['tips'] += 1
+            else:
+                child_count = open_child_counts.pop(depth + 1, 0)
+                tip_count = open_tip_counts.pop(depth + 1, 0)
+                if start is None:
+                    self.partial_nodes.append((taxon, ott, depth, child_count, tip_count))
+                else:
+                    child_counts[child_count] += 1
+                    self.add_clade(tip_count, start, taxon, ott, depth)
+                if ott:
+                    ott_counts['internal nodes'] += 1
+
+            open_child_counts[depth] += 1
+            open_tip_counts[depth] += tip_count
+
+            if edge_length > 0:
+                edge_lengths[floor(log10(edge_length))] += 1
+            else:
+                edge_lengths['zero' if edge_length == 0 else 'negative'] += 1
+            if edge_length:
+                edge_length_total += edge_length
+                if edge_length < edge_length_min:
+                    edge_length_min = edge_length
+                if edge_length > edge_length_max:
+                    edge_length_max = edge_length
+
+            # Ignore what follows a dot, e.g. in Foo_sp._1
+            underscore_counts[taxon.partition('.')[0].count('_') if taxon else -1] += 1
+
+        self.node_count += node_count
+        self.edge_length_total += edge_length_total
+        if edge_length_min <= edge_length_max:
+            self.edge_length_min, self.edge_length_max = edge_length_min, edge_length_max
+
+    def add_clade(self, tip_count, start, taxon, ott, depth):
+        # The clades with the same number of tips are kept in tree order
+        clade = (tip_count, -start, taxon, ott, depth)
+        if len(self.largest_clades) < self.top_clade_count:
+            heapq.heappush(self.largest_clades, clade)
+        elif clade > self.largest_clades[0]:
+            heapq.heapreplace(self.largest_clades, clade)
+
+    def merge(self, chunk_stats, depth_at_start, starts):
+        '''
+        Add the statistics of the next chunk of the tree, given the depth at its start and the starts of
+        its partial nodes, as returned by match_chunk_braces
+        '''
+        shift = lambda counter: Counter({depth + depth_at_start: count for depth, count in counter.items()})
+
+        self.node_count += chunk_stats.node_count
+        self.tip_depths.update(shift(chunk_stats.tip_depths))
+        self.child_counts.update(chunk_stats.child_counts)
+        self.edge_lengths.update(chunk_stats.edge_lengths)
+        self.edge_length_total += chunk_stats.edge_length_total
+        for value in (chunk_stats.edge_length_min, chunk_stats.edge_length_max):
+            if value is not None:
+                self.edge_length_min = value if self.edge_length_min is None else min(self.edge_length_min, value)
+                self.edge_length_max = value if self.edge_length_max is None else max(self.edge_length_max, value)
+        self.ott_counts.update(chunk_stats.ott_counts)
+        self.underscore_counts.update(chunk_stats.underscore_counts)
+        for tip_count, negative_start, taxon, ott, depth in chunk_stats.largest_clades:
+            self.add_clade(tip_count, -negative_start, taxon, ott, depth + depth_at_start)
+
+        # Complete the partial nodes with the children and tips found in the earlier chunks. The extra
+        # tips also belong to their parent, which is either a later partial node, or still open.
+        for (taxon, ott, depth, child_count, tip_count), start in zip(chunk_stats.partial_nodes, starts):
+            depth += depth_at_start
+            child_count += self.open_child_counts.pop(depth + 1, 0)
+            extra_tip_count = self.open_tip_counts.pop(depth + 1, 0)
+            self.open_tip_counts[depth] += extra_tip_count
+            self.child_counts[child_count] += 1
+            self.add_clade(tip_count + extra_tip_count, start, taxon, ott, depth)
+
+        self.open_child_counts.update(shift(chunk_stats.open_child_counts))
+        self.open_tip_counts.update(shift(chunk_stats.open_tip_counts))
+
+    def to_dict(self):
+        tip_count = sum(self.tip_depths.values())
+        edge_length_count = self.node_count - self.edge_lengths['zero']
+        name_kinds = Counter()
+        for underscore_count, count in self.underscore_counts.items():
+            name_kinds[name_kinds_by_underscore_count.get(underscore_count, 'other')] += count
+        sorted_counter = lambda counter: {str(key): counter[key] for key in sorted(counter)}
+        return {
+            'nodes': self.node_count,
+            'tips': tip_count,
+            'internal_nodes': self.node_count - tip_count,
+            'max_depth': max(self.tip_depths, default=0),
+            'mean_tip_depth': sum(depth * count for depth, count in self.tip_depths.items()) / tip_count if tip_count else None,
+            'tip_depths': sorted_counter(self.tip_depths),
+            'child_counts': sorted_counter(self.child_counts),
+            'edge_lengths': {
+                'count': edge_length_count,
+                'total': self.edge_length_total,
+                'min': self.edge_length_min,
+                'max': self.edge_length_max,
+                'mean': self.edge_length_total / edge_length_count if edge_length_count else None,
+                'histogram': {get_edge_length_bucket(exponent): self.edge_lengths[exponent]
+                              for exponent in sorted(self.edge_lengths, key=edge_length_bucket_order)},
+            },
+            'ott': {
+                'nodes': self.ott_counts['tips'] + self.ott_counts['internal nodes'],
+                'tips': self.ott_counts['tips'],
+                'internal_nodes': self.ott_counts['internal nodes'],
+            },
+            'name_kinds': dict(name_kinds),
+            'largest_clades': [{'taxon': taxon, 'ott': ott, 'tips': tip_count, 'depth': depth}
+                               for tip_count, _, taxon, ott, depth in sorted(self.largest_clades, reverse=True)],
+        }
+
+def analyze_tree(newick_tree, workers=1, top_clade_count=DEFAULT_TOP_CLADE_COUNT, metrics=None):
+    '''
+    Compute the statistics of a string or bytes-like tree, as a dictionary (see TreeStats.to_dict),
+    using the given number of worker processes. The tree can also be a file object, which is read in
+    chunks, but then only serially.
+    '''
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning("Can't fork worker processes on this platform, so analyzing the tree serially")
+        workers = 1
+    if workers > 1 and is_tree_stream(newick_tree):
+        logging.warning("The tree is read from a stream, so analyzing it serially")
+        workers = 1
+
+    if workers > 1:
+        stats = analyze_tree_in_parallel(newick_tree, workers, top_clade_count)
+    else:
+        stats = TreeStats(top_clade_count)
+        stats.add_nodes(parse_tree(newick_tree, analyzed_fields))
+
+    if metrics:
+        metrics.count('nodes parsed', stats.node_count)
+        # The size of a stream isn't known, but the whole tree is scanned either way
+        if not is_tree_stream(newick_tree):
+            metrics.count('bytes scanned' if not isinstance(newick_tree, str) else 'characters scanned', len(newick_tree))
+
+    return stats.to_dict()
+
+# The state shared with the worker processes. They're forked, so they get the tree without copying it.
+parallel_state = {}
+
+def analyze_chunk(chunk_range):
+    '''
+    Worker for analyze_tree_in_parallel: compute the statistics of a chunk returned by split_tree
+    '''
+    newick_tree, top_clade_count = parallel_state['args']
+    chunk = TreeChunk(newick_tree, *chunk_range)
+
+    stats = TreeStats(top_clade_count)
+    stats.add_nodes(chunk.parse(analyzed_fields))
+    return stats, chunk.unmatched_braces
+
+def analyze_tree_in_parallel(newick_tree, workers, top_clade_count=DEFAULT_TOP_CLADE_COUNT):
+    # Use a few chunks per worker, so that the work stays balanced if some are slower
+    chunk_ranges = split_tree(newick_tree, workers * 4)
+
+    parallel_state['args'] = (newick_tree, top_clade_count)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            chunk_results = pool.map(analyze_chunk, chunk_ranges)
+    finally:
+        parallel_state.clear()
+
+    stats = TreeStats(top_clade_count)
+    unmatched_braces = [unmatched_braces for _, unmatched_braces in chunk_results]
+    for (chunk_stats, _), (depth_at_start, starts) in zip(chunk_results, match_chunk_braces(unmatched_braces)):
+        stats.merge(chunk_stats, depth_at_start, starts)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('treefile', type=argparse.FileType('rb'), nargs='?', default=sys.stdin, help='The tree file in newick form')
+    parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='The output JSON file')
+    parser.add_argument('--workers', '-j', type=int, default=1, help='the number of worker processes to use')
+    parser.add_argument('--top_clades', type=int, default=DEFAULT_TOP_CLADE_COUNT, help='the number of largest clades to list')
+    parser.add_argument('--metrics', help='a JSON file in which to save the time spent in each phase, and other metrics of the run')
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    with metrics.timed('read'):
+        # Memory map the file, or decompress it if it's compressed. The workers need to access the
+        # whole tree, but a single process can read the files that can't be mapped as it parses them.
+        tree = map_tree_file(args.treefile, random_access=args.workers > 1)
+
+    with metrics.timed('analyze'):
+        stats = analyze_tree(tree, args.workers, args.top_clades, metrics)
+
+    with metrics.timed('write'):
+        json.dump(stats, args.outfile, indent=2)
+        args.outfile.write('\n')
+
+    if args.metrics:
+        metrics.save(args.metrics)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+'''
+Precompute metrics of every clade of a newick tree, and save them in a sidecar file next to it, so
+that questions like "how many species are under ott X?" or "what is the age of node Y?" can be
+answered without parsing the tree again.
+
+The metrics of each node are its number of descendant tips and of nodes in its subtree, its distance
+from the root, the largest distance from it to one of its tips (its age, in a dated tree), and its
+left and right nested set numbers. The nodes are identified by their id in post-order (the same ids
+as in index_open_tree and CompactTree), or by ott.
+
+From the command line, run for example:
+python3 clade_metrics.py labelled_supertree_simplified_ottnames.tre --otts 770315 5334778
+
+This writes labelled_supertree_simplified_ottnames.tre.ozcm next to the tree file (or reuses it if
+it's up to date), and outputs the metrics of the given otts as JSON.
+'''
+
+'''
+The metrics are computed in a single pass over parse_tree, followed by a pass over the arrays
+for the distances from the root (a node's parent only comes after it in post-order).
+
+The sidecar is a binary file, which is memory mapped when used, so that looking up a few nodes only
+touches a few pages of it. All integers are little-endian.
+
+- Header: magic, tree file size, tree file mtime (ns), tree file SHA-256, the node count, and the
+  number of bits of the ott table size.
+- The float64 columns, by node id: root distances, max tip distances.
+- The ott table: an open addressing hash table of the otts (int64, -1 for empty slots), which finds
+  a node by ott in constant time.
+- The int32 columns, by node id: tip counts, node counts, left and right nested set numbers, and
+  the node ids matching the ott table.
+
+In the nested set numbering, the left number of a node comes before the left numbers of all its
+descendants, and its right number after their right numbers, so a node is a descendant of another
+if its left number is between the other's left and right numbers.
+'''
+
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from oz_tree_build.newick.index_open_tree import get_file_checksum
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+from oz_tree_build.utilities.compressed_files import open_tree_file
+
+__author__ = "David Ebbo"
+
+CLADE_METRICS_MAGIC = b'OZCM0001'
+header_struct = struct.Struct('<8sqq32sqq')
+
+# The columns, in the order they are saved in, with their types
+float_column_names = ('root_distances', 'max_tip_distances')
+int_column_names = ('tip_counts', 'node_counts', 'lefts', 'rights')
+
+# The multiplier of the Fibonacci hashing of the otts
+hash_multiplier = 0x9E3779B97F4A7C15
+hash_mask = (1 << 64) - 1
+
+def get_metrics_file(tree_file):
+    return tree_file + '.ozcm'
+
+def ott_slot(ott, bits):
+    '''The first slot to try for an ott, in an ott table of 2**bits slots'''
+    return ((ott * hash_multiplier) & hash_mask) >> (64 - bits)
+
+class CladeMetrics:
+    '''
+    The metrics of the nodes of a tree, as columns indexed by node id, and a hash table to find the
+    nodes by ott. Build it with from_newick and save it with save, or load a saved one with load.
+    '''
+    def __init__(self, root_distances, max_tip_distances, tip_counts, node_counts, lefts, rights,
+                 ott_keys, ott_node_ids):
+        self.root_distances = root_distances
+        self.max_tip_distances = max_tip_distances
+        self.tip_counts = tip_counts
+        self.node_counts = node_counts
+        self.lefts = lefts
+        self.rights = rights
+        self.ott_keys = ott_keys
+        self.ott_node_ids = ott_node_ids
+        self.ott_bits = len(ott_keys).bit_length() - 1
+
+        # Set for the metrics loaded from a file
+        self.tree_size = self.tree_mtime_ns = self.tree_checksum = None
+
+    @classmethod
+    def from_newick(cls, newick_tree):
+        '''Compute the metrics of a tree, which can be a string or a bytes-like object'''
+        edge_lengths = array('d')
+        depths = array('i')
+        max_tip_distances = array('d')
+        tip_counts = array('i')
+        node_counts = array('i')
+        lefts = array('i')
+        rights = array('i')
+        otts = array('q')
+        ott_node_ids = array('i')
+
+        # The tips, nodes and max tip distance found so far for the children of the open nodes, by depth of the children
+        open_tip_counts = []
+        open_node_counts = []
+        open_max_tip_distances = []
+
+        for node_id, (ott, edge_length, depth, is_leaf) in enumerate(parse_tree(newick_tree, ('ott', 'edge_length', 'depth', 'is_leaf'))):
+            while len(open_tip_counts) <= depth + 1:
+                open_tip_counts.append(0)
+                open_node_counts.append(0)
+                open_max_tip_distances.append(-math.inf)
+
+            if is_leaf:
+                tip_count, node_count, max_tip_distance = 1, 1, 0.0
+            else:
+                tip_count, node_count, max_tip_distance = open_tip_counts[depth + 1], open_node_counts[depth + 1] + 1, open_max_tip_distances[depth + 1]
+                open_tip_counts[depth + 1] = open_node_counts[depth + 1] = 0
+                open_max_tip_distances[depth + 1] = -math.inf
+
+            open_tip_counts[depth] += tip_count
+            open_node_counts[depth] += node_count
+            if max_tip_distance + edge_length > open_max_tip_distances[depth]:
+                open_max_tip_distances[depth] = max_tip_distance + edge_length
+
+            # The nodes entered before this one are its ancestors, and the nodes before its subtree in post-order
+            left = 2 * (node_id - node_count + 1) + depth + 1
+
+            edge_lengths.append(edge_length)
+            depths.append(depth)
+            max_tip_distances.append(max_tip_distance)
+            tip_counts.append(tip_count)
+            node_counts.append(node_count)
+            lefts.append(left)
+            rights.append(left + 2 * node_count - 1)
+            if ott and ott.isdigit():
+                otts.append(int(ott))
+                ott_node_ids.append(node_id)
+
+        # In reverse post-order, a node's parent is the last node seen at the depth above it
+        root_distances = array('d', bytes(8 * len(depths)))
+        distances_by_depth = [0.0]
+        for node_id in reversed(range(len(depths))):
+            depth = depths[node_id]
+            distance = distances_by_depth[depth - 1] + edge_lengths[node_id] if depth > 0 else 0.0
+            root_distances[node_id] = distance
+            if depth == len(distances_by_depth):
+                distances_by_depth.append(distance)
+            else:
+                distances_by_depth[depth] = distance
+
+        return cls(root_distances, max_tip_distances, tip_counts, node_counts, lefts, rights, *build_ott_table(otts, ott_node_ids))
+
+    def save(self, metrics_file, tree_file):
+        '''Save the metrics of a tree file, with its size, modification time and checksum to detect stale files'''
+        stat = os.stat(tree_file)
+        header = header_struct.pack(CLADE_METRICS_MAGIC, stat.st_size, stat.st_mtime_ns, get_file_checksum(tree_file),
+                                    len(self), self.ott_bits)
+
+        # Write to a temporary file first, so that an interrupted build doesn't leave a broken file
+        with open(metrics_file + '.tmp', 'wb') as f:
+            f.write(header)
+            for column_name in float_column_names:
+                getattr(self, column_name).tofile(f)
+            self.ott_keys.tofile(f)
+            for column_name in int_column_names:
+                getattr(self, column_name).tofile(f)
+            self.ott_node_ids.tofile(f)
+        os.replace(metrics_file + '.tmp', metrics_file)
+
+    @classmethod
+    def from_file(cls, metrics_file):
+        '''Open a saved metrics file, whose columns are views over the memory mapped file'''
+        with open(metrics_file, 'rb') as f:
+            # The mapping stays open as long as the columns use it, even once the file is closed
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, tree_size, tree_mtime_ns, tree_checksum, node_count, ott_bits = header_struct.unpack_from(buffer)
+        if magic != CLADE_METRICS_MAGIC:
+            raise ValueError(f"{metrics_file} is not a clade metrics file")
+
+        # Carve out views over each section of the file, without copying anything
+        view = memoryview(buffer)
+        offset = header_struct.size
+        def take(typecode, count):
+            nonlocal offset
+            size = count * array(typecode).itemsize
+            section = view[offset:offset + size].cast(typecode)
+            offset += size
+            return section
+
+        float_columns = [take('d', node_count) for column_name in float_column_names]
+        ott_keys = take('q', 1 << ott_bits)
+        int_columns = [take('i', node_count) for column_name in int_column_names]
+        ott_node_ids = take('i', 1 << ott_bits)
+
+        metrics = cls(*float_columns, *int_columns, ott_keys, ott_node_ids)
+        metrics.tree_size, metrics.tree_mtime_ns, metrics.tree_checksum = tree_size, tree_mtime_ns, tree_checksum
+        return metrics
+
+    @classmethod
+    def load(cls, tree_file, metrics_file=None):
+        '''
+        Load the metrics for the tree file, or return None if they don't exist or are stale
+        '''
+        metrics_file = metrics_file or get_metrics_file(tree_file)
+        if not os.path.exists(metrics_file):
+            logging.info(f"No clade metrics found for {tree_file}")
+            return None
+
+        metrics = cls.from_file(metrics_file)
+        stat = os.stat(tree_file)
+        if stat.st_size != metrics.tree_size:
+            logging.warning(f"Ignoring stale clade metrics {metrics_file}: the tree file size has changed")
+            return None
+
+        # If the file was touched or copied, fall back to checking its contents
+        if stat.st_mtime_ns != metrics.tree_mtime_ns and get_file_checksum(tree_file) != metrics.tree_checksum:
+            logging.warning(f"Ignoring stale clade metrics {metrics_file}: the tree file checksum has changed")
+            return None
+
+        return metrics
+
+    def __len__(self):
+        return len(self.tip_counts)
+
+    def find_ott(self, ott):
+        '''The id of the first node (in post-order) with the given ott (int or string), or None if it's not in the tree'''
+        if not str(ott).isdigit():
+            return None
+        ott = int(ott)
+        mask = len(self.ott_keys) - 1
+        slot = ott_slot(ott, self.ott_bits)
+        while self.ott_keys[slot] != -1:
+            if self.ott_keys[slot] == ott:
+                return self.ott_node_ids[slot]
+            slot = (slot + 1) & mask
+        return None
+
+    def node_metrics(self, node_id):
+        '''The metrics of a node, as a dictionary'''
+        return {'tip_count': self.tip_counts[node_id], 'node_count': self.node_counts[node_id],
+                'root_distance': self.root_distances[node_id], 'max_tip_distance': self.max_tip_distances[node_id],
+                'left': self.lefts[node_id], 'right': self.rights[node_id]}
+
+    def ott_metrics(self, ott):
+        '''The metrics of the node with the given ott, as a dictionary'''
+        node_id = self.find_ott(ott)
+        if node_id is None:
+            raise KeyError(f"{ott} is not in the tree")
+        return self.node_metrics(node_id)
+
+    def is_descendant(self, descendant_id, ancestor_id):
+        '''Whether the first node is the second one or one of its descendants'''
+        return self.lefts[ancestor_id] <= self.lefts[descendant_id] <= self.rights[ancestor_id]
+
+    def to_numpy(self):
+        '''
+        Return the columns as a dictionary of NumPy arrays, for vectorized analysis.
+        The arrays share memory with the columns, so no data is copied.
+        '''
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("NumPy is needed to export clade metrics to NumPy arrays")
+
+        return {
+            'root_distance': np.frombuffer(self.root_distances, dtype=np.float64),
+            'max_tip_distance': np.frombuffer(self.max_tip_distances, dtype=np.float64),
+            'tip_count': np.frombuffer(self.tip_counts, dtype=np.int32),
+            'node_count': np.frombuffer(self.node_counts, dtype=np.int32),
+            'left': np.frombuffer(self.lefts, dtype=np.int32),
+            'right': np.frombuffer(self.rights, dtype=np.int32),
+        }
+
+def build_ott_table(otts, node_ids):
+    '''
+    Build the hash table of the otts and their node ids, with at least twice as many slots as otts so that the
+    probe sequences stay short. For duplicate otts, the first node is kept, like the extract functions do.
+    '''
+    bits = max(len(otts) * 2 - 1, 1).bit_length()
+    mask = (1 << bits) - 1
+    ott_keys = array('q', [-1]) * (1 << bits)
+    ott_node_ids = array('i', [-1]) * (1 << bits)
+    for ott, node_id in zip(otts, node_ids):
+        slot = ott_slot(ott, bits)
+        while ott_keys[slot] != -1 and ott_keys[slot] != ott:
+            slot = (slot + 1) & mask
+        if ott_keys[slot] == -1:
+            ott_keys[slot] = ott
+            ott_node_ids[slot] = node_id
+    return ott_keys, ott_node_ids
+
+def build_clade_metrics(tree_file, metrics_file=None):
+    '''
+    Parse the whole (possibly compressed) tree file once, and save the clade metrics for it
+    '''
+    metrics_file = metrics_file or get_metrics_file(tree_file)
+    with open_tree_file(tree_file) as f:
+        metrics = CladeMetrics.from_newick(map_tree_file(f))
+    metrics.save(metrics_file, tree_file)
+
+    logging.info(f"Saved the clade metrics of {len(metrics)} nodes to {metrics_file}")
+    return metrics
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('treefile', help='The tree file in newick form')
+    parser.add_argument('metricsfile', nargs='?', help='The clade metrics file (default: the tree file name + .ozcm)')
+    parser.add_argument('--otts', '-o', nargs='+', help='the otts to output the metrics of, as JSON')
+    parser.add_argument('--rebuild', action='store_true', help='build the metrics file even if it is up to date')
+    args = parser.parse_args()
+
+    if args.verbosity==0:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    elif args.verbosity==1:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbosity==2:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+    metrics = None if args.rebuild else CladeMetrics.load(args.treefile, args.metricsfile)
+    if metrics is None:
+        metrics = build_clade_metrics(args.treefile, args.metricsfile)
+
+    if args.otts:
+        result = {ott: metrics.ott_metrics(ott) if metrics.find_ott(ott) is not None else None for ott in args.otts}
+        print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+'''
+Compact, array-backed representation of a whole parsed tree, for keeping very large trees
+(e.g. the full Open Tree) in memory and running repeated queries on them.
+
+Instead of one dictionary per node, the nodes are stored as parallel columns (arrays) indexed
+by an integer node id. The node ids are in post-order (children before parent), which is the
+order in which parse_tree returns them. As a result, the root is the last node, and the subtree
+of a node is the contiguous range of ids from its first descendant up to the node itself.
+
+The names are stored once each, in a single UTF-8 string table.
+
+A saved tree (see save, and ozb_file for the .ozb files) can be loaded with from_buffer over a
+memory mapped file, in which case the columns are views over the file rather than copies.
+
+For example:
+
+    tree = CompactTree.from_newick("(A_ott123,B:1.2)C_ott789:5.5;")
+    for node_id in tree.children(tree.root):
+        print(tree.name(node_id), tree.ott(node_id), tree.edge_length(node_id))
+'''
+
+import re
+import struct
+from array import array
+from bisect import bisect_left
+
+from oz_tree_build.newick.newick_parser import parse_tree
+
+__author__ = "David Ebbo"
+
+COMPACT_TREE_MAGIC = b'OZCT0002'
+header_struct = struct.Struct('<8sqqq')
+
+# The names that need to be quoted, for the parser to read them back
+unsafe_name_regex = re.compile(r"^'|[\s,;:()\[\]]")
+
+class CompactTree:
+    # The columns, in the order they are saved in
+    column_names = ('parents', 'starts', 'ends', 'full_name_starts', 'otts', 'edge_lengths', 'depths',
+                    'leaf_flags', 'name_ids', 'first_descendants', 'name_offsets')
+
+    def __init__(self):
+        # Per node columns, all indexed by node id
+        self.parents = array('q')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.full_name_starts = array('q')
+        self.otts = array('q')
+        self.edge_lengths = array('d')
+        self.depths = array('i')
+        self.leaf_flags = array('b')
+        self.name_ids = array('i')
+
+        # Id of the first node in the subtree of each node (the node itself for leaves)
+        self.first_descendants = array('q')
+
+        # The string table: name i is name_table[name_offsets[i]:name_offsets[i+1]]
+        self.name_table = bytearray()
+        self.name_offsets = array('q', [0])
+
+        # Sorted (ott, node id) columns for lookups by ott, built on first use
+        self._sorted_otts = None
+        self._sorted_ott_node_ids = None
+
+        # Name id of each name, and first node id for each name id, for lookups by name, built on first use
+        self._name_ids_by_name = None
+        self._first_node_ids = None
+
+    @classmethod
+    def from_newick(cls, newick_tree):
+        '''
+        Build the tree in one pass over parse_tree. The tree can be a string or a bytes-like object.
+        '''
+        tree = cls()
+
+        # Only needed while building, to deduplicate the names
+        name_ids = {}
+
+        # Nodes whose parent we haven't seen yet. Since nodes come in post-order, when we get
+        # to a node, its children are the pending nodes that are deeper than it.
+        pending_node_ids = []
+
+        for node_id, node in enumerate(parse_tree(newick_tree)):
+            taxon = node['taxon'] or ''
+            ott = node['ott']
+
+            # Keep non numeric otts as part of the name, so that we don't lose them
+            if ott is not None and not ott.isdigit():
+                taxon = f'{taxon}_ott{ott}'
+                ott = None
+
+            name_id = name_ids.get(taxon)
+            if name_id is None:
+                name_id = name_ids[taxon] = len(name_ids)
+                tree.name_table += taxon.encode('utf-8')
+                tree.name_offsets.append(len(tree.name_table))
+
+            depth = node['depth']
+            first_descendant = node_id
+            while pending_node_ids and tree.depths[pending_node_ids[-1]] > depth:
+                child_id = pending_node_ids.pop()
+                tree.parents[child_id] = node_id
+                first_descendant = tree.first_descendants[child_id]
+            pending_node_ids.append(node_id)
+
+            tree.parents.append(-1)
+            tree.starts.append(node['start'])
+            tree.ends.append(node['end'])
+            tree.full_name_starts.append(node['full_name_start_index'])
+            tree.otts.append(int(ott) if ott else -1)
+            tree.edge_lengths.append(node['edge_length'])
+            tree.depths.append(depth)
+            tree.leaf_flags.append(node['is_leaf'])
+            tree.name_ids.append(name_id)
+            tree.first_descendants.append(first_descendant)
+
+        return tree
+
+    def __len__(self):
+        return len(self.parents)
+
+    @property
+    def root(self):
+        return len(self.parents) - 1
+
+    def name(self, node_id):
+        name_id = self.name_ids[node_id]
+        return bytes(self.name_table[self.name_offsets[name_id]:self.name_offsets[name_id+1]]).decode('utf-8')
+
+    def ott(self, node_id):
+        '''The ott of the node as a string (like parse_tree returns), or None if it doesn't have one'''
+        ott = self.otts[node_id]
+        return str(ott) if ott >= 0 else None
+
+    def parent(self, node_id):
+        '''The id of the parent node, or -1 for the root'''
+        return self.parents[node_id]
+
+    def edge_length(self, node_id):
+        return self.edge_lengths[node_id]
+
+    def depth(self, node_id):
+        return self.depths[node_id]
+
+    def is_leaf(self, node_id):
+        return bool(self.leaf_flags[node_id])
+
+    def subtree_range(self, node_id):
+        '''The range of ids of all the nodes in the subtree, including the node itself'''
+        return range(self.first_descendants[node_id], node_id + 1)
+
+    def children(self, node_id):
+        '''
+        The ids of the node's children, in tree order. The last child is the node just before its
+        parent, and each child's subtree is just after its previous sibling's.
+        '''
+        children = []
+        first_descendant = self.first_descendants[node_id]
+        child_id = node_id - 1
+        while child_id >= first_descendant:
+            children.append(child_id)
+            child_id = self.first_descendants[child_id] - 1
+        children.reverse()
+        return children
+
+    def node(self, node_id):
+        '''
+        The node as a dictionary, with the same keys as the ones returned by parse_tree. Non numeric
+        otts are kept as part of the taxon name (e.g. 'A_ottX').
+        '''
+        return {'taxon': self.name(node_id), 'ott': self.ott(node_id), 'edge_length': self.edge_lengths[node_id],
+                'start': self.starts[node_id], 'end': self.ends[node_id], 'full_name_start_index': self.full_name_starts[node_id],
+                'depth': self.depths[node_id], 'is_leaf': self.is_leaf(node_id)}
+
+    def nodes(self):
+        '''All the nodes in post-order, like parse_tree returns them'''
+        return map(self.node, range(len(self)))
+
+    def find_ott(self, ott):
+        '''The id of the node with the given ott (int or string), or None if it's not in the tree'''
+        if self._sorted_otts is None:
+            node_ids = sorted(range(len(self.otts)), key=self.otts.__getitem__)
+            self._sorted_ott_node_ids = array('q', node_ids)
+            self._sorted_otts = array('q', (self.otts[node_id] for node_id in node_ids))
+
+        ott = int(ott)
+        index = bisect_left(self._sorted_otts, ott)
+        if index < len(self._sorted_otts) and self._sorted_otts[index] == ott:
+            return self._sorted_ott_node_ids[index]
+        return None
+
+    def find_name(self, name):
+        '''The id of the first node (in post-order) with the given name, or None if it's not in the tree'''
+        if self._name_ids_by_name is None:
+            self._name_ids_by_name = {bytes(self.name_table[start:end]).decode('utf-8'): name_id for name_id, (start, end)
+                                      in enumerate(zip(self.name_offsets, self.name_offsets[1:]))}
+            self._first_node_ids = array('q', [-1]) * (len(self.name_offsets) - 1)
+            for node_id in reversed(range(len(self.name_ids))):
+                self._first_node_ids[self.name_ids[node_id]] = node_id
+
+        name_id = self._name_ids_by_name.get(name)
+        if not name or name_id is None:
+            return None
+        return self._first_node_ids[name_id]
+
+    def save(self, f):
+        '''Write the tree to a file opened in binary mode, so that it can be loaded without parsing it again'''
+        f.write(header_struct.pack(COMPACT_TREE_MAGIC, len(self), len(self.name_offsets), len(self.name_table)))
+        for column_name in self.column_names:
+            getattr(self, column_name).tofile(f)
+        f.write(self.name_table)
+
+    @classmethod
+    def load(cls, f):
+        '''Read a tree written by save from a file opened in binary mode'''
+        magic, node_count, name_offset_count, name_table_size = header_struct.unpack(f.read(header_struct.size))
+        if magic != COMPACT_TREE_MAGIC:
+            raise ValueError(f"{getattr(f, 'name', 'The file')} is not a saved CompactTree")
+
+        tree = cls()
+        for column_name in cls.column_names:
+            column = array(getattr(tree, column_name).typecode)
+            column.fromfile(f, name_offset_count if column_name == 'name_offsets' else node_count)
+            setattr(tree, column_name, column)
+        tree.name_table = bytearray(f.read(name_table_size))
+        return tree
+
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
+        '''
+        Same as load, but for a tree saved at the offset of a buffer (e.g. a memory mapped file).
+        The columns are read-only views over the buffer, so nothing is copied.
+        '''
+        view = memoryview(buffer)
+        magic, node_count, name_offset_count, name_table_size = header_struct.unpack_from(view, offset)
+        if magic != COMPACT_TREE_MAGIC:
+            raise ValueError("The buffer doesn't contain a saved CompactTree")
+        offset += header_struct.size
+
+        tree = cls()
+        for column_name in cls.column_names:
+            typecode = getattr(tree, column_name).typecode
+            size = (name_offset_count if column_name == 'name_offsets' else node_count) * array(typecode).itemsize
+            setattr(tree, column_name, view[offset:offset + size].cast(typecode))
+            offset += size
+        tree.name_table = view[offset:offset + name_table_size]
+        return tree
+
+    def write_newick(self, output_stream):
+        '''
+        Write the tree in newick form to a text stream. Names that the parser can't read unquoted
+        are quoted, and the zero edge lengths (which parse_tree returns for missing ones) are left out.
+        '''
+        # The open braces before each leaf, one for each node it's the first descendant of
+        open_brace_counts = array('i', [0]) * len(self)
+        for node_id in range(len(self)):
+            if not self.leaf_flags[node_id]:
+                open_brace_counts[self.first_descendants[node_id]] += 1
+
+        pieces = []
+        for node_id in range(len(self)):
+            if self.leaf_flags[node_id]:
+                pieces.append('(' * open_brace_counts[node_id])
+            else:
+                pieces.append(')')
+
+            full_name = self.name(node_id)
+            if self.otts[node_id] >= 0:
+                full_name += f'_ott{self.otts[node_id]}'
+            pieces.append(f"'{full_name}'" if unsafe_name_regex.search(full_name) else full_name)
+            if self.edge_lengths[node_id]:
+                pieces.append(f':{self.edge_lengths[node_id]!r}')
+
+            # The last child of a node is just before it, and is followed by the node's closing brace
+            parent = self.parents[node_id]
+            if parent >= 0 and parent != node_id + 1:
+                pieces.append(',')
+
+            if len(pieces) > 10000:
+                output_stream.write(''.join(pieces))
+                pieces.clear()
+
+        pieces.append(';')
+        output_stream.write(''.join(pieces))
+
+    def nbytes(self):
+        '''The number of bytes used by the columns and the string table'''
+        columns = [getattr(self, column_name) for column_name in self.column_names]
+        return sum(column.itemsize * len(column) for column in columns) + len(self.name_table)
+
+    def to_numpy(self):
+        '''
+        Return the columns as a dictionary of NumPy arrays, for vectorized analysis.
+        The arrays share memory with the tree's columns, so no data is copied.
+        '''
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("NumPy is needed to export a CompactTree to NumPy arrays")
+
+        return {
+            'parent': np.frombuffer(self.parents, dtype=np.int64),
+            'start': np.frombuffer(self.starts, dtype=np.int64),
+            'end': np.frombuffer(self.ends, dtype=np.int64),
+            'full_name_start': np.frombuffer(self.full_name_starts, dtype=np.int64),
+            'ott': np.frombuffer(self.otts, dtype=np.int64),
+            'edge_length': np.frombuffer(self.edge_lengths, dtype=np.float64),
+            'depth': np.frombuffer(self.depths, dtype=np.int32),
+            'is_leaf': np.frombuffer(self.leaf_flags, dtype=np.bool_),
+            'name_id': np.frombuffer(self.name_ids, dtype=np.int32),
+            'first_descendant': np.frombuffer(self.first_descendants, dtype=np.int64),
+        }
@@ -1,94 +1,180 @@
 '''
-Extract a minimal tree that includes a set of taxa
+Extract a minimal tree that includes a set of taxa, or the minimal trees for several sets of taxa
+in a single pass over the tree
 '''
 
 import argparse
 import logging
 import sys
-from typing import Set
+from typing import Dict, Set
 
-from oz_tree_build.newick.newick_parser import parse_tree
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+from oz_tree_build.newick.taxon_catalog import load_catalog_for_tree_stream, resolve_taxa
+from oz_tree_build.utilities.metrics import Metrics
 
 __author__ = "David Ebbo"
 
-def extract_minimal_tree(newick_tree, target_taxa: Set[str]):
-    # We build the node list as we find them and process them
-    node_list = []
-
-    # Clone the taxa set so we don't modify the original
-    target_taxa = set(target_taxa)
-
+def extract_minimal_tree(newick_tree, target_taxa: Set[str], metrics=None):
+    trees, missing_taxa = find_minimal_trees(newick_tree, {None: target_taxa}, metrics)
+
+    if missing_taxa:
+        logging.warning(f'Could not find the following taxa: {", ".join(missing_taxa[None])}')
+
+    return trees[None]
+
+def extract_minimal_trees(newick_tree, taxa_sets: Dict[str, Set[str]], metrics=None):
+    '''
+    Extract the minimal trees for several sets of taxa (indexed by name) in a single pass over the tree.
+    Returns a dictionary with the tree for each set, or None if none of its taxa were found. If a
+    Metrics object (see metrics) is passed, it gets the number of nodes parsed and bytes scanned.
+    '''
+    trees, missing_taxa = find_minimal_trees(newick_tree, taxa_sets, metrics)
+
+    for name, taxa in missing_taxa.items():
+        logging.warning(f'Could not find the following taxa for {name}: {", ".join(taxa)}')
+
+    return trees
+
+def find_minimal_trees(newick_tree, taxa_sets, metrics=None):
+    '''
+    Returns the minimal tree for each set of taxa, and the taxa that were not found for each set
+    '''
+    # The tree can be a string, or a bytes-like object (e.g. an mmap), in which case we return bytes
+    if isinstance(newick_tree, str):
+        substring = lambda start, end: newick_tree[start:end]
+        open_brace, closed_brace, comma = '(', ')', ','
+    else:
+        substring = lambda start, end: bytes(newick_tree[start:end])
+        open_brace, closed_brace, comma = b'(', b')', b','
+
+    # Clone the taxa sets so we don't modify the originals
+    target_taxa = {name: set(taxa) for name, taxa in taxa_sets.items()}
+
+    # The names of the sets each taxon is in, so we only look at the sets that a node is in
+    sets_by_taxon = {}
+    for name, taxa in target_taxa.items():
+        for taxon in taxa:
+            sets_by_taxon.setdefault(taxon, []).append(name)
+
+    # For each set, the stack of the subtrees found so far whose parent we haven't reached yet,
+    # with their depths. Since we get the nodes in post-order, the children of a node are
+    # always at the top of the stack, one level deeper than the node.
+    subtree_stacks = {name: [] for name in target_taxa}
+    depth_stacks = {name: [] for name in target_taxa}
+
+    # The names of the sets with subtrees at the top of their stack at each depth. When we get to a
+    # node, only the sets with subtrees one level deeper have children to process.
+    sets_by_depth = {}
+
+    trees = {name: None for name in target_taxa if not target_taxa[name]}
+    node_count = 0
+    node = None
     for node in parse_tree(newick_tree):
+        node_count += 1
+        if len(trees) == len(target_taxa):
+            break
+
         taxon = node['taxon']
         ott = node['ott']
-        node_start_index = node['start']
-        node_end_index = node['end']
-
-        # This is a bit hacky. Ideally, the parser would give us the child count
-        is_parent_node = newick_tree[node_start_index] == '('
-
-        if taxon in target_taxa or ott in target_taxa:
-            # We've found a target taxon, so remove it from the target list
-            target_taxa.remove(taxon if taxon in target_taxa else ott)
-            found_target_taxon = True
-        else:
-            found_target_taxon = False
-
-        # If this taxon is in the target list, add it to the nodes list
-        if found_target_taxon or is_parent_node:
-            # Any node with higher depth must be a child of this one
-            # But ignore the whole child logic if we're separating trees
-            children = [n for n in node_list if n["depth"] > node["depth"]]
-
-            # Assert that all the children have depth 1 less than this node. This is
-            # because any deeper nodes would have been bubbled up 
-            assert all([child_node["depth"] == node['depth'] + 1 for child_node in children])
-
-            # Reduce the depth of the children to bubble them up
-            for child_node in children:
-                child_node["depth"] -= 1
-
-            # If we found a taxon, or there are multiple children, we need to add a node to the list
-            if found_target_taxon or len(children) > 1:
-                # Remove the children from the search list
-                node_list = [n for n in node_list if n not in children]
-
+        depth = node['depth']
+
+        found_sets = sets_by_taxon.get(taxon, [])
+        if ott in sets_by_taxon:
+            found_sets = found_sets + sets_by_taxon[ott]
+        child_sets = sets_by_depth.pop(depth + 1, None)
+        if not found_sets and not child_sets:
+            continue
+
+        for name in child_sets.union(found_sets) if child_sets else set(found_sets):
+            if name in trees:
+                continue
+
+            taxa = target_taxa[name]
+            if taxon in taxa or ott in taxa:
+                # We've found a target taxon, so remove it from the target list
+                taxa.remove(taxon if taxon in taxa else ott)
+                found_target_taxon = True
+            else:
+                found_target_taxon = False
+
+            # Any subtree deeper than this node must be a child of it
+            subtrees, depths = subtree_stacks[name], depth_stacks[name]
+            child_count = 0
+            while depths and depths[-1] > depth:
+                # All the children have a depth 1 more than this node, since any deeper subtrees
+                # would have been bubbled up
+                assert depths[-1] == depth + 1
+                child_count += 1
+                depths.pop()
+
+            # If we found a taxon, or there are multiple children, we need a new subtree
+            if found_target_taxon or child_count > 1:
                 # Full name including the edge length
-                tree_string = newick_tree[node['full_name_start_index']:node_end_index]
-                if children:
+                tree_string = substring(node['full_name_start_index'], node['end'])
+                if child_count:
                     # Add the children to the tree string
-                    tree_string = f"({','.join([child_node['tree_string'] for child_node in children])}){tree_string}"
-
-                node_list.append({"name": taxon, "ott": ott, "tree_string": tree_string, "depth": node["depth"]})
-
-        # If we've found all the target taxa, we're done
-        if not target_taxa and len(node_list) <= 1:
-            break
-
-    if target_taxa:
-        logging.warning(f'Could not find the following taxa: {", ".join(target_taxa)}')
-
-    # Return the tree, if any
-    assert len(node_list) <= 1
-    return node_list[0]['tree_string'] if len(node_list) > 0 else None
+                    children = subtrees[-child_count:]
+                    del subtrees[-child_count:]
+                    tree_string = open_brace + comma.join(children) + closed_brace + tree_string
+                subtrees.append(tree_string)
+
+            # Otherwise, the single child (if any) bubbles up to this node's depth
+            if found_target_taxon or child_count:
+                depths.append(depth)
+                sets_by_depth.setdefault(depth, set()).add(name)
+
+            # If we've found all the target taxa, this set is done
+            if not taxa and len(subtrees) <= 1:
+                trees[name] = subtrees[0] if subtrees else None
+
+    if metrics:
+        # The tree is scanned up to the end of the last node we parsed
+        metrics.count('nodes parsed', node_count)
+        metrics.count('bytes scanned' if not isinstance(newick_tree, str) else 'characters scanned', node['end'] if node else 0)
+
+    missing_taxa = {}
+    for name, taxa in target_taxa.items():
+        if taxa:
+            missing_taxa[name] = taxa
+        if name not in trees:
+            # Return the tree, if any
+            assert len(subtree_stacks[name]) <= 1
+            trees[name] = subtree_stacks[name][0] if subtree_stacks[name] else None
+
+    return trees, missing_taxa
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('treefile', type=argparse.FileType('r'), nargs='?', default=sys.stdin, help='The tree file in newick form')
+    parser.add_argument('treefile', type=argparse.FileType('rb'), nargs='?', default=sys.stdin, help='The tree file in newick form')
     parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='The output tree file')
     parser.add_argument('--taxa', '-t', nargs='+', required=True, help='the taxa to search for')
+    parser.add_argument('--catalog', help='a taxon catalog of the tree (see taxon_catalog), to resolve the taxa through')
+    parser.add_argument('--metrics', help='a JSON file in which to save the time spent in each phase, and other metrics of the run')
     args = parser.parse_args()
 
     target_taxa = set(args.taxa)
-
-    # Read the whole file as a string. This is not ideal, but it's still
-    # very fast even with the full OpenTree tree.
-    # This could be optimized to read by chunks, with more complexity
-    tree = args.treefile.read()
-
-    result = extract_minimal_tree(tree, target_taxa)
-    if result:
-        args.outfile.write(result + ';\n')
+    catalog = load_catalog_for_tree_stream(args.treefile, args.catalog) if args.catalog else None
+    if catalog:
+        with catalog:
+            target_taxa = resolve_taxa(catalog, target_taxa)
+
+    metrics = Metrics()
+    with metrics.timed('read'):
+        # Memory map the file, so the OS pages it in as needed rather than us reading it all into memory
+        tree = map_tree_file(args.treefile, random_access=True)
+
+    with metrics.timed('extract'):
+        result = extract_minimal_tree(tree, target_taxa, metrics)
+
+    with metrics.timed('write'):
+        if result:
+            if not isinstance(result, str):
+                result = result.decode('utf-8')
+            args.outfile.write(result + ';\n')
+            metrics.count('characters written', len(result) + 2)
+
+    if args.metrics:
+        metrics.save(args.metrics)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
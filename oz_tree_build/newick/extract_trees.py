@@ -6,6 +6,15 @@ Extract one or more subtrees from a Newick tree, including support for excluded
 Everything is processed in a single pass over the tree string, using the newick_parser module.
 As we walk through the nodes, we process both the target taxa and the excluded taxa.
 
+With more than one worker, the tree is split into chunks (see split_tree) that are scanned
+in parallel, and the nodes they find are merged to give the same output as the single pass.
+
+If the tree file has been indexed with index_open_tree, the nodes are looked up in the index
+instead, and only the parts of the file making up the subtrees are read.
+
+The tree file can be compressed with gzip, bzip2 or xz (see compressed_files). It's then decompressed
+into memory, except for a gzip file with a seek index, which the index can be used with.
+
 From the command line, run for example:
 python3 extract_trees.py tree.tre -t Tupaia Camelidae
 '''
@@ -13,103 +22,549 @@ python3 extract_trees.py tree.tre -t Tupaia Camelidae
 
 import argparse
 import logging
+import multiprocessing
+import os
 import sys
+from bisect import bisect_left, bisect_right
 from typing import Set
 
-from oz_tree_build.newick.newick_parser import parse_tree
+from oz_tree_build.newick.index_open_tree import OpenTreeIndex
+from oz_tree_build.newick.newick_parser import DEFAULT_CHUNK_SIZE, is_tree_stream, map_tree_file, parse_stream, parse_tree
+from oz_tree_build.newick.split_tree import TreeChunk, match_chunk_braces, split_tree
+from oz_tree_build.newick.taxon_catalog import load_catalog_for_tree_stream, resolve_taxa
+from oz_tree_build.utilities.compressed_files import is_compressed_stream, open_tree_file
+from oz_tree_build.utilities.metrics import Metrics
 
 __author__ = "David Ebbo"
 
-def extract_trees(newick_tree, target_taxa: Set[str], excluded_taxa: Set[str] = {}):
-    # We build the subtrees and exclusion lists as we find them and process them
-    subtrees = []
-    excluded_ranges = []
+def get_excluded_range(substring, comma, node_start_index, node_end_index):
+    '''
+    Get the range of the tree string to remove when excluding a node
+    '''
+    # Use different logic depending on comma position
+    if substring(node_start_index-1, node_start_index) == comma:
+        # Exclude the comma before the excluded taxon. e.g. (A,B,REMOVE_ME) --> (A,B)
+        return (node_start_index-1, node_end_index)
+    elif substring(node_end_index, node_end_index+1) == comma:
+        # Exclude the comma after the excluded taxon. e.g. (REMOVE_ME,B,C) --> (B,C)
+        return (node_start_index, node_end_index+1)
+    else:
+        # Otherwise just exclude the taxon, e.g. (REMOVE_ME) --> ()
+        # This can lead to empty brackets, but that's harmless enough
+        return (node_start_index, node_end_index)
+
+class ExcludedRanges:
+    '''
+    The ranges to remove for the excluded nodes found so far. The nodes must be added in post-order
+    (the order parse_tree returns them in), which keeps the ranges sorted by start index, and means
+    that the ranges already added after the start of a new one are all nested inside it.
+    '''
+    def __init__(self):
+        self.starts = []
+        self.ranges = []
+        self.taxa = []
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def add(self, excluded_range, taxa=()):
+        # Drop the ranges of the excluded descendants, since this one covers them
+        index = bisect_left(self.starts, excluded_range[0])
+        del self.starts[index:]
+        del self.ranges[index:]
+        del self.taxa[index:]
+        self.starts.append(excluded_range[0])
+        self.ranges.append(excluded_range)
+        self.taxa.append(taxa)
+
+    def inside(self, node_start_index, node_end_index):
+        '''The ranges starting strictly inside the node, sorted by start index'''
+        return self.ranges[bisect_right(self.starts, node_start_index):bisect_left(self.starts, node_end_index)]
+
+    def taxa_inside(self, node_start_index, node_end_index):
+        '''The excluded taxa (as given to add) whose ranges start strictly inside the node'''
+        taxa = self.taxa[bisect_right(self.starts, node_start_index):bisect_left(self.starts, node_end_index)]
+        return {taxon for node_taxa in taxa for taxon in node_taxa}
+
+def extract_subtree(substring, open_brace, comma, node_start_index, node_end_index, excluded_ranges):
+    '''
+    Extract the subtree for a node, skipping over the excluded ranges (sorted by start index)
+    '''
+    tree_string = substring(node_start_index, node_start_index)
+
+    def string_to_append(start, end):
+        # Fix up situation that would end up generating "(,"
+        if tree_string[-1:] == open_brace and substring(start, start+1) == comma:
+            start += 1
+        return substring(start, end)
+
+    prev_range = (node_start_index, node_start_index)
+    for range in excluded_ranges:
+        # Only process ranges that are strictly inside the current taxon
+        if range[0] > node_start_index and range[0] < node_end_index and range[1] > prev_range[1]:
+            tree_string += string_to_append(prev_range[1], range[0])
+            prev_range = range
+    tree_string += string_to_append(prev_range[1], node_end_index)
+
+    return tree_string
+
+def extract_trees(newick_tree, target_taxa: Set[str], excluded_taxa: Set[str] = {}, workers=1, applied_exclusions=None,
+                  metrics=None):
+    '''
+    Extract the subtrees of the target taxa, without the subtrees of the excluded taxa. If a dictionary
+    is passed as applied_exclusions, it gets the excluded taxa that were cut out of each subtree. If a
+    Metrics object (see metrics) is passed, it gets the number of nodes parsed and bytes scanned.
+    '''
+    return get_subtrees_by_name(generate_subtrees(newick_tree, target_taxa, excluded_taxa, workers, metrics), applied_exclusions)
+
+def generate_subtrees(newick_tree, target_taxa: Set[str], excluded_taxa: Set[str] = {}, workers=1, metrics=None):
+    '''
+    Same as extract_trees, but yields each subtree as soon as it's found, as a dictionary with its name,
+    ott, tree_string and excluded_taxa (the excluded taxa that were cut out of it).
+    '''
+    if is_tree_stream(newick_tree):
+        yield from generate_subtrees_from_stream(newick_tree, target_taxa, excluded_taxa, metrics)
+        return
+
+    if workers > 1:
+        yield from generate_subtrees_in_parallel(newick_tree, target_taxa, excluded_taxa, workers, metrics)
+        return
+
+    # The tree can be a string, or a bytes-like object (e.g. an mmap), in which case we return bytes
+    if isinstance(newick_tree, str):
+        substring = lambda start, end: newick_tree[start:end]
+        open_brace, comma = '(', ','
+    else:
+        substring = lambda start, end: bytes(newick_tree[start:end])
+        open_brace, comma = b'(', b','
+
+    # We build the exclusion list as we find the excluded nodes
+    excluded_ranges = ExcludedRanges()
 
     # Clone the taxa set so we don't modify the original
     target_taxa = set(target_taxa)
 
-    for node in parse_tree(newick_tree):
-        taxon = node['taxon']
-        ott = node['ott']
-        node_start_index = node['start']
-        node_end_index = node['end']
+    node_count = node_end_index = 0
 
-        # If this taxon or ott is in the excluded list, add it to the excluded ranges
-        if taxon in excluded_taxa or ott in excluded_taxa:
-            # Use different logic depending on comma position
-            if newick_tree[node_start_index-1] == ',':
-                # Exclude the comma before the excluded taxon. e.g. (A,B,REMOVE_ME) --> (A,B)
-                excluded_range = (node_start_index-1, node_end_index)
-            elif newick_tree[node_end_index] == ',':
-                # Exclude the comma after the excluded taxon. e.g. (REMOVE_ME,B,C) --> (B,C)
-                excluded_range = (node_start_index, node_end_index+1)
-            else:
-                # Otherwise just exclude the taxon, e.g. (REMOVE_ME) --> ()
-                # This can lead to empty brackets, but that's harmless enough
-                excluded_range = (node_start_index, node_end_index)
-            excluded_ranges.append(excluded_range)
-            # Sort the excluded ranges by start index. Not efficient, but not on critical path
-            excluded_ranges.sort(key=lambda x: x[0])
+    # Only decode the fields we need: the edge lengths are never converted
+    for taxon, ott, node_start_index, node_end_index in parse_tree(newick_tree, fields=('taxon', 'ott', 'start', 'end')):
+        node_count += 1
 
         # If this taxon or ott is in the target list, add it to the nodes list
         if taxon in target_taxa or ott in target_taxa:
             # First, remove it from the target list
             target_taxa.remove(taxon if taxon in target_taxa else ott)
 
-            tree_string = ""
-
-            def string_to_append(start, end):
-                # Fix up situation that would end up generating "(,"
-                if tree_string and tree_string[-1] == '(' and newick_tree[start] == ',':
-                    start += 1
-                return newick_tree[start:end]
+            tree_string = extract_subtree(substring, open_brace, comma, node_start_index, node_end_index,
+                                          excluded_ranges.inside(node_start_index, node_end_index))
 
-            # Extract the subtree for this node, skipping over excluded ranges
-            prev_range = (node_start_index, node_start_index)
-            for range in excluded_ranges:
-                # Only process ranges that are strictly inside the current taxon
-                if range[0] > node_start_index and range[0] < node_end_index and range[1] > prev_range[1]:
-                    tree_string += string_to_append(prev_range[1], range[0])
-                    prev_range = range
-            tree_string += string_to_append(prev_range[1], node_end_index)
+            yield {"name": taxon, "ott": ott, "tree_string": tree_string,
+                   "excluded_taxa": excluded_ranges.taxa_inside(node_start_index, node_end_index)}
 
-            subtrees.append({"name": taxon, "ott": ott, "tree_string": tree_string})
+        # If this taxon or ott is in the excluded list, add it to the excluded ranges. This is done after
+        # extracting it if it's also a target, since its own range doesn't apply to itself, but would
+        # replace the ranges of its excluded descendants.
+        if taxon in excluded_taxa or ott in excluded_taxa:
+            excluded_ranges.add(get_excluded_range(substring, comma, node_start_index, node_end_index),
+                                [name for name in (taxon, ott) if name in excluded_taxa])
 
         # If we've found all the target taxa, we're done
         if not target_taxa:
             break
 
+    if metrics:
+        # The tree is scanned up to the end of the last node we parsed
+        metrics.count('nodes parsed', node_count)
+        metrics.count('bytes scanned' if not isinstance(newick_tree, str) else 'characters scanned', node_end_index)
+
+    if target_taxa:
+        logging.warning(f'Could not find the following taxa: {", ".join(target_taxa)}')
+
+class ForwardReader:
+    '''
+    Read parts of a stream that's read forward (e.g. a compressed file), keeping what was read since the
+    offset passed to keep_from, so that the parts after it can be read in any order
+    '''
+    def __init__(self, stream, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.buffer_start = 0
+
+    def keep_from(self, offset):
+        '''Drop what was read before the offset, skipping what's left before it'''
+        buffer_end = self.buffer_start + len(self.buffer)
+        if offset < buffer_end:
+            del self.buffer[:offset - self.buffer_start]
+        else:
+            self.buffer.clear()
+            while buffer_end < offset:
+                data = self.stream.read(min(offset - buffer_end, self.chunk_size))
+                if not data:
+                    break
+                buffer_end += len(data)
+        self.buffer_start = offset
+
+    def substring(self, start, end):
+        if start < self.buffer_start:
+            raise ValueError(f"Offset {start} was already dropped from the stream buffer")
+        while self.buffer_start + len(self.buffer) < end:
+            data = self.stream.read(self.chunk_size)
+            if not data:
+                break
+            self.buffer += data
+        return bytes(self.buffer[start - self.buffer_start:end - self.buffer_start])
+
+def generate_subtrees_from_stream(tree_stream, target_taxa: Set[str], excluded_taxa: Set[str] = {}, metrics=None,
+                                  chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Same as generate_subtrees, for a binary stream that can't be memory mapped, e.g. a compressed file,
+    without reading it all into memory. The stream is read twice, so it needs to be seekable (for
+    a compressed file, seeking back to the start decompresses it again). The first pass parses it to
+    find the target and excluded nodes, and the second one only keeps the text of the subtrees to extract.
+    '''
+    if not tree_stream.seekable():
+        logging.warning("Reading the tree into memory, since the stream can't be read twice")
+        yield from generate_subtrees(tree_stream.read(), target_taxa, excluded_taxa, metrics=metrics)
+        return
+
+    # Clone the taxa set so we don't modify the original
+    target_taxa = set(target_taxa)
+
+    # The target and excluded nodes, in post-order, with the names they're a target or excluded for
+    nodes = []
+    node_count = node_end_index = 0
+    fields = ('taxon', 'ott', 'start', 'end')
+    for taxon, ott, node_start_index, node_end_index in parse_stream(tree_stream, chunk_size, fields):
+        node_count += 1
+        target = taxon if taxon in target_taxa else ott if ott in target_taxa else None
+        excluded = [name for name in (taxon, ott) if name in excluded_taxa]
+        if target:
+            target_taxa.remove(target)
+        if target or excluded:
+            nodes.append((taxon, ott, node_start_index, node_end_index, target, excluded))
+        if not target_taxa:
+            break
+
+    if metrics:
+        # The tree is scanned up to the end of the last node we parsed
+        metrics.count('nodes parsed', node_count)
+        metrics.count('bytes scanned', node_end_index)
+
     if target_taxa:
         logging.warning(f'Could not find the following taxa: {", ".join(target_taxa)}')
 
-    # Return a dictionary of subtrees, indexed by ott or name
+    # Only the text of the outermost targets is read, and the excluded nodes outside of them don't
+    # matter, since they can't be cut out of any target
+    outer_ranges = []
+    for _, _, node_start_index, node_end_index, target, _ in sorted(nodes, key=lambda node: node[2]):
+        if target and (not outer_ranges or node_start_index >= outer_ranges[-1][1]):
+            outer_ranges.append((node_start_index, node_end_index))
+    outer_range_starts = [start for start, end in outer_ranges]
+
+    tree_stream.seek(0)
+    reader = ForwardReader(tree_stream, chunk_size)
+    excluded_ranges = ExcludedRanges()
+    current_range = None
+    for taxon, ott, node_start_index, node_end_index, target, excluded in nodes:
+        range_index = bisect_right(outer_range_starts, node_start_index) - 1
+        if range_index < 0 or node_end_index > outer_ranges[range_index][1]:
+            continue
+
+        # The nodes are in post-order, so the ranges are reached in order
+        if current_range != range_index:
+            current_range = range_index
+            reader.keep_from(outer_ranges[range_index][0])
+
+        if target:
+            tree_string = extract_subtree(reader.substring, b'(', b',', node_start_index, node_end_index,
+                                          excluded_ranges.inside(node_start_index, node_end_index))
+            yield {"name": taxon, "ott": ott, "tree_string": tree_string,
+                   "excluded_taxa": excluded_ranges.taxa_inside(node_start_index, node_end_index)}
+
+        # An excluded node only matters if it's strictly inside a target, where the commas around it are
+        start, end = outer_ranges[range_index]
+        if excluded and start < node_start_index and node_end_index < end:
+            excluded_ranges.add(get_excluded_range(reader.substring, b',', node_start_index, node_end_index), excluded)
+
+def get_subtrees_by_name(subtrees, applied_exclusions=None):
+    '''
+    Return a dictionary of subtrees, indexed by ott or name, and fill in the applied exclusions if needed
+    '''
+    subtrees = list(subtrees)
+    if applied_exclusions is not None:
+        applied_exclusions.update({subtree['ott'] or subtree['name']: subtree['excluded_taxa'] for subtree in subtrees})
     return {subtree['ott'] or subtree['name']: subtree['tree_string'] for subtree in subtrees}
 
+def get_taxon_and_ott(full_name):
+    '''
+    Get the taxon and ott from a node's full name (str or bytes), e.g. b"'Foo_ott123':1.5"
+    '''
+    quote, colon = ("'", ':') if isinstance(full_name, str) else (b"'", b':')
+    if full_name[:1] == quote:
+        taxon = full_name[1:full_name.index(quote, 1)]
+    else:
+        taxon = full_name.split(colon)[0]
+    if not isinstance(taxon, str):
+        taxon = taxon.decode('utf-8')
+
+    if '_ott' in taxon:
+        ott_index = taxon.index('_ott')
+        return taxon[:ott_index], taxon[ott_index+4:]
+    return taxon, None
+
+# The state shared with the worker processes. They're forked, so they get the tree without copying it.
+parallel_state = {}
+
+def find_nodes_in_chunk(chunk_range):
+    '''
+    Worker for extract_trees_in_parallel: find the target and excluded nodes in a chunk returned by split_tree.
+    '''
+    newick_tree, target_taxa, excluded_taxa = parallel_state['args']
+    chunk = TreeChunk(newick_tree, *chunk_range)
+
+    nodes = []
+    node_count = 0
+    unmatched_close_index = 0
+    for taxon, ott, start, end in chunk.parse(fields=('taxon', 'ott', 'start', 'end')):
+        node_count += 1
+        is_target = taxon in target_taxa or ott in target_taxa
+        is_excluded = taxon in excluded_taxa or ott in excluded_taxa
+
+        if is_target or is_excluded:
+            # If the node's start is in an earlier chunk, record which unmatched brace it is instead
+            nodes.append({"name": taxon, "ott": ott, "start": start if start is not None else -1 - unmatched_close_index,
+                          "end": end, "is_target": is_target, "is_excluded": is_excluded})
+
+        if start is None:
+            unmatched_close_index += 1
+
+    return nodes, chunk.unmatched_braces, node_count
+
+def extract_trees_in_parallel(newick_tree, target_taxa: Set[str], excluded_taxa: Set[str], workers, applied_exclusions=None):
+    '''
+    Same as extract_trees, but splits the tree into chunks that are scanned in a pool of worker
+    processes. The nodes they find are then processed in order, like extract_trees does.
+    '''
+    return get_subtrees_by_name(generate_subtrees_in_parallel(newick_tree, target_taxa, excluded_taxa, workers), applied_exclusions)
+
+def generate_subtrees_in_parallel(newick_tree, target_taxa: Set[str], excluded_taxa: Set[str], workers, metrics=None):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning("Can't fork worker processes on this platform, so extracting trees serially")
+        yield from generate_subtrees(newick_tree, target_taxa, excluded_taxa, metrics=metrics)
+        return
+
+    if isinstance(newick_tree, str):
+        substring = lambda start, end: newick_tree[start:end]
+        open_brace, comma = '(', ','
+    else:
+        substring = lambda start, end: bytes(newick_tree[start:end])
+        open_brace, comma = b'(', b','
+
+    # Use a few chunks per worker, so that the work stays balanced if some are slower
+    chunk_ranges = split_tree(newick_tree, workers * 4)
+
+    parallel_state['args'] = (newick_tree, target_taxa, excluded_taxa)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            chunk_results = pool.map(find_nodes_in_chunk, chunk_ranges)
+    finally:
+        parallel_state.clear()
+
+    if metrics:
+        # The workers parse the whole tree
+        metrics.count('nodes parsed', sum(node_count for _, _, node_count in chunk_results))
+        metrics.count('bytes scanned' if not isinstance(newick_tree, str) else 'characters scanned', len(newick_tree))
+
+    # Fill in the starts of the nodes whose open brace was in an earlier chunk
+    found_nodes = []
+    unmatched_braces = [unmatched_braces for nodes, unmatched_braces, _ in chunk_results]
+    for (nodes, _, _), (depth_at_start, starts) in zip(chunk_results, match_chunk_braces(unmatched_braces)):
+        for node in nodes:
+            if node['start'] < 0:
+                node['start'] = starts[-1 - node['start']]
+        found_nodes += nodes
+
+    # The nodes are now in post-order, like in extract_trees, so we process them in the same way
+    excluded_ranges = ExcludedRanges()
+    target_taxa = set(target_taxa)
+    for node in found_nodes:
+        taxon = node['name']
+        ott = node['ott']
+
+        if node['is_target'] and (taxon in target_taxa or ott in target_taxa):
+            target_taxa.remove(taxon if taxon in target_taxa else ott)
+            tree_string = extract_subtree(substring, open_brace, comma, node['start'], node['end'],
+                                          excluded_ranges.inside(node['start'], node['end']))
+            yield {"name": taxon, "ott": ott, "tree_string": tree_string,
+                   "excluded_taxa": excluded_ranges.taxa_inside(node['start'], node['end'])}
+
+        if node['is_excluded']:
+            excluded_ranges.add(get_excluded_range(substring, comma, node['start'], node['end']),
+                                [name for name in (taxon, ott) if name in excluded_taxa])
+
+        if not target_taxa:
+            break
+
+    if target_taxa:
+        logging.warning(f'Could not find the following taxa: {", ".join(target_taxa)}')
+
+def extract_trees_with_index(tree_stream, index, target_taxa: Set[str], excluded_taxa: Set[str] = {}, applied_exclusions=None):
+    '''
+    Same as extract_trees, but uses an OpenTreeIndex to find the nodes, and only reads the parts
+    of the tree file (opened in binary mode) that are needed. The subtrees are returned as bytes.
+    '''
+    return get_subtrees_by_name(generate_subtrees_with_index(tree_stream, index, target_taxa, excluded_taxa), applied_exclusions)
+
+def generate_subtrees_with_index(tree_stream, index, target_taxa: Set[str], excluded_taxa: Set[str] = {}, metrics=None):
+    def substring(start, end):
+        if start < 0:
+            return b''
+        tree_stream.seek(start)
+        if metrics:
+            metrics.count('bytes read', end - start)
+        return tree_stream.read(end - start)
+
+    # Clone the taxa set so we don't modify the original
+    target_taxa = set(target_taxa)
+
+    # Go through the matching nodes in post-order, which is the order extract_trees finds them in
+    subtrees = []
+    candidate_node_ids = sorted({node_id for taxon in target_taxa for node_id in index.find(taxon)})
+    if metrics:
+        metrics.count('index lookups', len(target_taxa) + len(excluded_taxa))
+    for node_id in candidate_node_ids:
+        node_start_index, node_end_index, full_name_start_index = index.get_node_offsets(node_id)
+        taxon, ott = get_taxon_and_ott(substring(full_name_start_index, node_end_index))
+        if taxon in target_taxa or ott in target_taxa:
+            target_taxa.remove(taxon if taxon in target_taxa else ott)
+            subtrees.append({"name": taxon, "ott": ott, "node_id": node_id, "start": node_start_index, "end": node_end_index})
+
+    if target_taxa:
+        logging.warning(f'Could not find the following taxa: {", ".join(target_taxa)}')
+
+    # Go through the targets and the excluded nodes together in post-order, like extract_trees does,
+    # extracting a target before adding its own exclusion
+    excluded_taxa_by_node_id = {}
+    for taxon in excluded_taxa:
+        for node_id in index.find(taxon):
+            excluded_taxa_by_node_id.setdefault(node_id, []).append(taxon)
+    events = sorted([(subtree['node_id'], 0, subtree) for subtree in subtrees] +
+                    [(node_id, 1, None) for node_id in excluded_taxa_by_node_id], key=lambda event: event[:2])
+
+    excluded_ranges = ExcludedRanges()
+    for node_id, is_excluded, subtree in events:
+        if is_excluded:
+            node_start_index, node_end_index, _ = index.get_node_offsets(node_id)
+            excluded_ranges.add(get_excluded_range(substring, b',', node_start_index, node_end_index),
+                                excluded_taxa_by_node_id[node_id])
+            continue
+
+        # Read the whole subtree once, and cut the excluded ranges out of it
+        tree_bytes = substring(subtree['start'], subtree['end'])
+        subtree_substring = lambda start, end: tree_bytes[start-subtree['start']:end-subtree['start']]
+        subtree['tree_string'] = extract_subtree(subtree_substring, b'(', b',', subtree['start'], subtree['end'],
+                                                 excluded_ranges.inside(subtree['start'], subtree['end']))
+        subtree['excluded_taxa'] = excluded_ranges.taxa_inside(subtree['start'], subtree['end'])
+        yield subtree
+
+def extract_trees_from_file(tree_file, target_taxa: Set[str], excluded_taxa: Set[str] = {}, index_file=None, workers=1,
+                            applied_exclusions=None, metrics=None):
+    '''
+    Extract the subtrees from a tree file, as bytes. If the file has an up to date index
+    (see index_open_tree), only the needed parts of the file are read. Otherwise, the whole
+    file is parsed, using the given number of worker processes.
+    '''
+    return get_subtrees_by_name(generate_subtrees_from_file(tree_file, target_taxa, excluded_taxa, index_file, workers, metrics),
+                                applied_exclusions)
+
+def open_tree_for_extraction(tree_file, index_file=None):
+    '''
+    Open a tree file to extract subtrees from it with generate_subtrees_from_open_tree. If the file has an
+    up to date index, only the subtrees to extract will be read from it. Otherwise, it is memory mapped
+    here rather than while extracting the subtrees, unless it can't be (e.g. it's compressed), in which case
+    it's streamed twice while extracting (see generate_subtrees_from_stream). Returns the open stream, which
+    the caller needs to close, and either the index or the mapped tree (or the stream).
+    '''
+    index = OpenTreeIndex.load(tree_file, index_file)
+    f = open_tree_file(tree_file)
+    try:
+        # Seeking in a compressed file means decompressing it from the start, unless it's a gzip file with a seek index
+        if index and is_compressed_stream(f):
+            logging.info(f"Not using the index of {tree_file}, since it's compressed without a seek index")
+            index = None
+        return f, index, None if index else map_tree_file(f)
+    except BaseException:
+        f.close()
+        raise
+
+def generate_subtrees_from_open_tree(tree_stream, index, newick_tree, target_taxa: Set[str], excluded_taxa: Set[str] = {},
+                                     workers=1, metrics=None):
+    '''
+    Same as generate_subtrees_from_file, for a tree file opened by open_tree_for_extraction
+    '''
+    if index:
+        yield from generate_subtrees_with_index(tree_stream, index, target_taxa, excluded_taxa, metrics)
+    else:
+        yield from generate_subtrees(newick_tree, target_taxa, excluded_taxa, workers, metrics)
+
+def generate_subtrees_from_file(tree_file, target_taxa: Set[str], excluded_taxa: Set[str] = {}, index_file=None, workers=1,
+                                metrics=None):
+    '''
+    Same as extract_trees_from_file, but yields the subtrees as they are found, like generate_subtrees
+    '''
+    tree_stream, index, newick_tree = open_tree_for_extraction(tree_file, index_file)
+    with tree_stream:
+        yield from generate_subtrees_from_open_tree(tree_stream, index, newick_tree, target_taxa, excluded_taxa, workers,
+                                                    metrics)
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('treefile', type=argparse.FileType('r'), nargs='?', default=sys.stdin, help='The tree file in newick form')
+    parser.add_argument('treefile', type=argparse.FileType('rb'), nargs='?', default=sys.stdin, help='The tree file in newick form')
     parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='The output tree file')
     parser.add_argument('--taxa', '-t', nargs='+', required=True, help='the taxon to search for')
     parser.add_argument('--excluded_taxa', '-x', nargs='+', help='taxa to exclude from the result')
+    parser.add_argument('--workers', '-j', type=int, default=1, help='the number of worker processes to use when parsing the whole tree')
+    parser.add_argument('--index_file', help='the index of the tree file (default: the tree file name + .ozidx), used if it exists')
+    parser.add_argument('--catalog', help='a taxon catalog of the tree (see taxon_catalog), to resolve the taxa through')
+    parser.add_argument('--metrics', help='a JSON file in which to save the time spent in each phase, and other metrics of the run')
     args = parser.parse_args()
 
     target_taxa = set(args.taxa)
     excluded_taxa = set(args.excluded_taxa) if args.excluded_taxa else set()
+    catalog = load_catalog_for_tree_stream(args.treefile, args.catalog) if args.catalog else None
+    if catalog:
+        with catalog:
+            target_taxa = resolve_taxa(catalog, target_taxa)
+            # Exclude all the nodes matching an excluded name, as without the catalog
+            excluded_taxa = resolve_taxa(catalog, excluded_taxa, all_matches=True)
 
-    # Read the whole file as a string. This is not ideal, but it's still very fast
-    # even with the full OpenTree tree, and the memory usage is acceptable.
-    # This could be optimized to read by chunks, with much more complexity.
-    tree = args.treefile.read()
+    metrics = Metrics()
+    if os.path.isfile(args.treefile.name):
+        # Use the index if there is one, and otherwise memory map the file
+        with metrics.timed('extract'):
+            result = extract_trees_from_file(args.treefile.name, target_taxa, excluded_taxa, args.index_file, args.workers,
+                                             metrics=metrics)
+    else:
+        with metrics.timed('read'):
+            tree = map_tree_file(args.treefile, random_access=True)
+        with metrics.timed('extract'):
+            result = extract_trees(tree, target_taxa, excluded_taxa, args.workers, metrics=metrics)
+    result = {name: tree if isinstance(tree, str) else tree.decode('utf-8') for name, tree in result.items()}
 
-    result = extract_trees(tree, target_taxa, excluded_taxa)
+    with metrics.timed('write'):
+        if len(result) == 1:
+            # If only one result, just output the tree
+            output = [f'{next(iter(result.values()))};\n']
+        else:
+            # If multiple items, output each on a separate line, prefixed with the name/ott
+            output = [f'{name}: {tree};\n' for name, tree in result.items()]
+        for line in output:
+            args.outfile.write(line)
+            metrics.count('characters written', len(line))
 
-    if len(result) == 1:
-        # If only one result, just output the tree
-        args.outfile.write(f'{next(iter(result.values()))};\n')
-    else:
-        # If multiple items, output each on a separate line, prefixed with the name/ott
-        for name, tree in result.items():
-            args.outfile.write(f'{name}: {tree};\n')
+    if args.metrics:
+        metrics.save(args.metrics)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -16,61 +16,131 @@ The output is:
     ):1.0
   ):0.5
 ):4.5;
+
+For huge trees, --max_depth puts each subtree starting at that depth on a single line, e.g. with
+--max_depth 1, the tree above gives:
+(
+  Tupaia_tana:8.5,
+  (Tupaia_picta:8.0,(Tupaia_montana:7.0,Tupaia_splendidula:7.0):1.0):0.5
+):4.5;
+
+The tree is read in chunks and formatted as it's read, so it doesn't need to fit in memory, and the
+output is written in large batches rather than a few characters at a time.
 '''
 
 import argparse
 import re
 import sys
 
+from oz_tree_build.utilities.compressed_files import decompress_stream
+
 __author__ = "David Ebbo"
 
-whole_token_regex = re.compile('[^(),;]+')
+token_regex = re.compile('[(),;]|[^(),;]+')
 
-def format(newick_tree, output_stream, indent_spaces=2):
+DEFAULT_CHUNK_SIZE = 1024 * 1024
 
-    indent_string = ' ' * indent_spaces
+def format(newick_tree, output_stream, indent_spaces=2, max_depth=None):
+    format_chunks([newick_tree], output_stream, indent_spaces, max_depth)
 
-    index = 0
+def format_stream(input_stream, output_stream, indent_spaces=2, max_depth=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Same as format, but reads the tree from a text stream, in chunks of chunk_size'''
+    format_chunks(iter(lambda: input_stream.read(chunk_size), ''), output_stream, indent_spaces, max_depth)
+
+def format_chunks(chunks, output_stream, indent_spaces=2, max_depth=None):
+    '''
+    Format a tree given as a sequence of strings, which can split it anywhere. The subtrees starting
+    at max_depth (if not None) or deeper are kept on a single line.
+    '''
+    # The indent string for each depth, built as needed
+    indents = ['']
+    def indent(depth):
+        while len(indents) <= depth:
+            indents.append(indents[-1] + ' ' * indent_spaces)
+        return indents[depth]
+
+    max_depth = float('inf') if max_depth is None else max_depth
+    pieces = []
     depth = 0
+    closed_brace = False
+
+    def copy_collapsed(tokens):
+        '''Copy the tokens of a collapsed subtree as they are, up to the brace closing it'''
+        nonlocal depth, closed_brace
+        for token in tokens:
+            pieces.append(token)
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth == max_depth:
+                    closed_brace = True
+                    return
+
+    def format_text(text, is_last):
+        '''
+        Format the text, and return the end of it that needs the next chunk (a name that may carry on),
+        or None if the tree is complete
+        '''
+        nonlocal depth, closed_brace
+        token_list = token_regex.findall(text)
+        rest = ''
+        if not is_last and token_list and token_list[-1][0] not in '(),;':
+            rest = token_list.pop()
+
+        tokens = iter(token_list)
+        if depth > max_depth:
+            copy_collapsed(tokens)
+        for token in tokens:
+            if token == '(':
+                pieces.append(indent(depth))
+                depth += 1
+                closed_brace = False
+                if depth > max_depth:
+                    # Put the whole subtree on a single line
+                    pieces.append('(')
+                    copy_collapsed(tokens)
+                else:
+                    pieces.append('(\n')
+            elif token == ')':
+                depth -= 1
+                pieces.append('\n')
+                pieces.append(indent(depth))
+                pieces.append(')')
+                closed_brace = True
+            elif token == ',':
+                pieces.append(',\n')
+                closed_brace = False
+            elif token == ';':
+                pieces.append(';\n')
+                return None
+            else:
+                # The name (and edge length) of a node comes straight after the closed brace of its children
+                if not closed_brace:
+                    pieces.append(indent(depth))
+                pieces.append(token)
+                closed_brace = False
+        return rest
 
-    while index < len(newick_tree):
-
-        if newick_tree[index] == '(':
-            index += 1
-            output_stream.write(indent_string * depth)
-            output_stream.write('(\n')
-            depth += 1
-            continue
-
-        closed_brace = newick_tree[index] == ')'
-        if closed_brace:
-            index += 1
-            depth -= 1
-            output_stream.write('\n')
-            output_stream.write(indent_string * depth)
-            output_stream.write(')')
-
-        if match_full_name := whole_token_regex.match(newick_tree, index):
-            index = match_full_name.end()
-            if not closed_brace:
-                output_stream.write(indent_string * depth)
-            output_stream.write(match_full_name.group())
-
-        if newick_tree[index] == ',':
-            output_stream.write(newick_tree[index] + '\n')
-            index += 1
-
-        if newick_tree[index] == ';':
-            output_stream.write(newick_tree[index] + '\n')
+    rest = ''
+    for chunk in chunks:
+        rest = format_text(rest + chunk, False)
+        output_stream.write(''.join(pieces))
+        pieces.clear()
+        if rest is None:
             break
+    else:
+        format_text(rest, True)
+        output_stream.write(''.join(pieces))
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('treefile', type=argparse.FileType('r'), nargs='?', default=sys.stdin, help='The tree file in newick format')
     parser.add_argument('outputfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='The output tree file')
     parser.add_argument('--indent_spaces', '-i', default=2, type=int, help='the number of spaces for each indentation level')
+    parser.add_argument('--max_depth', '--max-depth', '-d', type=int, help='put the subtrees starting at this depth or deeper on a single line')
     args = parser.parse_args()
-    format(args.treefile.read(), args.outputfile, args.indent_spaces)
+    format_stream(decompress_stream(args.treefile), args.outputfile, args.indent_spaces, args.max_depth)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,211 @@
+'''
+Build a sidecar index for an Open Tree newick file, mapping each OTT id and taxon name to the
+offsets of its node, so that subtrees can be read directly without parsing the whole file.
+
+The index only needs to be built once per Open Tree release. It records the size, modification
+time and SHA-256 checksum of the tree file, so that a stale index is detected and ignored.
+
+From the command line, run for example:
+python3 index_open_tree.py labelled_supertree_simplified_ottnames.tre
+
+This writes labelled_supertree_simplified_ottnames.tre.ozidx next to the tree file.
+'''
+
+'''
+The index is a binary file, which is memory mapped and binary searched when used, so that
+looking up a few taxa only touches a few pages of it. All integers are little-endian int64.
+
+- Header: magic, tree file size, tree file mtime (ns), tree file SHA-256, and the node, ott
+  and name counts, and the name table size.
+- Nodes, in post-order: (start, end, full_name_start) for each node.
+- Otts: the sorted ott ids, followed by the matching node ids.
+- Names: the offsets of the sorted names in the name table, followed by the matching node ids,
+  and the name table itself (UTF-8).
+'''
+
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+
+__author__ = "David Ebbo"
+
+INDEX_MAGIC = b'OZIDX001'
+header_struct = struct.Struct('<8sqq32sqqqq')
+
+def get_index_file(tree_file):
+    return tree_file + '.ozidx'
+
+def get_file_checksum(file, chunk_size=1024*1024):
+    checksum = hashlib.sha256()
+    with open(file, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            checksum.update(chunk)
+    return checksum.digest()
+
+def build_index(tree_file, index_file=None):
+    '''
+    Parse the whole tree file once, and write the index for it
+    '''
+    index_file = index_file or get_index_file(tree_file)
+
+    node_offsets = array('q')
+    otts = []
+    names = []
+
+    # A compressed file is parsed as it's decompressed, so it needs to stay open
+    with open(tree_file, 'rb') as f:
+        tree = map_tree_file(f)
+        for node_id, (start, end, full_name_start_index, taxon, ott) in enumerate(
+                parse_tree(tree, fields=('start', 'end', 'full_name_start_index', 'taxon', 'ott'))):
+            node_offsets.extend((start, end, full_name_start_index))
+
+            if ott and ott.isdigit():
+                otts.append((int(ott), node_id))
+            if taxon:
+                names.append((taxon.encode('utf-8'), node_id))
+
+    otts.sort()
+    names.sort()
+
+    name_offsets = array('q', [0])
+    for name, node_id in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+
+    stat = os.stat(tree_file)
+    header = header_struct.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, get_file_checksum(tree_file),
+                                len(node_offsets) // 3, len(otts), len(names), name_offsets[-1])
+
+    # Write to a temporary file first, so that an interrupted build doesn't leave a broken index
+    with open(index_file + '.tmp', 'wb') as f:
+        f.write(header)
+        node_offsets.tofile(f)
+        array('q', (ott for ott, node_id in otts)).tofile(f)
+        array('q', (node_id for ott, node_id in otts)).tofile(f)
+        name_offsets.tofile(f)
+        array('q', (node_id for name, node_id in names)).tofile(f)
+        for name, node_id in names:
+            f.write(name)
+    os.replace(index_file + '.tmp', index_file)
+
+    logging.info(f"Indexed {len(node_offsets) // 3} nodes, {len(otts)} otts and {len(names)} names into {index_file}")
+
+class NameTable:
+    '''
+    Sequence view of the sorted names in the index, so that they can be binary searched with bisect
+    '''
+    def __init__(self, offsets, table):
+        self.offsets = offsets
+        self.table = table
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.table[self.offsets[i]:self.offsets[i+1]])
+
+class OpenTreeIndex:
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.tree_size, self.tree_mtime_ns, self.tree_checksum,
+         node_count, ott_count, name_count, name_table_size) = header_struct.unpack_from(self.mmap)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{index_file} is not an Open Tree index file")
+        index_size = header_struct.size + (node_count * 3 + ott_count * 2 + name_count * 2 + 1) * 8 + name_table_size
+        if len(self.mmap) < index_size:
+            raise ValueError(f"{index_file} is truncated")
+
+        # Carve out int64 views over each section of the file, without copying anything
+        view = memoryview(self.mmap)
+        offset = header_struct.size
+        def take_int64s(count):
+            nonlocal offset
+            section = view[offset:offset + count * 8].cast('q')
+            offset += count * 8
+            return section
+
+        self.node_offsets = take_int64s(node_count * 3)
+        self.otts = take_int64s(ott_count)
+        self.ott_node_ids = take_int64s(ott_count)
+        name_offsets = take_int64s(name_count + 1)
+        self.name_node_ids = take_int64s(name_count)
+        self.names = NameTable(name_offsets, view[offset:offset + name_table_size])
+
+    @classmethod
+    def load(cls, tree_file, index_file=None):
+        '''
+        Load the index for the tree file, or return None if it doesn't exist, is invalid or is stale
+        '''
+        index_file = index_file or get_index_file(tree_file)
+        if not os.path.exists(index_file):
+            logging.info(f"No index found for {tree_file}")
+            return None
+
+        try:
+            index = cls(index_file)
+        except (struct.error, ValueError) as e:
+            logging.warning(f"Ignoring invalid index {index_file}: {e}")
+            return None
+
+        stat = os.stat(tree_file)
+        if stat.st_size != index.tree_size:
+            logging.warning(f"Ignoring stale index {index_file}: the tree file size has changed")
+            return None
+
+        # If the file was touched or copied, fall back to checking its contents
+        if stat.st_mtime_ns != index.tree_mtime_ns and get_file_checksum(tree_file) != index.tree_checksum:
+            logging.warning(f"Ignoring stale index {index_file}: the tree file checksum has changed")
+            return None
+
+        return index
+
+    def __len__(self):
+        return len(self.node_offsets) // 3
+
+    def get_node_offsets(self, node_id):
+        '''The (start, end, full_name_start) offsets of the node'''
+        return tuple(self.node_offsets[node_id*3:node_id*3+3])
+
+    def find_ott(self, ott):
+        '''The ids of the nodes with the given ott, in post-order'''
+        if not str(ott).isdigit():
+            return []
+        ott = int(ott)
+        return [self.ott_node_ids[i] for i in range(bisect_left(self.otts, ott), bisect_right(self.otts, ott))]
+
+    def find_name(self, name):
+        '''The ids of the nodes with the given taxon name, in post-order'''
+        name = name.encode('utf-8')
+        return [self.name_node_ids[i] for i in range(bisect_left(self.names, name), bisect_right(self.names, name))]
+
+    def find(self, taxon_or_ott):
+        '''The ids of the nodes matching the taxon name or ott, like the extract functions do'''
+        return sorted(set(self.find_name(taxon_or_ott) + self.find_ott(taxon_or_ott)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('treefile', help='The Open Tree file in newick form')
+    parser.add_argument('indexfile', nargs='?', help='The index file to write (default: the tree file name + .ozidx)')
+    args = parser.parse_args()
+
+    if args.verbosity==0:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    elif args.verbosity==1:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbosity==2:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+    build_index(args.treefile, args.indexfile)
+
+if __name__ == '__main__':
+    main()
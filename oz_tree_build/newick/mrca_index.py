@@ -0,0 +1,195 @@
+'''
+Index over a parsed tree for answering most recent common ancestor (MRCA) and ancestor/descendant
+queries, without going back to the newick tree for each query.
+
+The index is built once from a CompactTree, and can be saved to disk and loaded again. Taxa can be
+given by name or ott, like for the extract functions. Queries return node ids of the CompactTree
+(index.tree), which can be used to get the name, ott, etc. of the node.
+
+From the command line, run for example:
+python3 mrca_index.py tree.tre --mrca Tupaia Camelidae
+python3 mrca_index.py tree.tre --save tree.ozmrca
+python3 mrca_index.py tree.ozmrca --mrca 770315 5334778
+python3 mrca_index.py tree.ozb --mrca 770315 5334778
+'''
+
+'''
+The node ids are in post-order, so the subtree of a node is the range of ids from its first
+descendant up to the node itself, which gives ancestor/descendant tests in constant time.
+
+For the MRCA of two nodes u < v that aren't the same, the nodes with ids in [u, v) include the child
+of the MRCA on the path to u, and the other nodes in that range are all deeper (this is the post-order
+version of the usual trick on the pre-order). So the MRCA is the parent of any of the least deep nodes
+in that range. The MRCA of k nodes is the MRCA of the smallest and largest of their ids.
+
+Finding the least deep node in a range is a range minimum query, on keys combining the depth and id
+of each node. Rather than a full sparse table, which would take too much memory for the Open Tree,
+the nodes are grouped in blocks, with a sparse table over the block minimums. A query looks at most
+two partial blocks and two entries of the sparse table.
+'''
+
+import argparse
+import logging
+import struct
+import sys
+from array import array
+
+from oz_tree_build.newick.compact_tree import COMPACT_TREE_MAGIC, CompactTree
+from oz_tree_build.newick.newick_parser import map_tree_file
+
+__author__ = "David Ebbo"
+
+MRCA_INDEX_MAGIC = b'OZMRCA01'
+header_struct = struct.Struct('<8sqq')
+
+# The keys are depth << id_bits | id, so that the minimum key is the least deep node
+id_bits = 40
+id_mask = (1 << id_bits) - 1
+
+class MrcaIndex:
+    block_size = 32
+
+    def __init__(self, tree: CompactTree, keys=None, levels=None):
+        self.tree = tree
+
+        if keys is None:
+            keys = array('q', ((depth << id_bits) | node_id for node_id, depth in enumerate(tree.depths)))
+        self.keys = keys
+
+        if levels is None:
+            # levels[k][i] is the minimum key of blocks i to i + 2**k - 1
+            block_size = self.block_size
+            levels = [array('q', (min(keys[i:i+block_size]) for i in range(0, len(keys), block_size)))]
+            while 2 ** len(levels) <= len(levels[0]):
+                previous_level, half = levels[-1], 2 ** (len(levels) - 1)
+                levels.append(array('q', map(min, previous_level[:-half], previous_level[half:])))
+        self.levels = levels
+
+    @classmethod
+    def from_newick(cls, newick_tree):
+        '''Build the index for a tree, which can be a string or a bytes-like object'''
+        return cls(CompactTree.from_newick(newick_tree))
+
+    def save(self, index_file):
+        with open(index_file, 'wb') as f:
+            self.tree.save(f)
+            f.write(header_struct.pack(MRCA_INDEX_MAGIC, len(self.keys), len(self.levels)))
+            self.keys.tofile(f)
+            for level in self.levels:
+                level.tofile(f)
+
+    @classmethod
+    def load(cls, index_file):
+        '''Load an index saved with save, or build it for a .ozb file (see ozb_file), which only has the tree'''
+        with open(index_file, 'rb') as f:
+            tree = CompactTree.load(f)
+            header = f.read(header_struct.size)
+            if not header:
+                return cls(tree)
+
+            magic, key_count, level_count = header_struct.unpack(header)
+            if magic != MRCA_INDEX_MAGIC:
+                raise ValueError(f"{index_file} is not an MRCA index file")
+
+            keys = array('q')
+            keys.fromfile(f, key_count)
+            levels = []
+            block_count = -(-key_count // cls.block_size)
+            for k in range(level_count):
+                level = array('q')
+                level.fromfile(f, block_count - 2 ** k + 1)
+                levels.append(level)
+
+        return cls(tree, keys, levels)
+
+    def find(self, taxon_or_ott):
+        '''
+        The id of the node matching the taxon name or ott, taking the first one in post-order
+        like the extract functions do. Otts can also be given as integers.
+        '''
+        taxon_or_ott = str(taxon_or_ott)
+        node_ids = [node_id for node_id in (self.tree.find_name(taxon_or_ott),
+                                            self.tree.find_ott(taxon_or_ott) if taxon_or_ott.isdigit() else None)
+                    if node_id is not None]
+        if not node_ids:
+            raise KeyError(f"{taxon_or_ott} is not in the tree")
+        return min(node_ids)
+
+    def is_ancestor(self, ancestor, descendant):
+        '''Whether the first taxon is the second one or one of its ancestors'''
+        ancestor, descendant = self.find(ancestor), self.find(descendant)
+        return self.tree.first_descendants[ancestor] <= descendant <= ancestor
+
+    def is_descendant(self, descendant, ancestor):
+        '''Whether the first taxon is the second one or one of its descendants'''
+        return self.is_ancestor(ancestor, descendant)
+
+    def min_key(self, start, end):
+        '''The minimum key of the nodes with ids in [start, end), which must not be empty'''
+        block_size = self.block_size
+        first_block, last_block = start // block_size + 1, end // block_size
+        if first_block >= last_block:
+            return min(self.keys[start:end])
+
+        # The partial blocks at both ends, and the full blocks in between, from two overlapping ranges of blocks
+        key = min(self.keys[start:first_block * block_size])
+        if end > last_block * block_size:
+            key = min(key, min(self.keys[last_block * block_size:end]))
+        k = (last_block - first_block).bit_length() - 1
+        level = self.levels[k]
+        return min(key, level[first_block], level[last_block - 2 ** k])
+
+    def mrca_of_nodes(self, first_node_id, second_node_id):
+        start, end = sorted((first_node_id, second_node_id))
+        if self.tree.first_descendants[end] <= start:
+            # The later node is an ancestor of the earlier one (or the same node)
+            return end
+        return self.tree.parents[self.min_key(start, end) & id_mask]
+
+    def mrca(self, *taxa):
+        '''The id of the most recent common ancestor node of the taxa'''
+        node_ids = [self.find(taxon) for taxon in taxa]
+        if not node_ids:
+            raise ValueError("The MRCA needs at least one taxon")
+        return self.mrca_of_nodes(min(node_ids), max(node_ids))
+
+    def mrca_of_pairs(self, pairs):
+        '''The ids of the MRCA nodes for a list of pairs of taxa'''
+        return [self.mrca_of_nodes(self.find(first), self.find(second)) for first, second in pairs]
+
+    def describe(self, node_id):
+        '''The name and ott of the node, in the same form as in the newick tree'''
+        name, ott = self.tree.name(node_id), self.tree.ott(node_id)
+        return f'{name}_ott{ott}' if ott else name
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('treefile', help='The tree file in newick form, a .ozb file, or an index file saved with --save')
+    parser.add_argument('--save', help='save the index to this file, for faster queries later')
+    parser.add_argument('--mrca', '-m', nargs='+', help='the taxa (names or otts) to find the MRCA of')
+    args = parser.parse_args()
+
+    if args.verbosity==0:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    elif args.verbosity==1:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbosity==2:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+    with open(args.treefile, 'rb') as f:
+        is_index_file = f.read(len(COMPACT_TREE_MAGIC)) == COMPACT_TREE_MAGIC
+    if is_index_file:
+        index = MrcaIndex.load(args.treefile)
+    else:
+        with open(args.treefile, 'rb') as f:
+            index = MrcaIndex.from_newick(map_tree_file(f))
+    logging.info(f"Indexed {len(index.tree)} nodes")
+
+    if args.save:
+        index.save(args.save)
+    if args.mrca:
+        print(index.describe(index.mrca(*args.mrca)))
+
+if __name__ == '__main__':
+    main()
@@ -17,18 +17,160 @@ It produces the following output:
     Node: A, OTT: 123, Edge length: 0.0
     Node: B, OTT: None, Edge length: 1.2
     Node: C, OTT: 789, Edge length: 5.5
+
+To avoid reading a huge tree into memory, parse_stream does the same thing over a file object,
+reading it in fixed size chunks. It returns the same nodes, with offsets into the file. parse_tree
+uses it for the trees passed as file objects, e.g. by map_tree_file for the files it can't map.
+
+parse_tree also accepts bytes-like trees (bytes, memoryview or mmap.mmap), which avoids decoding
+the whole file to a string. In that case the offsets are byte offsets, and the nodes are BytesNode
+objects that only decode the taxon, ott and edge length when they are read.
+
+When only some of the fields are needed, parse_tree(tree, fields=('start', 'end')) returns tuples
+of those fields instead, skipping the decoding of the others, and visit_tree calls a function on
+each node rather than returning them.
 '''
 
+import collections
+import io
+import logging
+import mmap
+import operator
 import re
 from typing import Set
 
+from oz_tree_build.utilities.compressed_files import decompress_stream, is_compressed_stream
+
 __author__ = "David Ebbo"
 
 non_name_regex = re.compile(r'[,;:\(\)]')
+non_name_bytes_regex = re.compile(rb'[,;:\(\)]')
+quote_bytes_regex = re.compile(rb"'")
+non_name_chars = ',;:()'
+non_name_bytes = frozenset(b',;:()')
 
-def parse_tree(newick_tree):
-    index = 0
-    index_stack = []
+# The usual form of edge lengths, used to check them while scanning even when they aren't converted
+edge_length_regex = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+edge_length_bytes_regex = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+node_fields = ('taxon', 'ott', 'edge_length', 'start', 'end', 'full_name_start_index', 'depth', 'is_leaf')
+
+def parse_tree(newick_tree, fields=None):
+    '''
+    Enumerate the nodes of a string or bytes-like tree in post-order. By default, they're dictionaries
+    (BytesNode objects for bytes-like trees), with all the node_fields as keys.
+
+    If fields is given (e.g. ('start', 'end')), each node is instead a tuple of those fields, in that
+    order, and the taxon, ott and edge length are only decoded if they're in it. The edge lengths are
+    still checked while scanning, so invalid ones are reported either way.
+
+    The tree can also be a file object (see is_tree_stream), which is read with parse_stream.
+    '''
+    if is_tree_stream(newick_tree):
+        return parse_stream(newick_tree, fields=fields)
+    make_node = None if fields is None else node_tuple_factory(fields)
+    if isinstance(newick_tree, str):
+        return parse_string_tree(newick_tree, make_node)
+    return parse_bytes_tree(newick_tree, make_node)
+
+def visit_tree(newick_tree, visitor, fields=None):
+    '''
+    Call visitor on each node returned by parse_tree(newick_tree, fields). The nodes are consumed
+    without a Python loop, which saves a little time per node on huge trees.
+    '''
+    collections.deque(map(visitor, parse_tree(newick_tree, fields)), maxlen=0)
+
+def parse_tree_chunk(newick_tree, start, end, index_stack, fields=None):
+    '''
+    Enumerate the nodes of newick_tree[start:end] like parse_tree does, but without copying that part
+    of the tree (see TreeChunk in split_tree). index_stack has the open braces before start, as None
+    when their index isn't known, and needs at least one more of them than there are unmatched closed
+    braces in the chunk. It's updated in place, so that at the end it has the braces still open.
+
+    The offsets are those of the whole tree, the nodes whose open brace isn't known get a start of
+    None, and the depths are relative to the start of the chunk.
+    '''
+    make_node = None if fields is None else node_tuple_factory(fields)
+    if isinstance(newick_tree, str):
+        return parse_string_tree(newick_tree, make_node, start, end, index_stack)
+    return parse_bytes_tree(newick_tree, make_node, start, end, index_stack)
+
+def is_tree_stream(newick_tree):
+    '''Whether the tree is a file object to read it from, rather than its text (a mmap isn't one)'''
+    return isinstance(newick_tree, io.IOBase)
+
+def split_ott(full_taxon):
+    '''Split a name like Foo_ott123 into its taxon and ott (None if it doesn't have one)'''
+    if full_taxon and '_ott' in full_taxon:
+        ott_index = full_taxon.index('_ott')
+        return full_taxon[:ott_index], full_taxon[ott_index+4:]
+    return full_taxon, None
+
+def parse_edge_length(edge_length_str):
+    try:
+        return float(edge_length_str)
+    except ValueError:
+        raise SyntaxError(f"'{edge_length_str}' is not a valid edge length")
+
+def is_valid_edge_length(edge_length_str):
+    '''Whether float() accepts a str or bytes edge length, e.g. one that edge_length_regex doesn't match like inf'''
+    try:
+        float(edge_length_str)
+        return True
+    except ValueError:
+        return False
+
+def node_field_selector(fields):
+    '''
+    Return a function selecting the given fields, as a tuple, from the values of all the node_fields
+    '''
+    unknown_fields = set(fields) - set(node_fields)
+    if unknown_fields:
+        raise ValueError(f"Unknown node fields: {', '.join(sorted(unknown_fields))}")
+
+    indexes = [node_fields.index(field) for field in fields]
+    return operator.itemgetter(*indexes) if len(indexes) > 1 else lambda values: (values[indexes[0]],)
+
+def node_tuple_factory(fields):
+    '''
+    Return a function making the node tuples with the given fields, from the offsets found by the
+    parser. The names and edge lengths are only decoded when they're among the fields.
+    '''
+    select = node_field_selector(fields)
+    needs_name = 'taxon' in fields or 'ott' in fields
+    needs_edge_length = 'edge_length' in fields
+
+    def make_node(tree, start, end, full_name_start_index, depth, is_leaf,
+                  name_start_index, name_end_index, edge_length_start_index):
+        taxon = ott = None
+        if needs_name and name_end_index is not None:
+            full_taxon = tree[name_start_index:name_end_index]
+            if not isinstance(full_taxon, str):
+                full_taxon = bytes(full_taxon).decode('utf-8')
+            taxon, ott = split_ott(full_taxon)
+
+        edge_length = 0.0
+        if needs_edge_length and edge_length_start_index is not None:
+            edge_length_str = tree[edge_length_start_index:end]
+            if not isinstance(edge_length_str, str):
+                edge_length_str = bytes(edge_length_str).decode('utf-8')
+            edge_length = parse_edge_length(edge_length_str)
+
+        return select((taxon, ott, edge_length, start, end, full_name_start_index, depth, is_leaf))
+
+    return make_node
+
+def parse_string_tree(newick_tree, make_node=None, start_index=0, end_index=None, index_stack=None):
+    '''
+    Parse a string tree, yielding dictionaries, or the nodes returned by make_node (see
+    node_tuple_factory) if it's given. start_index, end_index and index_stack are for
+    parse_tree_chunk.
+    '''
+    index = start_index
+    index_stack = [] if index_stack is None else index_stack
+    depth_offset = len(index_stack)
     closed_brace = False
 
     # Helper function to raise a syntax error with extra context
@@ -49,36 +191,353 @@ def parse_tree(newick_tree):
         else:
             node_start_index = index
 
-        taxon = ott = None
+        name_start_index = name_end_index = edge_length_start_index = None
 
-        # Parse the taxon name, either quoted or unquoted
+        # Find the taxon name, either quoted or unquoted
         full_name_start_index = index
         if newick_tree[index] == "'":
             # This is a quoted name, so we need to find the matching end quote
             end_quote_index = newick_tree.index("'", index+1)
 
-            taxon = newick_tree[index+1:end_quote_index]
+            name_start_index, name_end_index = index+1, end_quote_index
             index = end_quote_index + 1
         else:
             # This may be an unquoted name, so we need to find the end
             match = non_name_regex.search(newick_tree, index)
             if match:
                 index = match.start()
-                taxon = newick_tree[full_name_start_index:index]
+                name_start_index, name_end_index = full_name_start_index, index
 
-        # After the taxon, there may be an edge length
-        edge_length = 0.0
+        # After the taxon, there may be an edge length, which is checked even if it isn't converted
         if newick_tree[index] == ':':
             index += 1
-            match = non_name_regex.search(newick_tree, index)
-            if match:
+            match = edge_length_regex.match(newick_tree, index)
+            if match and match.end() < len(newick_tree) and newick_tree[match.end()] in non_name_chars:
+                edge_length_start_index = index
+                index = match.end()
+            else:
+                match = non_name_regex.search(newick_tree, index)
+                if match:
+                    edge_length_start_index = index
+                    index = match.start()
+                    edge_length_str = newick_tree[edge_length_start_index:index]
+                    if not is_valid_edge_length(edge_length_str):
+                        raise_syntax_error(f"'{edge_length_str}' is not a valid edge length")
+
+        if make_node:
+            yield make_node(newick_tree, node_start_index, index, full_name_start_index, len(index_stack) - depth_offset, not closed_brace,
+                            name_start_index, name_end_index, edge_length_start_index)
+        else:
+            taxon = ott = None
+            if name_end_index is not None:
+                taxon, ott = split_ott(newick_tree[name_start_index:name_end_index])
+
+            edge_length = 0.0
+            if edge_length_start_index is not None:
                 # Convert to a float
+                edge_length_str = newick_tree[edge_length_start_index:index]
                 try:
-                    edge_length_str = newick_tree[index:match.start()]
                     edge_length = float(edge_length_str)
                 except ValueError:
                     raise_syntax_error(f"'{edge_length_str}' is not a valid edge length")
+
+            yield {'taxon': taxon, 'ott': ott, 'edge_length': edge_length,
+                    'start': node_start_index, 'end': index, 'full_name_start_index': full_name_start_index,
+                    'depth': len(index_stack) - depth_offset, 'is_leaf': not closed_brace}
+
+        # If the stack is empty, we've balanced all the braces and we're done
+        if len(index_stack) == 0:
+            break
+
+        # When parsing a chunk, stop at its end, leaving its unmatched open braces on the stack
+        if index == end_index:
+            return
+
+        # After a taxon, we expect a comma or a closed brace
+        closed_brace = newick_tree[index] == ')'
+        if newick_tree[index] == ',':
+            index += 1
+        elif not closed_brace:
+            raise_syntax_error(f"expected ',' or ')'")
+
+    if index == len(newick_tree) or newick_tree[index] != ';':
+        raise_syntax_error(f"expected a semicolon at the end of the tree")
+
+
+class BytesNode:
+    '''
+    A node from a bytes-like tree. It can be used like the dictionaries returned for string trees
+    (e.g. node['taxon']), but only the offsets are stored, and the taxon, ott and edge length
+    are decoded from the tree when they are read.
+    '''
+    __slots__ = ('tree', 'start', 'end', 'full_name_start_index', 'depth', 'is_leaf',
+                 'name_start_index', 'name_end_index', 'edge_length_start_index')
+
+    fields = node_fields
+
+    def __init__(self, tree, start, end, full_name_start_index, depth, is_leaf,
+                 name_start_index, name_end_index, edge_length_start_index):
+        self.tree = tree
+        self.start = start
+        self.end = end
+        self.full_name_start_index = full_name_start_index
+        self.depth = depth
+        self.is_leaf = is_leaf
+        self.name_start_index = name_start_index
+        self.name_end_index = name_end_index
+        self.edge_length_start_index = edge_length_start_index
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return self.fields
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def _full_taxon(self):
+        if self.name_end_index is None:
+            return None
+        return bytes(self.tree[self.name_start_index:self.name_end_index]).decode('utf-8')
+
+    @property
+    def taxon(self):
+        return split_ott(self._full_taxon())[0]
+
+    @property
+    def ott(self):
+        return split_ott(self._full_taxon())[1]
+
+    @property
+    def edge_length(self):
+        if self.edge_length_start_index is None:
+            return 0.0
+        return parse_edge_length(bytes(self.tree[self.edge_length_start_index:self.end]).decode('utf-8'))
+
+def parse_bytes_tree(newick_tree, make_node=None, start_index=0, end_index=None, index_stack=None):
+    '''
+    Same as parse_string_tree, but for a bytes-like tree (bytes, memoryview or mmap.mmap).
+    Nothing is copied or decoded while scanning: by default, it yields BytesNode objects with byte offsets.
+    '''
+    make_node = make_node or BytesNode
+    open_brace, closed_brace_char, comma, colon, quote, semicolon = b'(),:\';'
+
+    index = start_index
+    index_stack = [] if index_stack is None else index_stack
+    depth_offset = len(index_stack)
+    closed_brace = False
+
+    def raise_syntax_error(message):
+        context = bytes(newick_tree[max(index-20,0):index+20]).decode('utf-8', errors='replace')
+        raise SyntaxError(message, (None, 0, min(index, 20), context))
+
+    while True:
+        if newick_tree[index] == open_brace:
+            index_stack.append(index)
+            index += 1
+            continue
+
+        if closed_brace:
+            index += 1
+
+            # Set the start index to the beginning of the node (where the open parenthesis is)
+            node_start_index = index_stack.pop()
+        else:
+            node_start_index = index
+
+        name_start_index = name_end_index = edge_length_start_index = None
+
+        # Find the taxon name, either quoted or unquoted
+        full_name_start_index = index
+        if newick_tree[index] == quote:
+            match = quote_bytes_regex.search(newick_tree, index+1)
+            if not match:
+                raise_syntax_error("missing closing quote")
+            name_start_index, name_end_index = index+1, match.start()
+            index = match.end()
+        else:
+            match = non_name_bytes_regex.search(newick_tree, index)
+            if match:
                 index = match.start()
+                name_start_index, name_end_index = full_name_start_index, index
+
+        # After the taxon, there may be an edge length, which is checked even if it isn't converted
+        if newick_tree[index] == colon:
+            index += 1
+            match = edge_length_bytes_regex.match(newick_tree, index)
+            if match and match.end() < len(newick_tree) and newick_tree[match.end()] in non_name_bytes:
+                edge_length_start_index = index
+                index = match.end()
+            else:
+                match = non_name_bytes_regex.search(newick_tree, index)
+                if match:
+                    edge_length_start_index = index
+                    index = match.start()
+                    edge_length_bytes = bytes(newick_tree[edge_length_start_index:index])
+                    if not is_valid_edge_length(edge_length_bytes):
+                        raise_syntax_error(f"'{edge_length_bytes.decode('utf-8', errors='replace')}' is not a valid edge length")
+
+        yield make_node(newick_tree, node_start_index, index, full_name_start_index, len(index_stack) - depth_offset, not closed_brace,
+                        name_start_index, name_end_index, edge_length_start_index)
+
+        # If the stack is empty, we've balanced all the braces and we're done
+        if len(index_stack) == 0:
+            break
+
+        # When parsing a chunk, stop at its end, leaving its unmatched open braces on the stack
+        if index == end_index:
+            return
+
+        # After a taxon, we expect a comma or a closed brace
+        closed_brace = newick_tree[index] == closed_brace_char
+        if newick_tree[index] == comma:
+            index += 1
+        elif not closed_brace:
+            raise_syntax_error(f"expected ',' or ')'")
+
+    if index == len(newick_tree) or newick_tree[index] != semicolon:
+        raise_syntax_error(f"expected a semicolon at the end of the tree")
+
+def map_tree_file(stream, random_access=False):
+    '''
+    Memory map an open tree file, so that it can be passed to parse_tree without reading it all
+    into memory. A file that can't be mapped (e.g. stdin, or a compressed file, see compressed_files)
+    is returned as a stream (decompressing it as it's read), which parse_tree reads in chunks with
+    parse_stream. The code slicing the text of the tree needs random_access, in which case such a
+    file is read into memory instead.
+    '''
+    stream = decompress_stream(stream)
+
+    # The fileno() of a compressed stream is the one of the compressed file
+    if not is_compressed_stream(stream):
+        try:
+            return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            pass
+
+    if not random_access:
+        return stream
+    logging.warning(f"Reading {getattr(stream, 'name', 'the tree')} into memory, since it can't be memory mapped")
+    return stream.read()
+
+def parse_stream(stream, chunk_size=DEFAULT_CHUNK_SIZE, fields=None):
+    '''
+    Same as parse_tree, but reads the tree from a file object in chunks of chunk_size. The nodes are
+    dictionaries, or tuples of the given fields, like for parse_tree (but all the fields are decoded).
+
+    Only the text of the current name or edge length is kept around, so the memory used is
+    bounded by the chunk size and the depth of the tree, rather than by the size of the file.
+
+    The file can be opened in text or binary mode. The start/end offsets are absolute
+    offsets in the file, so for a file opened in binary mode they can be passed to seek().
+    '''
+    select = None if fields is None else node_field_selector(fields)
+    buffer = stream.read(chunk_size)
+
+    if isinstance(buffer, bytes):
+        regex = non_name_bytes_regex
+        open_brace, closed_brace_char, comma, colon, quote, semicolon = b'(', b')', b',', b':', b"'", b';'
+        decode = lambda b: b.decode('utf-8')
+    else:
+        regex = non_name_regex
+        open_brace, closed_brace_char, comma, colon, quote, semicolon = '(', ')', ',', ':', "'", ';'
+        decode = lambda s: s
+
+    # Absolute offset of the first character in the buffer
+    buffer_start = 0
+    index = 0
+    index_stack = []
+    closed_brace = False
+
+    # Read the next chunk, dropping everything before the keep_from offset, which is no longer needed
+    def read_chunk(keep_from):
+        nonlocal buffer, buffer_start
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return False
+        keep_from = min(keep_from - buffer_start, len(buffer))
+        buffer = buffer[keep_from:] + chunk
+        buffer_start += keep_from
+        return True
+
+    # Get the character at the given offset, or an empty string at the end of the file
+    def char_at(i):
+        while i - buffer_start >= len(buffer):
+            if not read_chunk(i):
+                return buffer[:0]
+        return buffer[i-buffer_start:i-buffer_start+1]
+
+    # Find the offset of the next match of the compiled regex (or string) from the given offset
+    def find_from(i, pattern):
+        while True:
+            if isinstance(pattern, re.Pattern):
+                match = pattern.search(buffer, i - buffer_start)
+                found = match.start() if match else -1
+            else:
+                found = buffer.find(pattern, i - buffer_start)
+            if found >= 0:
+                return found + buffer_start
+            if not read_chunk(i):
+                return None
+
+    def text(start, end):
+        return decode(buffer[start-buffer_start:end-buffer_start])
+
+    def raise_syntax_error(message):
+        context_start = max(index-20, buffer_start)
+        raise SyntaxError(message, (None, 0, index - context_start, text(context_start, min(index+20, buffer_start+len(buffer)))))
+
+    while True:
+        next_char = char_at(index)
+        if not next_char:
+            raise_syntax_error("unexpected end of the tree")
+
+        if next_char == open_brace:
+            index_stack.append(index)
+            index += 1
+            continue
+
+        if closed_brace:
+            index += 1
+
+            # Set the start index to the beginning of the node (where the open parenthesis is)
+            node_start_index = index_stack.pop()
+        else:
+            node_start_index = index
+
+        taxon = ott = None
+
+        # Parse the taxon name, either quoted or unquoted
+        full_name_start_index = index
+        if char_at(index) == quote:
+            # This is a quoted name, so we need to find the matching end quote
+            end_quote_index = find_from(index+1, quote)
+            if end_quote_index is None:
+                raise_syntax_error("missing closing quote")
+
+            taxon = text(index+1, end_quote_index)
+            index = end_quote_index + 1
+        else:
+            # This may be an unquoted name, so we need to find the end
+            name_end_index = find_from(index, regex)
+            if name_end_index is not None:
+                index = name_end_index
+                taxon = text(full_name_start_index, index)
+
+        # After the taxon, there may be an edge length
+        edge_length = 0.0
+        if char_at(index) == colon:
+            index += 1
+            edge_length_end_index = find_from(index, regex)
+            if edge_length_end_index is not None:
+                # Convert to a float
+                try:
+                    edge_length_str = text(index, edge_length_end_index)
+                    edge_length = float(edge_length_str)
+                except ValueError:
+                    raise_syntax_error(f"'{edge_length_str}' is not a valid edge length")
+                index = edge_length_end_index
 
         if taxon:
             # Check if the taxon has an ott id, and if so, parse it out
@@ -87,20 +546,25 @@ def parse_tree(newick_tree):
                 ott = taxon[ott_index+4:]
                 taxon = taxon[:ott_index]
 
-        yield {'taxon': taxon, 'ott': ott, 'edge_length': edge_length,
-                'start': node_start_index, 'end': index, 'full_name_start_index': full_name_start_index,
-                'depth': len(index_stack), 'is_leaf': not closed_brace}
+        if select:
+            yield select((taxon, ott, edge_length, node_start_index, index, full_name_start_index,
+                          len(index_stack), not closed_brace))
+        else:
+            yield {'taxon': taxon, 'ott': ott, 'edge_length': edge_length,
+                    'start': node_start_index, 'end': index, 'full_name_start_index': full_name_start_index,
+                    'depth': len(index_stack), 'is_leaf': not closed_brace}
 
         # If the stack is empty, we've balanced all the braces and we're done
         if len(index_stack) == 0:
             break
 
         # After a taxon, we expect a comma or a closed brace
-        closed_brace = newick_tree[index] == ')'
-        if newick_tree[index] == ',':
+        next_char = char_at(index)
+        closed_brace = next_char == closed_brace_char
+        if next_char == comma:
             index += 1
         elif not closed_brace:
             raise_syntax_error(f"expected ',' or ')'")
 
-    if index == len(newick_tree) or newick_tree[index] != ';':
+    if char_at(index) != semicolon:
         raise_syntax_error(f"expected a semicolon at the end of the tree")
@@ -0,0 +1,89 @@
+'''
+Convert newick trees to and from .ozb files, a binary form of the parsed tree that loads much faster
+than parsing the newick text again.
+
+A .ozb file is a saved CompactTree: a header, then the per node columns (parent ids as the topology,
+otts as integers, edge lengths as float64, etc.), and the deduplicated names as a string table.
+load_ozb memory maps the file, so loading it only takes the time to check the header, and the OS
+pages the columns in as they are used, sharing them between the processes using the same file.
+
+From the command line, run for example:
+python3 ozb_file.py labelled_supertree_simplified_ottnames.tre labelled_supertree_simplified_ottnames.ozb
+python3 ozb_file.py labelled_supertree_simplified_ottnames.ozb labelled_supertree_simplified_ottnames.tre
+'''
+
+import argparse
+import logging
+import mmap
+import os
+import sys
+
+from oz_tree_build.newick.compact_tree import COMPACT_TREE_MAGIC, CompactTree
+from oz_tree_build.newick.newick_parser import map_tree_file
+from oz_tree_build.utilities.compressed_files import open_tree_file
+
+__author__ = "David Ebbo"
+
+def is_ozb_file(file):
+    with open(file, 'rb') as f:
+        return f.read(len(COMPACT_TREE_MAGIC)) == COMPACT_TREE_MAGIC
+
+def newick_to_ozb(tree_file, ozb_file):
+    '''
+    Parse a (possibly compressed) newick tree file, and save it as a .ozb file
+    '''
+    with open_tree_file(tree_file) as f:
+        tree = CompactTree.from_newick(map_tree_file(f))
+
+    # Write to a temporary file first, so that an interrupted conversion doesn't leave a broken file
+    with open(ozb_file + '.tmp', 'wb') as f:
+        tree.save(f)
+    os.replace(ozb_file + '.tmp', ozb_file)
+
+    logging.info(f"Saved {len(tree)} nodes to {ozb_file}")
+    return tree
+
+def load_ozb(ozb_file):
+    '''
+    Load a .ozb file as a CompactTree, whose columns are views over the memory mapped file
+    '''
+    with open(ozb_file, 'rb') as f:
+        # The mapping stays open as long as the tree uses it, even once the file is closed
+        return CompactTree.from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def parse_ozb(ozb_file):
+    '''
+    Enumerate the nodes of a .ozb file in post-order, with the same keys as parse_tree. The
+    offsets are the ones in the newick file the .ozb file was made from.
+    '''
+    return load_ozb(ozb_file).nodes()
+
+def ozb_to_newick(ozb_file, output_stream):
+    '''
+    Write the tree of a .ozb file in newick form to a text stream
+    '''
+    load_ozb(ozb_file).write_newick(output_stream)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('infile', help='The tree file to convert: a newick file (possibly compressed) or a .ozb file')
+    parser.add_argument('outfile', help='The converted tree file: a .ozb file for a newick input, or a newick file for a .ozb input')
+    args = parser.parse_args()
+
+    if args.verbosity==0:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    elif args.verbosity==1:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbosity==2:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+    if is_ozb_file(args.infile):
+        with open(args.outfile, 'w', encoding="utf8") as f:
+            ozb_to_newick(args.infile, f)
+            f.write('\n')
+    else:
+        newick_to_ozb(args.infile, args.outfile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+Split a Newick tree into chunks that can be parsed in parallel, e.g. in separate processes.
+
+The chunks are balanced byte ranges, split between sibling clades (i.e. at commas), so that no
+name or edge length is cut in two. Finding the split points only needs a few searches, rather
+than a scan of the whole tree structure.
+
+A chunk generally doesn't contain whole clades: a clade can start in one chunk and end in a later
+one. Each chunk is parsed on its own, in place (see TreeChunk), and a node whose open brace is in an earlier
+chunk gets a start of None. The chunks also record their unmatched braces, and match_chunk_braces
+uses them to find the start indexes of those nodes, and the depth at the start of each chunk.
+
+For example:
+
+    chunks = [TreeChunk(tree, start, end) for start, end in split_tree(tree, 4)]
+    nodes_per_chunk = [list(chunk.parse()) for chunk in chunks]
+    unmatched_braces = [chunk.unmatched_braces for chunk in chunks]
+    for (depth_at_start, starts), nodes in zip(match_chunk_braces(unmatched_braces), nodes_per_chunk):
+        ...
+'''
+
+import re
+from bisect import bisect_right
+
+from oz_tree_build.newick.newick_parser import parse_tree_chunk
+
+__author__ = "David Ebbo"
+
+comma_regex = re.compile(r',')
+comma_bytes_regex = re.compile(rb',')
+quote_regex = re.compile(r"'")
+quote_bytes_regex = re.compile(rb"'")
+semicolon_regex = re.compile(r';')
+semicolon_bytes_regex = re.compile(rb';')
+closed_brace_bytes_regex = re.compile(rb'\)')
+
+def split_tree(newick_tree, chunk_count):
+    '''
+    Split the tree into up to chunk_count (start, end) ranges of roughly the same size.
+    The commas between the chunks are not part of any chunk.
+    '''
+    if isinstance(newick_tree, str):
+        comma, quote, semicolon = comma_regex, quote_regex, semicolon_regex
+    else:
+        comma, quote, semicolon = comma_bytes_regex, quote_bytes_regex, semicolon_bytes_regex
+
+    # Find the quotes, so we can skip commas and semicolons that are inside quoted names.
+    # They are typically rare, so this is fast.
+    quote_indexes = [match.start() for match in quote.finditer(newick_tree)]
+    def find_unquoted(regex, index):
+        while match := regex.search(newick_tree, index):
+            if bisect_right(quote_indexes, match.start()) % 2 == 0:
+                return match.start()
+            index = match.start() + 1
+        return None
+
+    tree_end_index = find_unquoted(semicolon, 0)
+    if tree_end_index is None:
+        tree_end_index = len(newick_tree)
+
+    chunks = []
+    chunk_start_index = 0
+    for i in range(1, chunk_count):
+        comma_index = find_unquoted(comma, max(i * tree_end_index // chunk_count, chunk_start_index))
+        if comma_index is None or comma_index >= tree_end_index:
+            break
+        chunks.append((chunk_start_index, comma_index))
+        chunk_start_index = comma_index + 1
+    chunks.append((chunk_start_index, tree_end_index))
+
+    return chunks
+
+class TreeChunk:
+    '''
+    A chunk of a tree returned by split_tree. Parsing it gives the same nodes as parse_tree
+    (with the same offsets), except that:
+    - Nodes whose open brace is in an earlier chunk have a start of None.
+    - Nodes whose closed brace is in a later chunk are not returned.
+    - The depths are relative to the start of the chunk, so they can be negative.
+
+    After parsing, unmatched_braces can be passed to match_chunk_braces.
+    '''
+    def __init__(self, newick_tree, start, end):
+        self.newick_tree = newick_tree
+        self.start = start
+        self.end = end
+        self.unmatched_close_count = 0
+        self.unmatched_open_brace_indexes = []
+
+    def parse(self, fields=None):
+        '''
+        Enumerate the nodes of the chunk, as dictionaries or as tuples of the given fields, like parse_tree
+        '''
+        # Put enough unknown open braces on the stack for any unmatched closed braces in the chunk, plus
+        # one so that the stack never empties, and the chunk is parsed as a list of siblings.
+        # Braces in quoted names are counted too, which only leaves a few unused ones.
+        if isinstance(self.newick_tree, str):
+            closed_brace_count = self.newick_tree.count(')', self.start, self.end)
+        else:
+            closed_brace_count = len(closed_brace_bytes_regex.findall(self.newick_tree, self.start, self.end))
+        index_stack = [None] * (closed_brace_count + 1)
+
+        yield from parse_tree_chunk(self.newick_tree, self.start, self.end, index_stack, fields)
+
+        # The braces left on the stack are the unknown ones that weren't matched, then the open braces
+        # of the chunk that weren't closed, in the order they were opened
+        unknown_count = index_stack.count(None)
+        self.unmatched_close_count = closed_brace_count + 1 - unknown_count
+        self.unmatched_open_brace_indexes = index_stack[unknown_count:]
+
+    @property
+    def unmatched_braces(self):
+        '''
+        The number of closed braces matching open braces in earlier chunks, and the indexes
+        of the open braces matched by closed braces in later chunks
+        '''
+        return self.unmatched_close_count, self.unmatched_open_brace_indexes
+
+def match_chunk_braces(unmatched_braces):
+    '''
+    For the unmatched braces of each parsed chunk (in tree order), yield the depth of the tree at the
+    start of the chunk, and the start indexes of the nodes of the chunk whose start was None, in the
+    order they were returned.
+    '''
+    open_brace_indexes = []
+    for unmatched_close_count, unmatched_open_brace_indexes in unmatched_braces:
+        depth_at_start = len(open_brace_indexes)
+
+        # The first unmatched closed brace matches the last open brace, and so on
+        starts = [open_brace_indexes.pop() for i in range(unmatched_close_count)]
+        open_brace_indexes += unmatched_open_brace_indexes
+
+        yield depth_at_start, starts
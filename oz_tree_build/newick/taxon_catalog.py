@@ -0,0 +1,305 @@
+'''
+Build a SQLite catalog of the nodes of a newick tree, to look up taxa by name, ott or name prefix
+in milliseconds, rather than searching the whole tree file (e.g. with find_in_file) each time.
+
+Each node of the tree has a row with its name, ott, offsets in the tree file, depth, parent and
+whether it's a leaf. The names can be searched exactly, or by case-insensitive prefix, e.g. to find
+the exact spelling of a taxon. The extract_trees and extract_minimal_tree commands can also resolve
+the taxa they're given through a catalog (--catalog), which finds names with the wrong case.
+
+From the command line, run for example:
+build_taxon_catalog labelled_supertree_simplified_ottnames.tre
+build_taxon_catalog labelled_supertree_simplified_ottnames.tre --find Homo_sapiens 770315
+build_taxon_catalog labelled_supertree_simplified_ottnames.tre --prefix homo_s
+
+This writes labelled_supertree_simplified_ottnames.tre.ozdb next to the tree file (or reuses it if
+it's up to date), and outputs the matching nodes as JSON.
+'''
+
+'''
+The tree is parsed once with parse_tree, and the nodes are inserted in batches with executemany,
+all in a single transaction, with the indexes created at the end. A node's parent only comes after it
+in post-order, so the nodes are inserted once their parent is found. The only nodes waiting for it
+are the children of the nodes still open, so this doesn't keep much of the tree in memory.
+
+The node ids are in post-order, like in index_open_tree and CompactTree, and the offsets are the
+same as the ones parse_tree returns (byte offsets for tree files). Like in CompactTree, non numeric
+otts are kept as part of the name. The catalog also records the size, modification time and
+checksum of the tree file, to detect stale catalogs.
+
+The case-insensitive prefix search uses a range query on an index of the names with the NOCASE
+collation, rather than LIKE, since the names are full of underscores, which LIKE treats as wildcards.
+NOCASE only ignores the case of ASCII letters.
+'''
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+from oz_tree_build.newick.index_open_tree import get_file_checksum
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+from oz_tree_build.utilities.compressed_files import open_tree_file
+
+__author__ = "David Ebbo"
+
+TAXON_CATALOG_VERSION = 1
+
+DEFAULT_BATCH_SIZE = 100000
+
+# Higher than any character, to find the names starting with a prefix
+max_character = '\U0010ffff'
+
+schema = '''
+CREATE TABLE catalog_info (version INTEGER, tree_size INTEGER, tree_mtime_ns INTEGER, tree_checksum BLOB);
+CREATE TABLE nodes (
+    node_id INTEGER PRIMARY KEY,
+    name TEXT,
+    ott INTEGER,
+    start_offset INTEGER,
+    end_offset INTEGER,
+    full_name_offset INTEGER,
+    depth INTEGER,
+    parent INTEGER,
+    is_leaf INTEGER
+);
+'''
+
+indexes = '''
+CREATE INDEX nodes_name ON nodes (name);
+CREATE INDEX nodes_name_nocase ON nodes (name COLLATE NOCASE);
+CREATE INDEX nodes_ott ON nodes (ott);
+'''
+
+node_columns = 'node_id, name, ott, start_offset, end_offset, full_name_offset, depth, parent, is_leaf'
+
+def get_catalog_file(tree_file):
+    return tree_file + '.ozdb'
+
+def enumerate_catalog_rows(newick_tree):
+    '''
+    Enumerate the rows of the nodes table for a tree, as lists of the node_columns values. The nodes are
+    returned once their parent is found, so they're in post-order except for the children of each node.
+    '''
+    # The rows of the nodes whose parent we haven't seen yet. Since nodes come in post-order, when we
+    # get to a node, its children are the pending nodes that are deeper than it.
+    pending_rows = []
+
+    fields = ('taxon', 'ott', 'start', 'end', 'full_name_start_index', 'depth', 'is_leaf')
+    for node_id, (taxon, ott, start, end, full_name_start_index, depth, is_leaf) in enumerate(parse_tree(newick_tree, fields)):
+        # Keep non numeric otts as part of the name, so that we don't lose them
+        if ott is not None and not ott.isdigit():
+            taxon = f'{taxon}_ott{ott}'
+            ott = None
+
+        while pending_rows and pending_rows[-1][6] > depth:
+            row = pending_rows.pop()
+            row[7] = node_id
+            yield row
+        pending_rows.append([node_id, taxon or None, int(ott) if ott else None, start, end, full_name_start_index,
+                             depth, None, is_leaf])
+
+    # The root, which has no parent
+    yield from pending_rows
+
+def build_taxon_catalog(tree_file, catalog_file=None, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Parse the whole (possibly compressed) tree file once, and write the catalog of its nodes
+    '''
+    catalog_file = catalog_file or get_catalog_file(tree_file)
+
+    # Write to a temporary file first, so that an interrupted build doesn't leave a broken catalog
+    if os.path.exists(catalog_file + '.tmp'):
+        os.remove(catalog_file + '.tmp')
+    connection = sqlite3.connect(catalog_file + '.tmp')
+    try:
+        # The file is only used once it's complete, so it doesn't need a journal
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.executescript(schema)
+
+        node_count = 0
+        insert = f'INSERT INTO nodes ({node_columns}) VALUES ({", ".join("?" * len(node_columns.split(", ")))})'
+        with connection, open_tree_file(tree_file) as f:
+            batch = []
+            for row in enumerate_catalog_rows(map_tree_file(f)):
+                batch.append(row)
+                if len(batch) == batch_size:
+                    connection.executemany(insert, batch)
+                    node_count += len(batch)
+                    batch.clear()
+            connection.executemany(insert, batch)
+            node_count += len(batch)
+
+            connection.executescript(indexes)
+            stat = os.stat(tree_file)
+            connection.execute('INSERT INTO catalog_info VALUES (?, ?, ?, ?)',
+                               (TAXON_CATALOG_VERSION, stat.st_size, stat.st_mtime_ns, get_file_checksum(tree_file)))
+    finally:
+        connection.close()
+    os.replace(catalog_file + '.tmp', catalog_file)
+
+    logging.info(f"Cataloged {node_count} nodes into {catalog_file}")
+
+class TaxonCatalog:
+    '''
+    A catalog built by build_taxon_catalog. The nodes are returned as dictionaries, with the same
+    keys as the ones returned by parse_tree, plus their node id and parent node id (None for the root).
+    '''
+    def __init__(self, catalog_file):
+        # Open it read-only, so that a missing file isn't created
+        self.connection = sqlite3.connect(f'file:{catalog_file}?mode=ro', uri=True)
+        try:
+            version, self.tree_size, self.tree_mtime_ns, self.tree_checksum = \
+                self.connection.execute('SELECT * FROM catalog_info').fetchone()
+        except sqlite3.DatabaseError:
+            self.connection.close()
+            raise ValueError(f"{catalog_file} is not a taxon catalog")
+        if version != TAXON_CATALOG_VERSION:
+            self.connection.close()
+            raise ValueError(f"{catalog_file} is a taxon catalog from a different version, and needs to be built again")
+
+    @classmethod
+    def load(cls, tree_file, catalog_file=None):
+        '''
+        Load the catalog for the tree file, or return None if it doesn't exist or is stale
+        '''
+        catalog_file = catalog_file or get_catalog_file(tree_file)
+        if not os.path.exists(catalog_file):
+            logging.info(f"No taxon catalog found for {tree_file}")
+            return None
+
+        catalog = cls(catalog_file)
+        stat = os.stat(tree_file)
+        if stat.st_size != catalog.tree_size:
+            logging.warning(f"Ignoring stale taxon catalog {catalog_file}: the tree file size has changed")
+            catalog.close()
+            return None
+
+        # If the file was touched or copied, fall back to checking its contents
+        if stat.st_mtime_ns != catalog.tree_mtime_ns and get_file_checksum(tree_file) != catalog.tree_checksum:
+            logging.warning(f"Ignoring stale taxon catalog {catalog_file}: the tree file checksum has changed")
+            catalog.close()
+            return None
+
+        return catalog
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    def query(self, where, parameters=()):
+        rows = self.connection.execute(f'SELECT {node_columns} FROM nodes WHERE {where}', parameters)
+        return [{'node_id': node_id, 'taxon': name or '', 'ott': None if ott is None else str(ott), 'start': start,
+                 'end': end, 'full_name_start_index': full_name_start_index, 'depth': depth, 'parent': parent,
+                 'is_leaf': bool(is_leaf)}
+                for node_id, name, ott, start, end, full_name_start_index, depth, parent, is_leaf in rows]
+
+    def find_name(self, name, ignore_case=False):
+        '''The nodes with the given taxon name, in post-order'''
+        collation = ' COLLATE NOCASE' if ignore_case else ''
+        return self.query(f'name = ?{collation} ORDER BY node_id', (name,))
+
+    def find_ott(self, ott):
+        '''The nodes with the given ott (int or string), in post-order'''
+        if not str(ott).isdigit():
+            return []
+        return self.query('ott = ? ORDER BY node_id', (int(ott),))
+
+    def find(self, taxon_or_ott):
+        '''The nodes matching the taxon name or ott, in post-order, like the extract functions do'''
+        nodes = {node['node_id']: node for node in self.find_name(str(taxon_or_ott)) + self.find_ott(taxon_or_ott)}
+        return [nodes[node_id] for node_id in sorted(nodes)]
+
+    def search_prefix(self, prefix, limit=20):
+        '''The first nodes (by name, then in post-order) whose name starts with the prefix, ignoring the case'''
+        return self.query('name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE ORDER BY name COLLATE NOCASE, node_id LIMIT ?',
+                          (prefix, prefix + max_character, limit))
+
+    def resolve(self, taxon_or_ott):
+        '''
+        The ott (or the name, if it doesn't have one) of the first node (in post-order) matching the taxon
+        name or ott, also looking for names with a different case. Returns None if there is none.
+        '''
+        nodes = self.find(taxon_or_ott) or self.find_name(str(taxon_or_ott), ignore_case=True)
+        if not nodes:
+            return None
+        return nodes[0]['ott'] or nodes[0]['taxon']
+
+    def resolve_all(self, taxon_or_ott):
+        '''
+        Same as resolve, but for all the matching nodes, e.g. to exclude all the nodes with a name shared by
+        several taxa. Returns an empty set if there is none.
+        '''
+        nodes = self.find(taxon_or_ott) or self.find_name(str(taxon_or_ott), ignore_case=True)
+        return {node['ott'] or node['taxon'] for node in nodes}
+
+def load_catalog_for_tree_stream(tree_stream, catalog_file):
+    '''
+    Load the catalog given on the command line for an open tree file, checking that it is up to date with
+    it. Returns None, with a warning, if it's missing or stale, or if the tree isn't a file it can be checked
+    against (e.g. stdin).
+    '''
+    catalog = TaxonCatalog.load(tree_stream.name, catalog_file) if os.path.isfile(tree_stream.name) else None
+    if catalog is None:
+        logging.warning(f"Not resolving the taxa through {catalog_file}, since it is missing, or not up to date with the tree file")
+    return catalog
+
+def resolve_taxa(catalog, taxa, all_matches=False):
+    '''
+    Resolve taxa given on the command line through a catalog (see TaxonCatalog.resolve), or with all_matches,
+    to the taxa of all their matching nodes (see TaxonCatalog.resolve_all). The taxa that can't be resolved
+    are kept as they are.
+    '''
+    resolved_taxa = set()
+    for taxon in taxa:
+        matches = catalog.resolve_all(taxon) if all_matches else {catalog.resolve(taxon)} - {None}
+        if not matches:
+            logging.warning(f"{taxon} is not in the taxon catalog")
+            matches = {taxon}
+        elif matches != {taxon}:
+            logging.info(f"Resolved {taxon} to {', '.join(sorted(matches))}")
+        resolved_taxa |= matches
+    return resolved_taxa
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('treefile', help='The tree file in newick form')
+    parser.add_argument('catalogfile', nargs='?', help='The catalog file (default: the tree file name + .ozdb)')
+    parser.add_argument('--find', '-f', nargs='+', help='taxon names or otts to output the matching nodes of, as JSON')
+    parser.add_argument('--prefix', '-p', help='a name prefix to output the matching nodes of (ignoring the case), as JSON')
+    parser.add_argument('--limit', type=int, default=20, help='the maximum number of nodes to output for --prefix')
+    parser.add_argument('--rebuild', action='store_true', help='build the catalog even if it is up to date')
+    args = parser.parse_args()
+
+    if args.verbosity==0:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    elif args.verbosity==1:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbosity==2:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+    catalog = None if args.rebuild else TaxonCatalog.load(args.treefile, args.catalogfile)
+    if catalog is None:
+        build_taxon_catalog(args.treefile, args.catalogfile)
+        catalog = TaxonCatalog(args.catalogfile or get_catalog_file(args.treefile))
+
+    with catalog:
+        if args.find:
+            print(json.dumps({taxon: catalog.find(taxon) for taxon in args.find}, indent=2))
+        if args.prefix:
+            print(json.dumps(catalog.search_prefix(args.prefix, args.limit), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+'''
+Transform an ultrametric newick tree into an additive newick tree
+'''
+
+'''
+e.g. if A split from B 7 MYA, and C split from A&B 20 MYA, the ultrametric tree would be:
+
+(
+  (
+    A,
+    B
+  ):7,
+  C
+):20;
+
+And this code turns that into a proper additive newick tree:
+
+(
+  (
+    A:7.0,
+    B:7.0
+  ):13.0,
+  C:20.0
+);
+
+Note that the input is a clear abuse of the newick branch length syntax, since
+we're not actually storing length, but ages. It is however convenient as a
+transitional format when translating an ultrametric diagram to newick format.
+
+The edge lengths are rounded to 2 decimals, and omitted when they're zero. Everything else
+(names, quotes) is copied as is.
+
+The tree is processed in two passes of parse_tree, without building a tree of nodes in memory. The
+first one finds the ages of the internal nodes, and stores them in pre-order in a temporary file.
+The second one writes the tree, with each node's edge length computed from its parent's age, which
+is read from the temporary file when the parent's open brace is reached.
+'''
+
+import argparse
+import mmap
+import sys
+import tempfile
+
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+
+__author__ = "David Ebbo"
+
+DEFAULT_BATCH_SIZE = 100000
+
+def count_open_braces(newick_tree, chunk_size=1024 * 1024):
+    '''The number of open braces in the tree, which is at least its number of internal nodes'''
+    if isinstance(newick_tree, str):
+        return newick_tree.count('(')
+    return sum(bytes(newick_tree[i:i+chunk_size]).count(b'(') for i in range(0, len(newick_tree), chunk_size))
+
+def enumerate_opened_nodes(nodes):
+    '''
+    For each node returned by parse_tree with 'depth' and 'is_leaf' as the last two fields, yield it
+    with the number of internal nodes opened since the previous node. Since every open brace is
+    followed by a leaf (possibly with an empty name), they're the ancestors of the leaf not seen before.
+    '''
+    open_node_count = 0
+    for node in nodes:
+        depth, is_leaf = node[-2], node[-1]
+        if is_leaf:
+            opened_count = depth - open_node_count
+            open_node_count = depth
+            yield node, opened_count
+        else:
+            open_node_count -= 1
+            yield node, 0
+
+def store_internal_node_ages(newick_tree, ages):
+    '''
+    Store the age (i.e. the edge length in the ultrametric tree) of each internal node in ages, by
+    pre-order index
+    '''
+    open_node_indexes = []
+    node_index = 0
+    for (age, depth, is_leaf), opened_count in enumerate_opened_nodes(parse_tree(newick_tree, ('edge_length', 'depth', 'is_leaf'))):
+        if is_leaf:
+            open_node_indexes += range(node_index, node_index + opened_count)
+            node_index += opened_count
+        else:
+            ages[open_node_indexes.pop()] = age
+
+def write_additive_tree(newick_tree, ages, output_stream, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Write the tree with the edge lengths computed from the ages of the nodes, given the ages of the
+    internal nodes by pre-order index
+    '''
+    if isinstance(newick_tree, str):
+        substring = lambda start, end: newick_tree[start:end]
+    else:
+        substring = lambda start, end: bytes(newick_tree[start:end]).decode('utf-8')
+
+    # The ages of the internal nodes whose open brace was reached, but not their closed brace
+    open_node_ages = []
+    node_index = 0
+    index = 0
+    pieces = []
+
+    fields = ('edge_length', 'full_name_start_index', 'end', 'depth', 'is_leaf')
+    for (age, full_name_start_index, end, depth, is_leaf), opened_count in enumerate_opened_nodes(parse_tree(newick_tree, fields)):
+        if is_leaf:
+            open_node_ages += ages[node_index:node_index + opened_count]
+            node_index += opened_count
+        else:
+            open_node_ages.pop()
+
+        # The root has the same age as its (missing) parent, so its edge length is omitted
+        parent_age = open_node_ages[-1] if depth > 0 else age
+        edge_length = round(parent_age - age, 2)
+
+        # Copy the braces and commas since the previous node, and the name without the edge length.
+        # Unquoted names can't contain a colon, and quoted ones are followed by it if there is one.
+        full_name = substring(full_name_start_index, end)
+        if ':' in full_name and not full_name.endswith("'"):
+            full_name = full_name[:full_name.rindex(':')]
+        pieces.append(substring(index, full_name_start_index))
+        pieces.append(full_name)
+        if edge_length:
+            pieces.append(f":{edge_length}")
+        index = end
+
+        if len(pieces) >= batch_size:
+            output_stream.write(''.join(pieces))
+            pieces.clear()
+
+    # The closing braces of the root and the semicolon
+    pieces.append(substring(index, len(newick_tree)))
+    output_stream.write(''.join(pieces))
+
+def ultrametric_to_additive(newick_tree, output_stream, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Write the additive version of an ultrametric string or bytes-like tree to a text stream. Besides the
+    ages of the internal nodes, which are kept in a temporary file, the memory used only depends on the
+    depth of the tree, not its size.
+    '''
+    internal_node_count = count_open_braces(newick_tree)
+    if internal_node_count == 0:
+        write_additive_tree(newick_tree, [], output_stream, batch_size)
+        return
+
+    # Keep the ages in a file mapped in memory, so that the OS can page them out
+    with tempfile.TemporaryFile() as ages_file:
+        ages_file.truncate(internal_node_count * 8)
+        with mmap.mmap(ages_file.fileno(), internal_node_count * 8) as ages_map:
+            ages = memoryview(ages_map).cast('d')
+            try:
+                store_internal_node_ages(newick_tree, ages)
+                write_additive_tree(newick_tree, ages, output_stream, batch_size)
+            finally:
+                ages.release()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('treefile', type=argparse.FileType('rb'), nargs='?', default=sys.stdin, help='The ultrametric tree in newick form')
+    parser.add_argument('outfile', type=argparse.FileType('w', encoding="utf8"), nargs='?', default=sys.stdout, help='The output newick tree file')
+    args = parser.parse_args()
+
+    ultrametric_to_additive(map_tree_file(args.treefile, random_access=True), args.outfile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+Cache of the OneZoom tokens found in each part file, shared by get_open_trees_from_one_zoom and
+build_oz_tree, so that the files are only scanned again when they change.
+'''
+
+'''
+The manifest is a JSON file with, for each part file (by absolute path), its size, modification
+time, checksum, and the tokens enumerate_one_zoom_tokens finds in it, with their offsets in the
+trimmed tree (as build_oz_tree reads it). A file whose size or modification time changed is read
+again, but only scanned again if its content changed.
+
+It also records the include graph starting from the base file: the files that each OneZoom file
+includes, following token_to_file_map for the OneZoom tokens, and the Open Tree parts folder for the
+others. Walking it before a build reports all the missing files and unmapped tokens at once, rather
+than one at a time as the build gets to them.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from oz_tree_build.oz_tokens import enumerate_one_zoom_tokens
+from oz_tree_build.token_to_oz_tree_file_mapping import token_to_file_map
+
+__author__ = "David Ebbo"
+
+# Change this when the way the tokens are found changes, to scan all the files again
+TOKEN_MANIFEST_VERSION = 1
+
+def trim_tree(tree):
+    # Skip the comment block at the start of the file, if any
+    if '[' in tree:
+        tree = tree[tree.index(']')+1:]
+
+    # Trim any whitespace
+    tree = tree.strip()
+
+    # Strip the trailing semicolon, if the file isn't empty
+    if tree.endswith(';'):
+        tree = tree[:-1]
+
+    return tree
+
+def read_tree_file(file):
+    '''
+    Read and trim a tree file, or return None if it doesn't exist
+    '''
+    if not os.path.exists(file):
+        return None
+
+    with open(file, 'r', encoding="utf8") as stream:
+        return trim_tree(stream.read())
+
+def get_sub_file(result, oz_parts_folder, ot_parts_folder, file_exists):
+    '''
+    Find the file to expand a OneZoom token with. Returns the file, the mapping entry for
+    it if it's a OneZoom file, and whether its own tokens need to be expanded.
+    '''
+    # Check if OneZoom token has a base ott (e.g. 123 in foobar_ott123~456-789-111)
+    if 'base_ott' in result:
+        # It's an extracted Open Tree file, e.g. 123.phy
+        sub_file = os.path.join(ot_parts_folder, f'{result["base_ott"]}.phy')
+        if not file_exists(sub_file):
+            # Fall back to .nwk, which happens for additional copied files
+            sub_file = os.path.join(ot_parts_folder, f'{result["base_ott"]}.nwk')
+        return sub_file, None, False
+    else:
+        # Otherwise, it's a OneZoom file, e.g. AMORPHEA@ --> Amorphea.PHY
+        child_mapping_entry = token_to_file_map[result["full_name"]]
+        return os.path.join(oz_parts_folder, child_mapping_entry['file']), child_mapping_entry, True
+
+class TokenManifest:
+    '''
+    The tokens of the part files, loaded from (and saved to) manifest_file if it's given,
+    and otherwise only kept for the current run. It can be used from several threads.
+    '''
+    def __init__(self, manifest_file=None):
+        self.manifest_file = manifest_file
+        self.files = {}
+        self.include_graph = {}
+        self.lock = threading.Lock()
+
+        # The number of files scanned in this run, as opposed to found in the manifest
+        self.scanned_count = 0
+
+        if manifest_file and os.path.exists(manifest_file):
+            with open(manifest_file, 'r', encoding="utf8") as f:
+                manifest = json.load(f)
+            if manifest.get('version') == TOKEN_MANIFEST_VERSION:
+                self.files = manifest['files']
+                self.include_graph = manifest['include_graph']
+
+    def get_tokens(self, file, tree=None):
+        '''
+        The tokens of a part file, as returned by enumerate_one_zoom_tokens for its trimmed tree, or None if
+        the file doesn't exist. tree is the trimmed tree of the file, if the caller has already read it.
+        '''
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            return None
+
+        path = os.path.abspath(file)
+        with self.lock:
+            entry = self.files.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['tokens']
+
+        if tree is None:
+            tree = read_tree_file(file)
+
+        # Only the checksums of the saved manifests are ever compared
+        checksum = hashlib.sha256(tree.encode('utf-8')).hexdigest() if self.manifest_file else None
+        if entry and checksum and entry['checksum'] == checksum:
+            tokens = entry['tokens']
+        else:
+            tokens = list(enumerate_one_zoom_tokens(tree))
+            with self.lock:
+                self.scanned_count += 1
+
+        with self.lock:
+            self.files[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'checksum': checksum, 'tokens': tokens}
+        return tokens
+
+    def walk_include_graph(self, base_file, ot_parts_folder):
+        '''
+        Go through the include graph from the base file (whose folder has the OneZoom parts), and record it.
+        Returns the missing files, and the OneZoom tokens that aren't in token_to_file_map, by file.
+        '''
+        oz_parts_folder = os.path.dirname(base_file)
+        include_graph = {}
+        missing_files = []
+        unmapped_tokens = {}
+
+        files = [base_file]
+        while files:
+            file = files.pop()
+            path = os.path.abspath(file)
+            if path in include_graph:
+                continue
+
+            tokens = self.get_tokens(file)
+            if tokens is None:
+                missing_files.append(file)
+                include_graph[path] = None
+                continue
+
+            included_files = []
+            for result in tokens:
+                if 'base_ott' not in result and result['full_name'] not in token_to_file_map:
+                    unmapped_tokens.setdefault(file, []).append(result['full_name'])
+                    continue
+
+                sub_file, _, expand_nodes = get_sub_file(result, oz_parts_folder, ot_parts_folder, os.path.exists)
+                included_files.append(os.path.abspath(sub_file))
+                if expand_nodes:
+                    files.append(sub_file)
+                elif not os.path.exists(sub_file):
+                    missing_files.append(sub_file)
+            include_graph[path] = included_files
+
+        with self.lock:
+            self.include_graph = include_graph
+        return missing_files, unmapped_tokens
+
+    def check_include_graph(self, base_file, ot_parts_folder):
+        '''
+        Walk the include graph, warning about all the missing files at once, and raising an error listing
+        the unmapped tokens if there are any (build_oz_tree can't expand them)
+        '''
+        missing_files, unmapped_tokens = self.walk_include_graph(base_file, ot_parts_folder)
+        if missing_files:
+            logging.warning(f"{len(missing_files)} included files are missing, so their tokens will be kept as is: "
+                            + ", ".join(missing_files))
+        if unmapped_tokens:
+            raise ValueError("OneZoom tokens missing from token_to_file_map: " +
+                             "; ".join(f"{file}: {', '.join(tokens)}" for file, tokens in unmapped_tokens.items()))
+
+    def save(self):
+        '''
+        Save the manifest if it has a file, dropping the files that no longer exist
+        '''
+        if not self.manifest_file:
+            return
+
+        with self.lock:
+            files = {path: entry for path, entry in self.files.items() if os.path.exists(path)}
+            manifest = {'version': TOKEN_MANIFEST_VERSION, 'files': files, 'include_graph': self.include_graph}
+        with open(self.manifest_file + '.tmp', 'w', encoding="utf8") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+        logging.info(f"Token manifest: scanned {self.scanned_count} of {len(files)} files")
@@ -0,0 +1,345 @@
+'''
+Read tree files compressed with gzip, bzip2 or xz, as if they weren't compressed.
+
+The compression is detected from the first bytes of the file, so it works whatever the file is
+called, and on stdin. The decompression uses the codecs from the standard library, and streams
+the file rather than decompressing it all at once.
+
+Seeking in a compressed file normally means decompressing it again from the start. For gzip,
+a seek index can be built once and stored next to the file (the file name + .ozgzi), and the
+file is then opened with IndexedGzipFile, which jumps to the nearest seek point instead.
+
+From the command line, run for example:
+python3 compressed_files.py labelled_supertree_simplified_ottnames.tre.gz
+python3 compressed_files.py labelled_supertree_simplified_ottnames.tre --output labelled_supertree_simplified_ottnames.tre.gz
+'''
+
+'''
+The seek points are the starts of the gzip members. A gzip file can be made of several members,
+each compressed independently, which all gzip tools read back as a single file (bgzip does the
+same). The standard zlib module can't resume decompressing in the middle of a member, so a gzip
+file written as a single member (e.g. by the gzip command) only gets one seek point. Use --output
+to write a copy made of members of --member_size bytes (before compression), which costs a bit
+of compression ratio.
+
+The index is a binary file of little-endian int64s: a header with the magic, the gzip file size
+and mtime (ns), and the number of members, followed by the uncompressed offsets of the members,
+and their compressed offsets. Each list has an extra entry at the end, with the total sizes.
+'''
+
+import argparse
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+
+__author__ = "David Ebbo"
+
+GZIP_INDEX_MAGIC = b'OZGZI001'
+header_struct = struct.Struct('<8sqqq')
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MEMBER_SIZE = 4 * 1024 * 1024
+
+# The magic numbers of the supported formats, and how to open them (from a file name or a binary stream)
+compression_formats = {
+    'gzip': (b'\x1f\x8b', gzip.open),
+    'bz2': (b'BZh', bz2.open),
+    'xz': (b'\xfd7zXZ\x00', lzma.open),
+}
+
+def get_compression(stream):
+    '''
+    The compression format of a binary stream ('gzip', 'bz2' or 'xz'), or None if it isn't compressed.
+    This looks at the first bytes without consuming them, so the stream must support peek or seek.
+    '''
+    try:
+        if hasattr(stream, 'peek'):
+            head = stream.peek(8)
+        else:
+            position = stream.tell()
+            head = stream.read(8)
+            stream.seek(position)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+    for compression, (magic, _) in compression_formats.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+def is_compressed_stream(stream):
+    '''
+    Whether the stream decompresses a file with the standard library modules. Seeking backwards
+    in such a stream means decompressing again from the start, and its fileno() is the one of
+    the compressed file, so it can't be memory mapped.
+    '''
+    return isinstance(stream, (gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile))
+
+def decompress_stream(stream):
+    '''
+    Return a stream decompressing the given one if it's compressed, or the stream itself otherwise.
+    Text streams (e.g. from argparse.FileType('r')) give a decompressing text stream.
+    '''
+    is_text = isinstance(stream, io.TextIOBase)
+    binary_stream = stream.buffer if is_text else stream
+    compression = get_compression(binary_stream)
+    if not compression:
+        return stream
+
+    decompressed_stream = compression_formats[compression][1](binary_stream)
+    return io.TextIOWrapper(decompressed_stream, encoding=stream.encoding) if is_text else decompressed_stream
+
+def open_tree_file(file, mode='rb'):
+    '''
+    Open a tree file for reading ('rb' or 'r' mode), decompressing it if needed. A gzip file
+    with an up to date seek index is opened with IndexedGzipFile, so that seeking in it is fast.
+    '''
+    with open(file, 'rb') as f:
+        compression = get_compression(f)
+
+    if compression == 'gzip' and (index := GzipSeekIndex.load(file)):
+        stream = io.BufferedReader(IndexedGzipFile(file, index), DEFAULT_CHUNK_SIZE)
+    elif compression:
+        stream = compression_formats[compression][1](file)
+    else:
+        stream = open(file, 'rb')
+    return io.TextIOWrapper(stream, encoding="utf8") if mode == 'r' else stream
+
+def get_gzip_index_file(gz_file):
+    return gz_file + '.ozgzi'
+
+class GzipSeekIndex:
+    '''
+    The uncompressed and compressed offsets of the members of a gzip file, which are the points
+    where decompression can start. See build_gzip_index.
+    '''
+    def __init__(self, uncompressed_offsets, compressed_offsets, gz_size=None, gz_mtime_ns=None):
+        self.uncompressed_offsets = uncompressed_offsets
+        self.compressed_offsets = compressed_offsets
+        self.gz_size = gz_size
+        self.gz_mtime_ns = gz_mtime_ns
+
+    def __len__(self):
+        return len(self.uncompressed_offsets) - 1
+
+    @property
+    def uncompressed_size(self):
+        return self.uncompressed_offsets[-1]
+
+    def find_member(self, offset):
+        '''The member containing the uncompressed offset (the last one if it's past the end)'''
+        return min(max(bisect_right(self.uncompressed_offsets, offset) - 1, 0), len(self) - 1)
+
+    def save(self, gz_file, index_file=None):
+        index_file = index_file or get_gzip_index_file(gz_file)
+        stat = os.stat(gz_file)
+
+        # Write to a temporary file first, so that an interrupted build doesn't leave a broken index
+        with open(index_file + '.tmp', 'wb') as f:
+            f.write(header_struct.pack(GZIP_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(self)))
+            self.uncompressed_offsets.tofile(f)
+            self.compressed_offsets.tofile(f)
+        os.replace(index_file + '.tmp', index_file)
+
+    @classmethod
+    def load(cls, gz_file, index_file=None):
+        '''
+        Load the seek index for the gzip file, or return None if it doesn't exist or is stale
+        '''
+        index_file = index_file or get_gzip_index_file(gz_file)
+        if not os.path.exists(index_file):
+            return None
+
+        with open(index_file, 'rb') as f:
+            magic, gz_size, gz_mtime_ns, member_count = header_struct.unpack(f.read(header_struct.size))
+            if magic != GZIP_INDEX_MAGIC:
+                raise ValueError(f"{index_file} is not a gzip seek index file")
+            uncompressed_offsets, compressed_offsets = array('q'), array('q')
+            uncompressed_offsets.fromfile(f, member_count + 1)
+            compressed_offsets.fromfile(f, member_count + 1)
+
+        # Unlike the tree index, there's no checksum, since checking it would take about as long as building the index again
+        stat = os.stat(gz_file)
+        if stat.st_size != gz_size or stat.st_mtime_ns != gz_mtime_ns:
+            logging.warning(f"Ignoring stale gzip seek index {index_file}: the gzip file has changed")
+            return None
+
+        return cls(uncompressed_offsets, compressed_offsets, gz_size, gz_mtime_ns)
+
+def build_gzip_index(gz_file, index_file=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Decompress the whole gzip file once to find its members, and write the seek index for it
+    '''
+    uncompressed_offsets, compressed_offsets = array('q', [0]), array('q', [0])
+    uncompressed_size = compressed_size = 0
+
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(gz_file, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            while chunk:
+                if decompressor.eof:
+                    # The previous member ended, so this is the start of a new one
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    uncompressed_offsets.append(uncompressed_size)
+                    compressed_offsets.append(compressed_size)
+
+                uncompressed_size += len(decompressor.decompress(chunk))
+                compressed_size += len(chunk) - len(decompressor.unused_data)
+                chunk = decompressor.unused_data
+
+    if not decompressor.eof:
+        raise EOFError(f"{gz_file} is truncated")
+
+    uncompressed_offsets.append(uncompressed_size)
+    compressed_offsets.append(compressed_size)
+    index = GzipSeekIndex(uncompressed_offsets, compressed_offsets)
+    index.save(gz_file, index_file)
+
+    logging.info(f"Indexed {len(index)} gzip members in {gz_file}")
+    if len(index) == 1 and uncompressed_size > DEFAULT_MEMBER_SIZE:
+        logging.warning(f"{gz_file} is a single gzip member, so the index can't speed up seeking in it. "
+                        "Write a copy made of several members with --output.")
+    return index
+
+def write_seekable_gzip(input_file, gz_file, member_size=DEFAULT_MEMBER_SIZE, compresslevel=9):
+    '''
+    Write a (possibly compressed) file as a gzip file made of independent members of member_size
+    bytes (before compression), along with its seek index
+    '''
+    uncompressed_offsets, compressed_offsets = array('q', [0]), array('q', [0])
+
+    with open_tree_file(input_file) as input_stream, open(gz_file + '.tmp', 'wb') as f:
+        # An empty file still gets one (empty) member, to be a valid gzip file
+        data = input_stream.read(member_size)
+        while True:
+            f.write(gzip.compress(data, compresslevel=compresslevel, mtime=0))
+            uncompressed_offsets.append(uncompressed_offsets[-1] + len(data))
+            compressed_offsets.append(f.tell())
+            if not (data := input_stream.read(member_size)):
+                break
+    os.replace(gz_file + '.tmp', gz_file)
+
+    index = GzipSeekIndex(uncompressed_offsets, compressed_offsets)
+    index.save(gz_file)
+    logging.info(f"Wrote {len(index)} gzip members to {gz_file}")
+    return index
+
+class IndexedGzipFile(io.RawIOBase):
+    '''
+    Reads a gzip file with a seek index. Seeking starts decompressing at the member containing
+    the new position, or carries on with the current member when seeking forward within it.
+    This is a raw stream, so it's normally wrapped in an io.BufferedReader (see open_tree_file).
+    '''
+    def __init__(self, gz_file, index, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.file = open(gz_file, 'rb')
+        self.name = gz_file
+        self.index = index
+        self.chunk_size = chunk_size
+
+        self.position = 0
+        self.member = None
+        self.decompressor = None
+
+        # The decompressed data not returned yet, and its offset in the uncompressed file
+        self.pending = b''
+        self.pending_offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.index.uncompressed_size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        # Keep decompressing the current member if the new position is further on in it
+        if self.member is not None and (offset < self.pending_offset or self.index.find_member(offset) != self.member):
+            self.member = None
+        self.position = offset
+        return offset
+
+    def start_member(self, member):
+        self.member = member
+        self.file.seek(self.index.compressed_offsets[member])
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.pending = b''
+        self.pending_offset = self.index.uncompressed_offsets[member]
+
+    def decompress_more(self):
+        '''Decompress the next piece of the file, or return b'' at the end of it'''
+        while True:
+            if self.decompressor.eof:
+                # Move on to the next member, starting with the data we read past the end of this one
+                data = self.decompressor.unused_data or self.file.read(self.chunk_size)
+                if not data:
+                    return b''
+                self.member += 1
+                self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                data = self.decompressor.unconsumed_tail or self.file.read(self.chunk_size)
+                if not data:
+                    raise EOFError(f"{self.name} is truncated")
+
+            if decompressed := self.decompressor.decompress(data, self.chunk_size):
+                return decompressed
+
+    def readinto(self, buffer):
+        if self.member is None:
+            self.start_member(self.index.find_member(self.position))
+
+        # Skip the decompressed data before the position
+        while self.pending_offset + len(self.pending) <= self.position:
+            self.pending_offset += len(self.pending)
+            self.pending = self.decompress_more()
+            if not self.pending:
+                return 0
+
+        start = self.position - self.pending_offset
+        size = min(len(buffer), len(self.pending) - start)
+        buffer[:size] = self.pending[start:start + size]
+        self.position += size
+        return size
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbosity', '-v', action='count', default=0, help='verbosity level: output extra non-essential info')
+    parser.add_argument('file', help='The gzip file to index, or with --output, the (possibly compressed) file to copy')
+    parser.add_argument('--output', '-o', help='write a copy of the file as a seekable gzip file, and index that instead')
+    parser.add_argument('--member_size', type=int, default=DEFAULT_MEMBER_SIZE, help='the size of the gzip members written with --output, before compression')
+    args = parser.parse_args()
+
+    if args.verbosity==0:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    elif args.verbosity==1:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbosity==2:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+
+    if args.output:
+        write_seekable_gzip(args.file, args.output, args.member_size)
+    else:
+        build_gzip_index(args.file)
+
+if __name__ == '__main__':
+    main()
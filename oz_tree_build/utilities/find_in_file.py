@@ -2,22 +2,106 @@
 Look for regex matches within files with very long lines (unlike grep, which matches entire lines).
 The challenge is that the regex engine can't see the entire file at once, so we need to read the file in
 chunks and stitch the chunks together before passing them to the regex engine.
+
+Files compressed with gzip, bzip2 or xz are decompressed as they are read.
+
+To look for many names or otts at once, put them in a file (one per line) and pass it with
+--patterns_file. They are all found in a single pass over each file, and each match is reported
+with the pattern it matched. Several files can be searched in parallel with --processes.
+
+With --mmap, an uncompressed file is memory mapped and the regex runs directly over it, rather than
+over copies of the file chunks. A single file can then also be split into byte ranges searched in
+parallel with --processes. The offsets are byte offsets, which are the same as the character offsets
+of the default mode for ASCII files.
+
+For example:
+python3 find_in_file.py 'Tupaia_[a-z]*' tree.tre
+python3 find_in_file.py --patterns_file otts.txt --whole_names -j 4 tree1.tre tree2.tre.gz
+python3 find_in_file.py --mmap -j 8 'Tupaia_[a-z]*' tree.tre
+'''
+
+'''
+The chunks are searched the same way in both modes: from the start of each chunk, up to some overlap
+past its end, keeping the matches that start in the chunk. By default the overlap is the next chunk,
+which gives the same matches in both modes. With --mmap, the overlap is --max_match_length, and it
+is an explicit guarantee: any match up to that length is found whole. Since there's no copying, the
+chunks can be much larger with --mmap, e.g. -c 16000000. A single file is split into ranges of whole
+chunks, so the processes find the same matches as a single scan.
 '''
 
 import argparse
+import mmap
+import multiprocessing
+import os
 import re
 import sys
 
+from oz_tree_build.utilities.compressed_files import decompress_stream, get_compression, open_tree_file
+
 __author__ = "David Ebbo"
 
+
 def chunks_from_file(f, chunk_size):
     while chunk := f.read(chunk_size):
         yield chunk
 
+def literal_patterns_regex(patterns, whole_names=False):
+    '''
+    Compile a regex matching any of the literal patterns, preferring the longest one when several
+    match at the same position. The patterns are merged into a trie (e.g. (?:Tupaia(?:_tana)?|Homo)),
+    so that the regex engine doesn't have to try each of them in turn at each position.
+
+    With whole_names, the patterns only match if they're not preceded or followed by a letter or a digit.
+
+    The patterns made of digits are ott numbers, e.g. 770315, which match the number of an ott, as in
+    Homo_sapiens_ott770315, but not part of a longer number, e.g. ott7703150. With whole_names, they
+    can also be preceded by 'ott'.
+    '''
+    def trie_regex(patterns):
+        trie = {}
+        for pattern in patterns:
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        return node_regex(trie)
+
+    def node_regex(node):
+        alternatives = [re.escape(char) + node_regex(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')' + ('?' if '' in node else '')
+
+    names = [pattern for pattern in patterns if not pattern.isdigit()]
+    otts = [pattern for pattern in patterns if pattern.isdigit()]
+
+    alternatives = []
+    if names:
+        regex = trie_regex(names)
+        alternatives.append(f'(?<![^\\W_])(?:{regex})(?![^\\W_])' if whole_names else regex)
+    if otts:
+        regex = trie_regex(otts)
+        alternatives.append(f'(?:(?<=ott)|(?<![^\\W_]))(?:{regex})(?![^\\W_])' if whole_names else f'(?<![0-9])(?:{regex})(?![0-9])')
+    return re.compile(alternatives[0] if len(alternatives) == 1 else '|'.join(f'(?:{regex})' for regex in alternatives))
+
 def get_matches(chunk_iterator, regex, window_size):
+    '''
+    Find the matches of the regex (a string or a compiled regex) in the chunks, yielding the offset
+    of each match, and the match with window_size characters on each side of it
+    '''
+    for index, matched_text, string_to_return in get_matches_with_text(chunk_iterator, regex, window_size):
+        yield (index, string_to_return)
+
+def get_matches_with_text(chunk_iterator, regex, window_size):
+    '''
+    Same as get_matches, but also yields the text that matched, e.g. which pattern of a literal_patterns_regex
+    '''
+    regex = re.compile(regex)
     overall_index = 0
 
-    chunk = next(chunk_iterator)
+    chunk = next(chunk_iterator, "")
 
     # The last window_size characters from the previous chunk, used to stitch together matches that span chunks
     pre_string = ""
@@ -32,7 +116,7 @@ def get_matches(chunk_iterator, regex, window_size):
         # This assumes that the chunk size is larger than any match we want to find
         current_string = chunk + next_chunk
 
-        for m in re.finditer(regex, current_string):
+        for m in regex.finditer(current_string):
             # If the match is in the next chunk, we'll find it in the next iteration
             if m.start() >= len(chunk):
                 break
@@ -47,7 +131,7 @@ def get_matches(chunk_iterator, regex, window_size):
             if chars_needed_from_pre_string > 0:
                 string_to_return = pre_string[-chars_needed_from_pre_string:] + string_to_return
 
-            yield (overall_index + m.start(), string_to_return)
+            yield (overall_index + m.start(), m.group(), string_to_return)
         
         overall_index += len(chunk)
 
@@ -56,16 +140,125 @@ def get_matches(chunk_iterator, regex, window_size):
 
         chunk = next_chunk
 
+def to_bytes_regex(regex):
+    '''The bytes version of a regex (a string or a compiled regex), for searching memory mapped files'''
+    pattern, flags = (regex.pattern, regex.flags & ~re.UNICODE) if isinstance(regex, re.Pattern) else (regex, 0)
+    return re.compile(pattern.encode('utf-8') if isinstance(pattern, str) else pattern, flags)
+
+def map_file(file):
+    with open(file, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return b''
+
+def get_mapped_matches(file, regex, window_size, chunk_size, max_match_length=None, processes=1):
+    '''
+    Same as get_matches_with_text over the chunks of an (uncompressed) file, but memory maps the file, and runs
+    the regex directly over it. The matches starting in each chunk are searched up to max_match_length bytes past
+    its end (by default, the chunk size, which gives the same matches as get_matches_with_text, for ASCII files,
+    except that lookbehinds can see the end of the previous chunk).
+    With more than one process, the file is split into ranges of chunks searched in parallel.
+    '''
+    regex = to_bytes_regex(regex)
+    max_match_length = chunk_size if max_match_length is None else max_match_length
+    file_size = os.path.getsize(file)
+
+    if processes <= 1:
+        matches = generate_mapped_matches(map_file(file), regex, window_size, 0, file_size, chunk_size, max_match_length)
+    else:
+        # A few whole chunks per range, so that the work stays balanced if some are slower
+        range_size = max(-(-file_size // chunk_size // (processes * 4)), 1) * chunk_size
+        arguments = [(file, regex, window_size, range_start, min(range_start + range_size, file_size), chunk_size, max_match_length)
+                     for range_start in range(0, file_size, range_size)]
+        with multiprocessing.Pool(processes) as pool:
+            matches = [match for range_matches in pool.imap(find_mapped_matches_in_range, arguments) for match in range_matches]
+
+    for start, matched_bytes, window in matches:
+        yield (start, matched_bytes.decode('utf-8', errors='replace'), window.decode('utf-8', errors='replace'))
+
+def find_mapped_matches_in_range(arguments):
+    '''Worker for get_mapped_matches, searching the chunks in a byte range of the file'''
+    file, *arguments = arguments
+    return list(generate_mapped_matches(map_file(file), *arguments))
+
+def generate_mapped_matches(mapped_file, regex, window_size, range_start, range_end, chunk_size, max_match_length):
+    for chunk_start in range(range_start, range_end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, range_end)
+        for m in regex.finditer(mapped_file, chunk_start, chunk_end + max_match_length):
+            # The matches further on are found with the next chunk
+            if m.start() >= chunk_end:
+                break
+            window = mapped_file[max(0, m.start() - window_size):m.end() + window_size]
+            yield (m.start(), m.group(), window)
+
+def find_in_files(files, regex, window_size, chunk_size, processes=1, use_mmap=False, max_match_length=None):
+    '''
+    Search several (possibly compressed) files, in a pool of processes if processes > 1. Yields the
+    file name and the list of (index, matched text, match with its window) for each file, in order.
+    With use_mmap, the uncompressed files are searched with get_mapped_matches, and a single file
+    is split into byte ranges searched by the processes.
+    '''
+    if use_mmap and len(files) == 1 and processes > 1 and not is_compressed_file(files[0]):
+        yield files[0], get_mapped_matches(files[0], regex, window_size, chunk_size, max_match_length, processes)
+        return
+
+    arguments = [(file, regex, window_size, chunk_size, use_mmap, max_match_length) for file in files]
+    if processes > 1 and len(files) > 1:
+        with multiprocessing.Pool(min(processes, len(files))) as pool:
+            yield from zip(files, pool.imap(find_in_file, arguments))
+    else:
+        yield from zip(files, map(find_in_file, arguments))
+
+def is_compressed_file(file):
+    with open(file, 'rb') as f:
+        return get_compression(f) is not None
+
+def find_in_file(arguments):
+    '''Worker for find_in_files, searching a single file'''
+    file, regex, window_size, chunk_size, use_mmap, max_match_length = arguments
+    if use_mmap and not is_compressed_file(file):
+        return list(get_mapped_matches(file, regex, window_size, chunk_size, max_match_length))
+    with open_tree_file(file, 'r') as f:
+        return list(get_matches_with_text(chunks_from_file(f, chunk_size), regex, window_size))
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('regex', help='The expression to search for')
-    parser.add_argument('file', type=argparse.FileType('r'), nargs='?', default=sys.stdin, help='The input file')
+    # With --patterns_file, there's no regex, so the first positional argument is a file
+    parser.add_argument('regex', nargs='?', help='The expression to search for (unless --patterns_file is given)')
+    parser.add_argument('files', nargs='*', help='The input files (default: stdin)')
+    parser.add_argument('--patterns_file', '-p', help='a file with literal names or ott numbers to search for, one per line, instead of the regex')
+    parser.add_argument('--whole_names', action='store_true', help='with --patterns_file, only match patterns that are not preceded or followed by a letter or digit (or for ott numbers, preceded by ott)')
+    parser.add_argument('--processes', '-j', type=int, default=1, help='the number of processes searching the files (or with --mmap, the parts of a single file) in parallel')
+    parser.add_argument('--mmap', action='store_true', help='memory map the uncompressed files, and run the regex directly over them, reporting byte offsets')
+    parser.add_argument('--max_match_length', type=int, help='with --mmap, how far past the end of each chunk to search for the matches starting in it (default: the chunk size)')
     parser.add_argument('--window_size', '-w', type=int, default=100, help='the number of characters to display before and after each match')
     parser.add_argument('--chunk_size', '-c', type=int, default=10000, help='the size of the chunks to read from the file')
-    args = parser.parse_args()
+    # Intermixed, so that the files can come after options, even though the regex is optional
+    args = parser.parse_intermixed_args()
+
+    files = args.files
+    if args.patterns_file:
+        files = ([args.regex] if args.regex else []) + files
+        with open(args.patterns_file, 'r', encoding="utf8") as f:
+            regex = literal_patterns_regex({line.strip() for line in f if line.strip()}, args.whole_names)
+    elif args.regex:
+        regex = re.compile(args.regex)
+    else:
+        parser.error("either a regex or --patterns_file is needed")
+
+    if files:
+        results = find_in_files(files, regex, args.window_size, args.chunk_size, args.processes, args.mmap, args.max_match_length)
+    else:
+        results = [(None, get_matches_with_text(chunks_from_file(decompress_stream(sys.stdin), args.chunk_size), regex, args.window_size))]
 
-    for index, match in get_matches(chunks_from_file(args.file, args.chunk_size), args.regex, args.window_size):
-        print(f"{index}: {match}")
+    for file, matches in results:
+        for index, matched_text, match in matches:
+            # Keep the single regex output as it was, and prefix it with what's needed to tell the matches apart otherwise
+            prefix = f"{file}:" if len(files) > 1 else ""
+            prefix += f"[{matched_text}] " if args.patterns_file else ""
+            print(f"{prefix}{index}: {match}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,149 @@
+'''
+Record where the time of a run goes, for the --metrics option of the build and extraction tools:
+the time spent in each phase, counters like the bytes read and written or the nodes parsed, the
+peak RSS, and for build_oz_tree, a breakdown per include file.
+'''
+
+'''
+The tools take an optional Metrics object (their Python hook), which they fill in as they run, and
+from the command line --metrics out.json saves it as JSON, e.g.:
+{
+  "total_seconds": 12.5,
+  "peak_rss_mb": 812.3,
+  "phases": {"read": 0.4, "extract": 11.2, "write": 0.9},
+  "thread_seconds": {"read": 0.4, "extract": 11.2, "write": 3.1},
+  "counts": {"nodes parsed": 10452301, "bytes scanned": 1043204311, "files written": 412},
+  "files": {"oz/Amorphea.PHY": {"seconds": 3.2, "self_seconds": 0.1, "bytes": 2051, "tokens": 12}}
+}
+The phases are wall-clock times: how long each phase was running, in one thread or more. Phases can
+overlap each other (e.g. the writes run while the trees are being extracted), so their sum can be more
+than total_seconds. thread_seconds has the time of each phase added up over the threads running it.
+'''
+
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+__author__ = "David Ebbo"
+
+# Marks the end of the iterable in Metrics.timed_iter
+_end = object()
+
+def get_peak_rss_mb():
+    '''The peak resident memory of this process in MB, or None if it's not available'''
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux, but in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+class Metrics:
+    '''
+    The time spent in each phase of a run, and its counters. Phases can overlap, e.g. the writes run
+    while the trees are being extracted. The seconds of a phase are the wall-clock time during which it
+    was running in any thread, and its thread_seconds the total over the threads. All the methods can be
+    called from several threads.
+    '''
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.seconds = {}
+        self.thread_seconds = {}
+        # The number of threads in each phase, and since when the phase has been running
+        self.active_counts = {}
+        self.active_since = {}
+        self.counts = {}
+        self.files = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, phase):
+        with self.lock:
+            start = time.perf_counter()
+            if not self.active_counts.get(phase):
+                self.active_since[phase] = start
+            self.active_counts[phase] = self.active_counts.get(phase, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                end = time.perf_counter()
+                self.thread_seconds[phase] = self.thread_seconds.get(phase, 0) + end - start
+                self.active_counts[phase] -= 1
+                if not self.active_counts[phase]:
+                    self.seconds[phase] = self.seconds.get(phase, 0) + end - self.active_since[phase]
+
+    def timed_iter(self, iterable, phase):
+        '''
+        Iterate over an iterable, e.g. a generator doing the work of a phase, timing how long it takes to
+        get each item under the phase, but not what the caller does with it
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.timed(phase):
+                item = next(iterator, _end)
+            if item is _end:
+                return
+            yield item
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counts[counter] = self.counts.get(counter, 0) + value
+
+    def count_file(self, file, **values):
+        '''Add to the values recorded for a file, e.g. count_file('Amorphea.PHY', seconds=1.5, tokens=3)'''
+        with self.lock:
+            file_values = self.files.setdefault(file, {})
+            for name, value in values.items():
+                file_values[name] = file_values.get(name, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            result = {'total_seconds': time.perf_counter() - self.start_time, 'peak_rss_mb': get_peak_rss_mb(),
+                      'phases': dict(self.seconds), 'thread_seconds': dict(self.thread_seconds),
+                      'counts': dict(self.counts)}
+            if self.files:
+                result['files'] = {file: dict(values) for file, values in self.files.items()}
+        return result
+
+    def save(self, file):
+        with open(file, 'w', encoding="utf8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self):
+        logging.info("Phase timings: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.seconds.items()))
+        if self.counts:
+            logging.info("Counts: " + ", ".join(f"{counter} {value}" for counter, value in self.counts.items()))
+
+class MeteredStream:
+    '''
+    Minimal output stream that counts the characters written to another stream, and the time spent writing them
+    '''
+    def __init__(self, stream, metrics, counter='characters written', phase='write'):
+        self.stream = stream
+        self.metrics = metrics
+        self.counter = counter
+        self.phase = phase
+
+    def write(self, text):
+        self.metrics.count(self.counter, len(text))
+        with self.metrics.timed(self.phase):
+            return self.stream.write(text)
+
+    def flush(self):
+        with self.metrics.timed(self.phase):
+            return self.stream.flush()
+
+    @property
+    def buffer(self):
+        '''The binary stream under the text stream, also metered, or None if there isn't one'''
+        buffer = getattr(self.stream, 'buffer', None)
+        return MeteredStream(buffer, self.metrics, 'bytes written', self.phase) if buffer is not None else None
@@ -0,0 +1,68 @@
+'''
+Unit tests for analyze_tree
+'''
+
+import random
+
+import pytest
+
+from oz_tree_build.newick.analyze_tree import analyze_tree
+from oz_tree_build.utilities.metrics import Metrics
+
+test_tree = "((A_ott1:1,B_b:0.5)C_ott3:2,D_d_d,(E,F,G)H)Root;"
+
+def test_stats():
+    stats = analyze_tree(test_tree)
+
+    assert stats == {
+        'nodes': 9,
+        'tips': 6,
+        'internal_nodes': 3,
+        'max_depth': 2,
+        'mean_tip_depth': 11 / 6,
+        'tip_depths': {'1': 1, '2': 5},
+        'child_counts': {'2': 1, '3': 2},
+        'edge_lengths': {'count': 3, 'total': 3.5, 'min': 0.5, 'max': 2.0, 'mean': 3.5 / 3,
+                         'histogram': {'zero': 6, '1e-1': 1, '1e0': 2}},
+        'ott': {'nodes': 2, 'tips': 1, 'internal_nodes': 1},
+        'name_kinds': {'higher taxa': 7, 'species': 1, 'subspecies': 1},
+        'largest_clades': [{'taxon': 'Root', 'ott': None, 'tips': 6, 'depth': 0},
+                           {'taxon': 'H', 'ott': None, 'tips': 3, 'depth': 1},
+                           {'taxon': 'C', 'ott': '3', 'tips': 2, 'depth': 1}],
+    }
+
+def test_bytes_tree():
+    assert analyze_tree(test_tree.encode()) == analyze_tree(test_tree)
+
+def test_top_clades():
+    # The clades with the same number of tips are listed in tree order
+    tree = "((A,B)X,(C,D)Y,(E,F)Z)Root;"
+    clades = analyze_tree(tree, top_clade_count=3)['largest_clades']
+    assert [clade['taxon'] for clade in clades] == ['Root', 'X', 'Y']
+
+def test_parallel_same_as_serial_on_random_tree():
+    # Build a random tree, with polytomies and unnamed nodes
+    rng = random.Random(42)
+    clades = [f"T{i}_ott{i}:{rng.uniform(0, 10):.3f}" for i in range(2000)]
+    while len(clades) > 1:
+        child_count = min(rng.choice([1, 2, 2, 3, 8]), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        name = f"N_{len(clades)}" if rng.random() < 0.8 else ''
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])}){name}:{rng.uniform(0, 10):.3f}"]
+    tree = clades[0] + ';'
+
+    expected = analyze_tree(tree, top_clade_count=20)
+    for workers in [2, 4, 8]:
+        for newick_tree in [tree, tree.encode()]:
+            stats = analyze_tree(newick_tree, workers=workers, top_clade_count=20)
+
+            # The edge lengths are added in a different order
+            for field in ('total', 'mean'):
+                assert stats['edge_lengths'].pop(field) == pytest.approx(expected['edge_lengths'][field])
+            assert stats == {**expected, 'edge_lengths': {field: value for field, value in expected['edge_lengths'].items()
+                                                          if field not in ('total', 'mean')}}
+
+def test_metrics():
+    metrics = Metrics()
+    analyze_tree(test_tree.encode(), metrics=metrics)
+    assert metrics.counts == {'nodes parsed': 9, 'bytes scanned': len(test_tree)}
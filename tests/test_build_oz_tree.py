@@ -0,0 +1,179 @@
+'''
+Unit tests for build_oz_tree
+'''
+
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from oz_tree_build.build_oz_tree import TreeFilePrefetcher, build_oz_tree
+from oz_tree_build.token_manifest import TokenManifest
+from oz_tree_build.utilities.metrics import Metrics
+
+def create_parts(tmp_path):
+    oz_parts_folder = tmp_path / "oz"
+    ot_parts_folder = tmp_path / "ot"
+    oz_parts_folder.mkdir()
+    ot_parts_folder.mkdir()
+
+    (oz_parts_folder / "Base.PHY").write_text("[A comment]\n((AMORPHEA@,Tupaia_ott123@:5)Root_A,Missing_ott999@:2,X);\n")
+    (oz_parts_folder / "Amorphea.PHY").write_text("(Camelidae_ott456~-10-11@,Aa:1,Ab:2)Amorphea_last:7;")
+    (ot_parts_folder / "123.phy").write_text("  (T1,T2)Tupaia_ott123:3;\n")
+    (ot_parts_folder / "456.nwk").write_text("((C1,C2)Camelus,C3)Camelidae_ott456:4;")
+    return str(oz_parts_folder / "Base.PHY"), str(ot_parts_folder)
+
+def test_build(tmp_path):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    output = io.StringIO()
+    build_oz_tree(base_file, ot_parts_folder, output)
+
+    assert output.getvalue() == "(((((C1,C2)Camelus,C3)Camelidae_ott456:4,Aa:1,Ab:2)Amorphea_last:50,(T1,T2)Tupaia_ott123:3)Root_A,Missing_ott999@:2,X)"
+
+def test_parallel_build_same_as_serial(tmp_path):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    expected = io.StringIO()
+    build_oz_tree(base_file, ot_parts_folder, expected)
+
+    for jobs in [2, 8]:
+        output = io.StringIO()
+        build_oz_tree(base_file, ot_parts_folder, output, jobs=jobs)
+        assert output.getvalue() == expected.getvalue()
+
+def test_read_ahead_is_bounded(tmp_path):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    expected = io.StringIO()
+    build_oz_tree(base_file, ot_parts_folder, expected)
+
+    for read_ahead in [1, 2]:
+        output = io.StringIO()
+        build_oz_tree(base_file, ot_parts_folder, output, jobs=4, read_ahead=read_ahead)
+        assert output.getvalue() == expected.getvalue()
+
+    # Reading the base file queues the 3 files it includes, and then the one Amorphea.PHY includes,
+    # but only 2 of them are read until the build uses them
+    with ThreadPoolExecutor(4) as executor:
+        prefetcher = TreeFilePrefetcher(executor, os.path.dirname(base_file), ot_parts_folder, TokenManifest(), 2)
+        prefetcher.prefetch(base_file, expand_nodes=True)
+        prefetcher.read_tree(base_file)
+    assert len(prefetcher.futures) == 2
+    assert len(prefetcher.queued_files) >= 1
+
+def test_build_cache(tmp_path, caplog):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+    expected = io.StringIO()
+    build_oz_tree(base_file, ot_parts_folder, expected)
+
+    def build_with_cache(jobs=1):
+        caplog.clear()
+        output = io.StringIO()
+        with caplog.at_level(logging.INFO):
+            build_oz_tree(base_file, ot_parts_folder, output, jobs=jobs, cache_dir=cache_dir)
+        return output.getvalue(), [record.message for record in caplog.records if record.message.startswith("Build cache")]
+
+    assert build_with_cache() == (expected.getvalue(), ["Build cache: 0 hits, 2 misses"])
+
+    # Each expansion is only stored once, the base one referring to the Amorphea one
+    cached_text = ''.join(open(os.path.join(cache_dir, file)).read() for file in os.listdir(cache_dir) if file.endswith('.nwk'))
+    assert len(cached_text) == len(expected.getvalue())
+
+    assert build_with_cache() == (expected.getvalue(), ["Build cache: 1 hits, 0 misses"])
+    assert build_with_cache(jobs=4) == (expected.getvalue(), ["Build cache: 1 hits, 0 misses"])
+
+    # Changing a file only included by the base file doesn't expand Amorphea.PHY again
+    with open(os.path.join(ot_parts_folder, "123.phy"), "w", encoding="utf8") as f:
+        f.write("(T1,T2,Té)Tupaia_ott123:3;")
+    output, messages = build_with_cache()
+    expected_output = expected.getvalue().replace("(T1,T2)", "(T1,T2,Té)")
+    assert output == expected_output
+    assert messages == ["Build cache: 1 hits, 1 misses"]
+
+    # With an output file, the cached expansions are copied as bytes
+    output_file = tmp_path / "output.tre"
+    caplog.clear()
+    with open(output_file, "w", encoding="utf8") as f, caplog.at_level(logging.INFO):
+        f.write("[")
+        build_oz_tree(base_file, ot_parts_folder, f, cache_dir=cache_dir)
+        f.write("]")
+    assert output_file.read_text(encoding="utf8") == "[" + expected_output + "]"
+    assert [record.message for record in caplog.records if record.message.startswith("Build cache")] == ["Build cache: 1 hits, 0 misses"]
+
+    # Only the cached expansions used by the last build are kept
+    assert len([file for file in os.listdir(cache_dir) if file.endswith('.nwk')]) == 2
+
+def test_metrics(tmp_path):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    output = io.StringIO()
+    metrics = Metrics()
+    build_oz_tree(base_file, ot_parts_folder, output, metrics=metrics)
+
+    # The characters read are those of the trimmed trees
+    result = metrics.to_dict()
+    assert result['counts'] == {'files read': 4, 'files missing': 1, 'tokens expanded': 4, 'files scanned for tokens': 2,
+                                'characters read': 166, 'characters written': len(output.getvalue())}
+    assert set(result['phases']) == {'check include graph', 'read', 'scan tokens', 'write'}
+
+    # Each file gets its own time, and the time of a file includes the time of the files it includes
+    files = result['files']
+    amorphea_file = os.path.join(os.path.dirname(base_file), "Amorphea.PHY")
+    assert files[amorphea_file]['tokens'] == 1
+    assert files[base_file]['seconds'] >= files[amorphea_file]['seconds'] + files[base_file]['self_seconds'] - 1e-9
+    assert set(files[os.path.join(ot_parts_folder, "999.nwk")]) == {'seconds', 'self_seconds'}
+
+def test_token_manifest(tmp_path):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    manifest_file = str(tmp_path / "tokens.json")
+    expected = io.StringIO()
+    build_oz_tree(base_file, ot_parts_folder, expected)
+
+    def build_with_manifest():
+        output = io.StringIO()
+        token_manifest = TokenManifest(manifest_file)
+        build_oz_tree(base_file, ot_parts_folder, output, token_manifest=token_manifest)
+        return output.getvalue(), token_manifest
+
+    assert build_with_manifest()[0] == expected.getvalue()
+    output, token_manifest = build_with_manifest()
+    assert (output, token_manifest.scanned_count) == (expected.getvalue(), 0)
+
+    # Touching a file, or changing it without changing its tree, doesn't scan it again
+    amorphea_file = os.path.join(os.path.dirname(base_file), "Amorphea.PHY")
+    os.utime(amorphea_file, ns=(0, 0))
+    assert build_with_manifest()[1].scanned_count == 0
+    with open(amorphea_file, 'a') as f:
+        f.write("\n")
+    assert build_with_manifest()[1].scanned_count == 0
+
+    # But changing its tree does
+    with open(amorphea_file, 'w') as f:
+        f.write("(Aa:1,Ab:2)Amorphea_last:7;")
+    output, token_manifest = build_with_manifest()
+    assert token_manifest.scanned_count == 1
+    assert output == "(((Aa:1,Ab:2)Amorphea_last:50,(T1,T2)Tupaia_ott123:3)Root_A,Missing_ott999@:2,X)"
+
+    # The include graph has all the files, including the missing one
+    assert token_manifest.include_graph[os.path.abspath(base_file)] == [
+        os.path.abspath(amorphea_file), os.path.join(ot_parts_folder, "123.phy"), os.path.join(ot_parts_folder, "999.nwk")]
+
+def test_missing_files_reported_up_front(tmp_path, caplog):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    os.remove(os.path.join(ot_parts_folder, "456.nwk"))
+
+    with caplog.at_level(logging.WARNING):
+        build_oz_tree(base_file, ot_parts_folder, io.StringIO())
+    assert [record.message for record in caplog.records] == [
+        f"2 included files are missing, so their tokens will be kept as is: {os.path.join(ot_parts_folder, '999.nwk')}, "
+        f"{os.path.join(ot_parts_folder, '456.nwk')}"]
+
+def test_unmapped_tokens(tmp_path):
+    base_file, ot_parts_folder = create_parts(tmp_path)
+    with open(base_file, 'w') as f:
+        f.write("(AMORPHEA@,UNKNOWN@,OTHER@)Root;")
+
+    try:
+        build_oz_tree(base_file, ot_parts_folder, io.StringIO())
+    except ValueError as e:
+        assert str(e) == f"OneZoom tokens missing from token_to_file_map: {base_file}: UNKNOWN, OTHER"
+    else:
+        assert False
@@ -0,0 +1,108 @@
+'''
+Unit tests for clade_metrics
+'''
+
+import io
+import os
+import random
+
+from oz_tree_build.newick.clade_metrics import CladeMetrics, build_clade_metrics
+from oz_tree_build.newick.compact_tree import CompactTree
+
+test_tree = "((A_ott1:1,B_ott2:2)C_ott3:3,D_ott4:4,(E:1)F_ott1:1.5)Root_ott5:1;"
+
+def test_node_metrics():
+    metrics = CladeMetrics.from_newick(test_tree)
+
+    assert len(metrics) == 7
+    assert metrics.ott_metrics(3) == {'tip_count': 2, 'node_count': 3, 'root_distance': 3.0, 'max_tip_distance': 2.0,
+                                      'left': 2, 'right': 7}
+    assert metrics.ott_metrics('5') == {'tip_count': 4, 'node_count': 7, 'root_distance': 0.0, 'max_tip_distance': 5.0,
+                                        'left': 1, 'right': 14}
+    assert metrics.ott_metrics(4) == {'tip_count': 1, 'node_count': 1, 'root_distance': 4.0, 'max_tip_distance': 0.0,
+                                      'left': 8, 'right': 9}
+    assert metrics.node_metrics(4) == {'tip_count': 1, 'node_count': 1, 'root_distance': 2.5, 'max_tip_distance': 0.0,
+                                       'left': 11, 'right': 12}
+
+def test_from_stream():
+    # A tree that can't be memory mapped (e.g. stdin) is parsed as it's read
+    expected = CladeMetrics.from_newick(test_tree)
+    metrics = CladeMetrics.from_newick(io.BytesIO(test_tree.encode()))
+    assert [metrics.node_metrics(node_id) for node_id in range(len(metrics))] == [
+        expected.node_metrics(node_id) for node_id in range(len(expected))]
+
+def test_find_ott():
+    metrics = CladeMetrics.from_newick(test_tree.encode())
+
+    # The first node in post-order is used for duplicate otts
+    assert metrics.find_ott(1) == 0
+    assert metrics.find_ott('2') == 1
+    assert metrics.find_ott(6) is None
+    assert metrics.find_ott('X') is None
+
+def test_is_descendant():
+    metrics = CladeMetrics.from_newick(test_tree)
+    c, d, root = metrics.find_ott(3), metrics.find_ott(4), metrics.find_ott(5)
+
+    assert metrics.is_descendant(metrics.find_ott(2), c)
+    assert metrics.is_descendant(c, c)
+    assert metrics.is_descendant(d, root)
+    assert not metrics.is_descendant(d, c)
+    assert not metrics.is_descendant(root, c)
+
+def test_same_as_compact_tree_on_random_tree():
+    # Build a random tree, with polytomies and unary nodes
+    rng = random.Random(42)
+    clades = [f"T{i}_ott{i}:{rng.randint(1, 9)}" for i in range(2000)]
+    ott = 10000
+    while len(clades) > 1:
+        child_count = min(rng.choice([1, 2, 2, 3, 6]), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        ott += 1
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])})N_ott{ott}:{rng.randint(1, 9)}"]
+    tree = clades[0] + ';'
+
+    metrics = CladeMetrics.from_newick(tree)
+    compact_tree = CompactTree.from_newick(tree)
+    assert len(metrics) == len(compact_tree)
+
+    root_distances, max_tip_distances, lefts = {}, {}, {}
+    for node_id in reversed(range(len(compact_tree))):
+        parent = compact_tree.parent(node_id)
+        root_distances[node_id] = root_distances[parent] + compact_tree.edge_length(node_id) if parent >= 0 else 0.0
+    for node_id in range(len(compact_tree)):
+        children = compact_tree.children(node_id)
+        max_tip_distances[node_id] = max((max_tip_distances[child] + compact_tree.edge_length(child) for child in children), default=0.0)
+
+    for node_id in range(len(compact_tree)):
+        subtree = compact_tree.subtree_range(node_id)
+        assert metrics.node_counts[node_id] == len(subtree)
+        assert metrics.tip_counts[node_id] == sum(compact_tree.is_leaf(i) for i in subtree)
+        assert metrics.root_distances[node_id] == root_distances[node_id]
+        assert metrics.max_tip_distances[node_id] == max_tip_distances[node_id]
+        assert metrics.find_ott(compact_tree.ott(node_id)) == node_id
+
+        # The nested sets match the subtrees
+        for other_id in rng.sample(range(len(compact_tree)), 5):
+            assert metrics.is_descendant(other_id, node_id) == (other_id in subtree)
+
+def test_save_and_load(tmp_path):
+    tree_file = str(tmp_path / "tree.tre")
+    with open(tree_file, 'w') as f:
+        f.write(test_tree)
+
+    assert CladeMetrics.load(tree_file) is None
+    built_metrics = build_clade_metrics(tree_file)
+    metrics = CladeMetrics.load(tree_file)
+    assert len(metrics) == 7
+    for node_id in range(len(metrics)):
+        assert metrics.node_metrics(node_id) == built_metrics.node_metrics(node_id)
+    assert metrics.find_ott(3) == 2
+    assert metrics.find_ott(6) is None
+
+    # Touching the file keeps the metrics, but changing it makes them stale
+    os.utime(tree_file, ns=(1, 1))
+    assert CladeMetrics.load(tree_file) is not None
+    with open(tree_file, 'w') as f:
+        f.write(test_tree.replace('A_ott1', 'X_ott1'))
+    assert CladeMetrics.load(tree_file) is None
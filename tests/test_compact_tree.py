@@ -0,0 +1,72 @@
+'''
+Unit tests for CompactTree
+'''
+
+from oz_tree_build.newick.compact_tree import CompactTree
+from oz_tree_build.newick.newick_parser import parse_tree
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)Root;"
+
+def test_same_nodes_as_parser():
+    tree = CompactTree.from_newick(test_tree)
+    nodes = list(parse_tree(test_tree))
+
+    assert len(tree) == len(nodes)
+    for node_id, node in enumerate(nodes):
+        assert tree.node(node_id) == node
+
+def test_children_and_parents():
+    tree = CompactTree.from_newick(test_tree)
+
+    assert tree.name(tree.root) == 'Root'
+    assert tree.parent(tree.root) == -1
+    assert [tree.name(child) for child in tree.children(tree.root)] == ['A', 'B', 'C', 'D']
+
+    bb = tree.find_ott(456)
+    assert tree.name(bb) == 'BBC'
+    assert [tree.name(child) for child in tree.children(bb)] == ['BBCA', 'BBCB']
+    assert tree.name(tree.parent(bb)) == 'BB'
+    assert tree.children(tree.find_ott('123')) == []
+
+def test_subtree_range():
+    tree = CompactTree.from_newick(test_tree)
+
+    c = tree.children(tree.root)[2]
+    assert [tree.name(node_id) for node_id in tree.subtree_range(c)] == ['CAA', 'CAB', '', 'CB', 'C']
+
+def test_missing_ott():
+    tree = CompactTree.from_newick(test_tree)
+
+    assert tree.find_ott(999) is None
+    assert tree.ott(tree.root) is None
+
+def test_bytes_tree():
+    tree = CompactTree.from_newick(test_tree.encode())
+
+    assert tree.name(tree.find_ott(789)) == 'B'
+    assert tree.edge_length(tree.find_ott(456)) == 78.9
+
+def test_size_per_node():
+    tips = ','.join(f'Species_number_{i}_ott{i}:1.5' for i in range(10000))
+    tree = CompactTree.from_newick(f'({tips})Root;')
+
+    assert tree.nbytes() / len(tree) < 100
+
+def test_find_name():
+    tree = CompactTree.from_newick("((A,B)C,(A,D)E)F;")
+
+    assert tree.find_name('A') == 0
+    assert tree.name(tree.parent(tree.find_name('D'))) == 'E'
+    assert tree.find_name('X') is None
+    assert tree.find_name('') is None
+
+def test_save_and_load(tmp_path):
+    tree = CompactTree.from_newick(test_tree)
+    with open(tmp_path / "tree.ozct", 'wb') as f:
+        tree.save(f)
+    with open(tmp_path / "tree.ozct", 'rb') as f:
+        loaded_tree = CompactTree.load(f)
+
+    assert [loaded_tree.node(node_id) for node_id in range(len(loaded_tree))] == [tree.node(node_id) for node_id in range(len(tree))]
+    assert loaded_tree.children(loaded_tree.root) == tree.children(tree.root)
+    assert loaded_tree.find_ott(456) == tree.find_ott(456)
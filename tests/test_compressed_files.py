@@ -0,0 +1,104 @@
+'''
+Unit tests for compressed_files, and reading compressed tree files with the newick tools
+'''
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+
+import pytest
+
+from oz_tree_build.newick.extract_trees import extract_trees, extract_trees_from_file
+from oz_tree_build.newick.index_open_tree import build_index
+from oz_tree_build.newick.newick_parser import map_tree_file
+from oz_tree_build.utilities.compressed_files import (GzipSeekIndex, build_gzip_index, decompress_stream, get_compression,
+                                                      get_gzip_index_file, open_tree_file, write_seekable_gzip)
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,'CB':1)C,D)Root;"
+
+compressors = {'tre.gz': gzip.compress, 'tre.bz2': bz2.compress, 'tre.xz': lzma.compress}
+
+def create_file(tmp_path, name, content):
+    file = str(tmp_path / name)
+    with open(file, 'wb') as f:
+        f.write(content)
+    return file
+
+@pytest.mark.parametrize("extension", compressors)
+def test_open_compressed_file(tmp_path, extension):
+    file = create_file(tmp_path, extension, compressors[extension](test_tree.encode()))
+
+    with open_tree_file(file) as f:
+        assert f.read() == test_tree.encode()
+    with open_tree_file(file, 'r') as f:
+        assert f.read() == test_tree
+
+    # The file is decompressed as it's read, rather than into memory, unless random access to it is needed
+    with open(file, 'rb') as f:
+        assert map_tree_file(f).read() == test_tree.encode()
+    with open(file, 'rb') as f:
+        assert map_tree_file(f, random_access=True) == test_tree.encode()
+
+def test_decompress_stream():
+    assert get_compression(io.BytesIO(test_tree.encode())) is None
+    assert get_compression(io.BytesIO(gzip.compress(test_tree.encode()))) == 'gzip'
+
+    stream = io.BytesIO(test_tree.encode())
+    assert decompress_stream(stream) is stream
+
+    text_stream = io.TextIOWrapper(io.BufferedReader(io.BytesIO(bz2.compress(test_tree.encode()))), encoding='utf8')
+    assert decompress_stream(text_stream).read() == test_tree
+
+def test_seekable_gzip(tmp_path):
+    rng = random.Random(0)
+    content = bytes(rng.randrange(256) for _ in range(10000))
+    file = create_file(tmp_path, 'data', content)
+    index = write_seekable_gzip(file, file + '.gz', member_size=1000)
+    assert len(index) == 10
+
+    # Any gzip reader sees the members as a single file
+    with gzip.open(file + '.gz') as f:
+        assert f.read() == content
+
+    # Building the index from the file finds the same members
+    os.remove(get_gzip_index_file(file + '.gz'))
+    index = build_gzip_index(file + '.gz')
+    assert list(index.uncompressed_offsets) == list(range(0, 10001, 1000))
+
+    with open_tree_file(file + '.gz') as f:
+        for _ in range(100):
+            start = rng.randrange(len(content) + 10)
+            length = rng.randrange(3000)
+            f.seek(start)
+            assert f.read(length) == content[start:start+length]
+            assert f.tell() == max(start, min(start + length, len(content)))
+
+def test_stale_gzip_index(tmp_path):
+    file = create_file(tmp_path, 'tree.tre', test_tree.encode())
+    write_seekable_gzip(file, file + '.gz')
+    assert GzipSeekIndex.load(file + '.gz') is not None
+
+    with open(file + '.gz', 'wb') as f:
+        f.write(gzip.compress(b"((A,B)C,D)E;"))
+    assert GzipSeekIndex.load(file + '.gz') is None
+    with open_tree_file(file + '.gz') as f:
+        assert f.read() == b"((A,B)C,D)E;"
+
+@pytest.mark.parametrize("extension", ['tre.gz', 'tre.bz2', 'seekable.tre.gz'])
+def test_extract_from_compressed_file(tmp_path, extension):
+    if extension == 'seekable.tre.gz':
+        file = str(tmp_path / extension)
+        write_seekable_gzip(create_file(tmp_path, 'tree.tre', test_tree.encode()), file, member_size=20)
+    else:
+        file = create_file(tmp_path, extension, compressors[extension](test_tree.encode()))
+
+    for target_taxa, excluded_taxa in [({"X", "BBC"}, set()), ({"C", "BB"}, {"BAA", "CAA"}), ({"Root"}, {"B", "CB", "BBCA"})]:
+        expected = extract_trees(test_tree.encode(), target_taxa, excluded_taxa)
+        assert extract_trees_from_file(file, target_taxa, excluded_taxa) == expected
+
+        # The index has the offsets in the uncompressed tree
+        build_index(file)
+        assert extract_trees_from_file(file, target_taxa, excluded_taxa) == expected
@@ -2,7 +2,10 @@
 Unit test for extract_minimal_tree
 '''
 
-from oz_tree_build.newick.extract_minimal_tree import extract_minimal_tree
+import random
+
+from oz_tree_build.newick.extract_minimal_tree import extract_minimal_tree, extract_minimal_trees
+from oz_tree_build.newick.newick_parser import map_tree_file
 
 test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)Root;"
 
@@ -60,3 +63,52 @@ def test_find_by_ott():
     tree = extract_minimal_tree(test_tree, {"123", "789", "456"})
 
     assert tree == '((BBAA_ott123,BBC_ott456:78.9)BB)B_ott789'
+
+def test_bytes_tree():
+    tree = extract_minimal_tree(test_tree.encode(), {"BBB", "789", "BBCA", "BBCB"})
+
+    assert tree == b'((BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789'
+
+def test_mmap_tree(tmp_path):
+    tree_file = tmp_path / "tree.tre"
+    tree_file.write_text(test_tree)
+    with open(tree_file, 'rb') as f:
+        tree = extract_minimal_tree(map_tree_file(f), {"123", "789", "456"})
+
+    assert tree == b'((BBAA_ott123,BBC_ott456:78.9)BB)B_ott789'
+
+def test_invalid_edge_length(tmp_path):
+    # Edge lengths are checked even when the tree is bytes, and they aren't converted
+    tree_file = tmp_path / "tree.tre"
+    tree_file.write_text("(A:1,B:zz)C;")
+    with open(tree_file, 'rb') as f:
+        for tree in ["(A:1,B:zz)C;", b"(A:1,B:zz)C;", map_tree_file(f)]:
+            for options in [{}]:
+                try:
+                    extract_minimal_tree(tree, {'A', 'B'}, **options)
+                except SyntaxError as e:
+                    assert "'zz' is not a valid edge length" in e.msg
+                else:
+                    assert False
+
+def test_several_taxa_sets():
+    trees = extract_minimal_trees(test_tree, {"mixed": {"BBB", "789", "BBCA", "BBCB"}, "missing": {"X"}, "empty": set(),
+                                              "polytomy": {"BBAD", "BBAA", "BBAC"}, "three": {"BA", "C", "BBC"}})
+
+    assert trees == {"mixed": '((BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789', "missing": None, "empty": None,
+                     "polytomy": '(BBAA_ott123,BBAC,BBAD)BAA', "three": '((BA,BBC_ott456:78.9)B_ott789,C)Root'}
+
+def test_several_taxa_sets_on_random_tree():
+    # Build a random tree, with some duplicate names
+    rng = random.Random(42)
+    clades = [f"T{i}_ott{i}:1.5" for i in range(2000)]
+    while len(clades) > 1:
+        child_count = min(rng.randint(1, 4), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])})N{rng.randrange(500)}"]
+    tree = clades[0] + ';'
+
+    taxa_sets = {i: {f"N{rng.randrange(500)}" for j in range(i % 5)} | {str(rng.randrange(2000)) for j in range(i)}
+                 for i in range(50)}
+    trees = extract_minimal_trees(tree, taxa_sets)
+    assert trees == {name: extract_minimal_tree(tree, taxa) for name, taxa in taxa_sets.items()}
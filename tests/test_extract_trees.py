@@ -2,7 +2,13 @@
 Unit tests for extract_trees
 '''
 
-from oz_tree_build.newick.extract_trees import extract_trees
+import io
+import random
+from unittest import mock
+
+from oz_tree_build.newick.extract_trees import ExcludedRanges, ForwardReader, extract_trees, generate_subtrees_from_stream, get_subtrees_by_name
+from oz_tree_build.newick.newick_parser import map_tree_file
+from oz_tree_build.utilities.metrics import Metrics
 
 test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)Root;"
 
@@ -45,3 +51,162 @@ def test_nested_exclusions():
     tree = extract_trees("((A,B)C,D)E;", {"E"}, excluded_taxa={"B", "C"})
 
     assert tree == {'E': '(D)E'}
+
+def test_excluded_target():
+    # The exclusions inside an excluded target still apply to it
+    tree = extract_trees(test_tree, {"B", "BB"}, excluded_taxa={"B", "BB", "BBAB", "BBCA"})
+
+    assert tree == {'789': '(BA)B_ott789', 'BB': '((BBAA_ott123,BBAC,BBAD)BAA,(BBBA)BBB,(BBCB)BBC_ott456:78.9)BB'}
+
+def test_excluded_ranges():
+    excluded_ranges = ExcludedRanges()
+    for excluded_range in [(1, 3), (4, 6), (7, 9), (6, 12), (13, 15)]:
+        excluded_ranges.add(excluded_range)
+
+    # (7, 9) is nested in (6, 12), so it's dropped
+    assert len(excluded_ranges) == 4
+    assert excluded_ranges.inside(0, 20) == [(1, 3), (4, 6), (6, 12), (13, 15)]
+    assert excluded_ranges.inside(4, 13) == [(6, 12)]
+    assert excluded_ranges.inside(12, 13) == []
+
+def test_applied_exclusions():
+    applied_exclusions = {}
+    extract_trees(test_tree, {"B", "BB", "C"}, excluded_taxa={"BBAA", "BAA", "456", "CB", "D"}, applied_exclusions=applied_exclusions)
+
+    # BBAA is inside BAA, so it doesn't need to be excluded on its own
+    assert applied_exclusions == {'789': {"BAA", "456"}, 'BB': {"BAA", "456"}, 'C': {"CB"}}
+
+def test_bytes_tree():
+    tree = extract_trees(test_tree.encode(), {"C", "BB"}, excluded_taxa={"BAA", "CAA"})
+
+    assert tree == {'BB': b'((BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB', 'C': b'((CAB):5.25,CB)C'}
+
+def test_mmap_tree(tmp_path):
+    tree_file = tmp_path / "tree.tre"
+    tree_file.write_text(test_tree)
+    with open(tree_file, 'rb') as f:
+        tree = extract_trees(map_tree_file(f), {"123", "BAA"})
+
+    assert tree == {'123': b'BBAA_ott123', 'BAA': b'(BBAA_ott123,BBAB,BBAC,BBAD)BAA'}
+
+def test_invalid_edge_length(tmp_path):
+    # Edge lengths are checked even when the tree is bytes, and they aren't converted
+    tree_file = tmp_path / "tree.tre"
+    tree_file.write_text("(A:1,B:zz)C;")
+    with open(tree_file, 'rb') as f:
+        for tree in ["(A:1,B:zz)C;", b"(A:1,B:zz)C;", map_tree_file(f)]:
+            for options in [{}, {'workers': 2}]:
+                try:
+                    extract_trees(tree, {'B'}, **options)
+                except SyntaxError as e:
+                    assert "'zz' is not a valid edge length" in e.msg
+                else:
+                    assert False
+
+def test_parallel_same_as_serial():
+    for target_taxa, excluded_taxa in [({"X", "BBC"}, set()), ({"B"}, set()), ({"C"}, {"CAA"}), ({"123", "BAA"}, set()),
+                                       ({"C", "BB"}, {"BAA", "CAA"}), ({"Root"}, {"B", "CB", "BBCA"}), ({"B", "789"}, {"BBAD"}),
+                                       ({"B", "BB"}, {"B", "BB", "BBAB", "BBCA"}), ({"Root"}, {"BB", "BAA", "BBAB"})]:
+        for tree in [test_tree, test_tree.encode()]:
+            expected_exclusions, exclusions = {}, {}
+            expected = extract_trees(tree, target_taxa, excluded_taxa, applied_exclusions=expected_exclusions)
+            assert extract_trees(tree, target_taxa, excluded_taxa, workers=3, applied_exclusions=exclusions) == expected
+            assert exclusions == expected_exclusions
+
+def test_parallel_same_as_serial_on_random_tree():
+    # Build a random tree, with some duplicate names
+    rng = random.Random(42)
+    clades = [f"T{i}_ott{i}:1.5" for i in range(2000)]
+    while len(clades) > 1:
+        child_count = min(rng.randint(2, 4), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])})N{rng.randrange(500)}_ott{10000+len(clades)}"]
+    tree = clades[0] + ';'
+
+    target_taxa = {f"N{i}" for i in range(0, 500, 7)} | {str(i) for i in range(0, 2000, 13)}
+    excluded_taxa = {f"N{i}" for i in range(0, 500, 11)} | {str(i) for i in range(0, 2000, 3)}
+    expected = extract_trees(tree, target_taxa, excluded_taxa)
+    for workers in [2, 4, 8]:
+        assert extract_trees(tree, target_taxa, excluded_taxa, workers=workers) == expected
+
+def test_stream_same_as_bytes():
+    for target_taxa, excluded_taxa in [({"X", "BBC"}, set()), ({"C"}, {"CAA"}), ({"C", "BB"}, {"BAA", "CAA"}),
+                                       ({"Root"}, {"B", "CB", "BBCA"}), ({"B", "BB"}, {"B", "BB", "BBAB", "BBCA"}),
+                                       ({"BBBA", "CB"}, {"BBBA", "D"})]:
+        expected_exclusions, exclusions = {}, {}
+        expected = extract_trees(test_tree.encode(), target_taxa, excluded_taxa, applied_exclusions=expected_exclusions)
+        assert extract_trees(io.BytesIO(test_tree.encode()), target_taxa, excluded_taxa, applied_exclusions=exclusions) == expected
+        assert exclusions == expected_exclusions
+
+def test_stream_same_as_bytes_on_random_tree():
+    rng = random.Random(3)
+    clades = [f"T{i}_ott{i}:1.5" for i in range(2000)]
+    while len(clades) > 1:
+        child_count = min(rng.randint(1, 4), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])})N{rng.randrange(500)}_ott{10000+len(clades)}"]
+    tree = (clades[0] + ';').encode()
+
+    target_taxa = {f"N{i}" for i in range(0, 500, 7)} | {str(i) for i in range(0, 2000, 13)}
+    excluded_taxa = {f"N{i}" for i in range(0, 500, 11)} | {str(i) for i in range(0, 2000, 3)}
+    expected = extract_trees(tree, target_taxa, excluded_taxa)
+    assert len(expected) > 100
+    for chunk_size in [10, 1000]:
+        subtrees = generate_subtrees_from_stream(io.BytesIO(tree), target_taxa, excluded_taxa, chunk_size=chunk_size)
+        assert get_subtrees_by_name(subtrees) == expected
+
+def test_forward_reader():
+    reader = ForwardReader(io.BytesIO(b"0123456789" * 10), chunk_size=7)
+    reader.keep_from(15)
+    assert reader.substring(20, 25) == b"01234"
+    assert reader.substring(15, 18) == b"567"
+    reader.keep_from(17)
+    assert reader.substring(17, 19) == b"78"
+    reader.keep_from(95)
+    assert reader.substring(95, 105) == b"56789"
+    try:
+        reader.substring(90, 96)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_same_as_all_exclusions_on_random_tree():
+    # Nested exclusions are dropped, so compare with keeping all of them, sorted by start index
+    rng = random.Random(7)
+    clades = [f"T{i}_ott{i}" for i in range(3000)]
+    while len(clades) > 1:
+        child_count = min(rng.randint(1, 3), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])})N{len(clades)}"]
+    tree = clades[0] + ';'
+
+    target_taxa = {f"N{i}" for i in range(0, 3000, 17)}
+    excluded_taxa = {f"N{i}" for i in range(0, 3000, 5)} | {str(i) for i in range(0, 3000, 3)}
+
+    class AllExcludedRanges(list):
+        def add(self, excluded_range, taxa=()):
+            self.append(excluded_range)
+            self.sort(key=lambda x: x[0])
+
+        def inside(self, node_start_index, node_end_index):
+            return self
+
+        def taxa_inside(self, node_start_index, node_end_index):
+            return set()
+
+    expected = extract_trees(tree, target_taxa, excluded_taxa)
+    assert len(expected) > 100
+    with mock.patch('oz_tree_build.newick.extract_trees.ExcludedRanges', AllExcludedRanges):
+        assert extract_trees(tree, target_taxa, excluded_taxa) == expected
+
+def test_metrics():
+    metrics = Metrics()
+    extract_trees(test_tree, {"BBC"}, metrics=metrics)
+
+    # Parsing stops at the last target, BBC
+    assert metrics.counts == {'nodes parsed': 12, 'characters scanned': test_tree.index(')BB)')}
+
+    metrics = Metrics()
+    extract_trees(test_tree.encode(), {"BBC", "X"}, workers=2, metrics=metrics)
+    assert metrics.counts == {'nodes parsed': 21, 'bytes scanned': len(test_tree)}
@@ -2,7 +2,13 @@
 Unit test for find_in_file
 '''
 
-from oz_tree_build.utilities.find_in_file import get_matches
+import gzip
+import random
+
+import pytest
+
+from oz_tree_build.utilities.find_in_file import (find_in_files, get_mapped_matches, get_matches, get_matches_with_text,
+                                                  literal_patterns_regex)
 
 def chunks_from_string(s, chunk_size):
     for i in range(0, len(s), chunk_size):
@@ -38,3 +44,80 @@ def test_overlap_string():
     assert run_get_matches("zabcdefgh", 3) == [(25, 'wxyzabcdefghijk'), (51, 'wxyzabcdefghijk')]
     assert run_get_matches("vwxyza", 3) == [(21, 'stuvwxyzabcd'), (47, 'stuvwxyzabcd')]
     assert run_get_matches("vwxyza", 0) == [(21, 'vwxyza'), (47, 'vwxyza')]
+
+def test_literal_patterns():
+    s = "(Tupaia_tana_ott1,Tupaia_ott12,Homo_ott123)Root;"
+    regex = literal_patterns_regex(["Tupaia", "Tupaia_tana", "ott12", "Root", "X.Y"])
+
+    # The longest pattern wins, and the chunks don't change the result
+    expected = [(1, 'Tupaia_tana'), (18, 'Tupaia'), (25, 'ott12'), (36, 'ott12'), (43, 'Root')]
+    assert [(index, text) for index, text, match in get_matches_with_text(chunks_from_string(s, 10), regex, 0)] == expected
+    assert [(index, text) for index, text, match in get_matches_with_text(iter([s]), regex, 0)] == expected
+
+def test_whole_names():
+    s = "(Tupaia_tana_ott1,Tupaia_ott12,Homo_ott123)Root;"
+    regex = literal_patterns_regex(["Tupaia", "ott12", "ott1"], whole_names=True)
+
+    assert [(index, text) for index, text, match in get_matches_with_text(iter([s]), regex, 2)] == [
+        (1, 'Tupaia'), (13, 'ott1'), (18, 'Tupaia'), (25, 'ott12')]
+
+def test_ott_numbers(tmp_path):
+    s = "(Homo_sapiens_ott770315,ott7703150,Pan_ott1770315,ott770315)Homo_ott12;"
+
+    # A bare ott number matches the whole number of an ott, even with whole_names
+    for whole_names in [False, True]:
+        regex = literal_patterns_regex(["770315", "12", "Homo"], whole_names)
+        expected = [(1, 'Homo'), (17, '770315'), (53, '770315'), (60, 'Homo'), (68, '12')]
+        assert [(index, text) for index, text, match in get_matches_with_text(iter([s]), regex, 0)] == expected
+
+        file = str(tmp_path / "tree.tre")
+        with open(file, 'w') as f:
+            f.write(s)
+        assert [(index, text) for index, text, match in get_mapped_matches(file, regex, 0, 100)] == expected
+
+def test_same_as_one_pattern_at_a_time():
+    s = ",".join(f"Species_{i}_ott{i * 7}" for i in range(1000))
+    patterns = [f"ott{i}" for i in range(0, 7000, 13)]
+
+    expected = sorted((index, match) for pattern in patterns
+                      for index, match in get_matches(chunks_from_string(s, 100), pattern + "(?![0-9])", 5))
+    regex = literal_patterns_regex(patterns).pattern + "(?![0-9])"
+    assert sorted(get_matches(chunks_from_string(s, 100), regex, 5)) == expected
+
+def test_several_files(tmp_path):
+    files = []
+    for i, content in enumerate(["(A_ott1,B_ott2)C;", "(B_ott2,D_ott1)E;", ""]):
+        files.append(str(tmp_path / f"tree{i}.tre.gz"))
+        with open(files[-1], 'wb') as f:
+            f.write(gzip.compress(content.encode()))
+    regex = literal_patterns_regex(["ott1", "B"])
+
+    expected = [(files[0], [(3, 'ott1', '_ott1,'), (8, 'B', ',B_')]),
+                (files[1], [(1, 'B', '(B_'), (10, 'ott1', '_ott1)')]),
+                (files[2], [])]
+    assert list(find_in_files(files, regex, 1, 5)) == expected
+    assert list(find_in_files(files, regex, 1, 5, processes=2)) == expected
+
+@pytest.mark.parametrize("regex", ["a+", "ab|ba", "b(?=aa)", "b[ab]{0,7}b", literal_patterns_regex(["aba", "ab", "bbb"])])
+def test_mapped_matches(tmp_path, regex):
+    rng = random.Random(0)
+    s = "".join(rng.choice("aab") for _ in range(5000))
+    file = str(tmp_path / "file.txt")
+    with open(file, 'w') as f:
+        f.write(s)
+
+    expected = list(get_matches_with_text(chunks_from_string(s, 100), regex, 3))
+    assert list(get_mapped_matches(file, regex, 3, 100)) == expected
+    assert list(get_mapped_matches(file, regex, 3, 100, processes=2)) == expected
+    assert list(get_mapped_matches(file, regex, 3, 100, max_match_length=20, processes=3)) == expected
+
+def test_long_mapped_match(tmp_path):
+    s = "(" + "a" * 1000 + ")"
+    file = str(tmp_path / "file.txt")
+    with open(file, 'w') as f:
+        f.write(s)
+
+    # The chunks only see matches up to the chunk size, but the overlap can be larger with mmap
+    assert list(get_matches(chunks_from_string(s, 100), r"\(a*\)", 0)) == []
+    assert list(get_mapped_matches(file, r"\(a*\)", 0, 100)) == []
+    assert list(get_mapped_matches(file, r"\(a*\)", 0, 100, max_match_length=1000)) == [(0, s, s)]
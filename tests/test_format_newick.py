@@ -42,3 +42,31 @@ def test_format_newick():
     format_newick.format(test_tree, f, 2)
     f.seek(0)
     assert f.read() == formatted_test_tree
+
+def test_format_stream_in_chunks():
+    for chunk_size in [1, 2, 7, 1000]:
+        f = io.StringIO()
+        format_newick.format_stream(io.StringIO(test_tree + "\n"), f, 2, chunk_size=chunk_size)
+        assert f.getvalue() == formatted_test_tree
+
+def test_max_depth():
+    f = io.StringIO()
+    format_newick.format(test_tree, f, 2, max_depth=2)
+    assert f.getvalue() == \
+'''(
+  A,
+  (
+    BA,
+    ((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB
+  )B_ott789,
+  (
+    (CAA,CAB),
+    CB
+  )C,
+  D
+)Root;
+'''
+
+    f = io.StringIO()
+    format_newick.format_stream(io.StringIO(test_tree), f, 2, max_depth=0, chunk_size=5)
+    assert f.getvalue() == test_tree + "\n"
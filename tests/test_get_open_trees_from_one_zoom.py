@@ -0,0 +1,168 @@
+'''
+Unit tests for get_open_trees_from_one_zoom
+'''
+
+import os
+import time
+from unittest import mock
+
+from oz_tree_build import get_open_trees_from_one_zoom
+from oz_tree_build.get_open_trees_from_one_zoom import (extract_trees_from_open_tree_file,
+                                                        get_inclusions_and_exclusions_from_one_zoom_files)
+from oz_tree_build.token_manifest import TokenManifest
+from oz_tree_build.utilities.metrics import Metrics
+
+test_tree = "(A_ott1,(BA_ott21,((BBAA_ott123,BBAB_ott124)BAA_ott221,(BBCA_ott125,BBCB_ott126)BBC_ott456)BB_ott22)B_ott789,((CAA_ott311,CAB_ott312)CA_ott31,CB_ott32)C_ott3,D_ott4)Root;"
+
+def extract(tmp_path, included_otts, excluded_otts, threads=1):
+    open_tree_file = str(tmp_path / "tree.tre")
+    if not os.path.exists(open_tree_file):
+        with open(open_tree_file, 'w') as f:
+            f.write(test_tree)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir(exist_ok=True)
+
+    with mock.patch.object(get_open_trees_from_one_zoom, 'generate_subtrees_from_open_tree',
+                           wraps=get_open_trees_from_one_zoom.generate_subtrees_from_open_tree) as generate_subtrees:
+        counts = extract_trees_from_open_tree_file(open_tree_file, str(output_dir), included_otts, excluded_otts, threads=threads)
+
+    extracted_otts = generate_subtrees.call_args[0][3] if generate_subtrees.called else set()
+    files = {file[:-4]: (output_dir / file).read_text() for file in os.listdir(output_dir) if file.endswith('.phy')}
+    return counts, extracted_otts, files
+
+def test_unchanged_rerun(tmp_path):
+    counts, extracted_otts, files = extract(tmp_path, {"789", "3", "999"}, {"221", "31"})
+    assert counts == (2, 0, 0)
+    assert extracted_otts == {"789", "3", "999"}
+    assert files == {"789": "(BA_ott21,((BBCA_ott125,BBCB_ott126)BBC_ott456)BB_ott22)B_ott789;\n", "3": "(CB_ott32)C_ott3;\n"}
+
+    # Nothing changed, so nothing gets parsed or written, even for the missing ott
+    assert extract(tmp_path, {"789", "3", "999"}, {"221", "31"}) == ((0, 3, 0), set(), files)
+
+    # Same if the tree file is only touched
+    os.utime(tmp_path / "tree.tre", ns=(0, 0))
+    assert extract(tmp_path, {"789", "3", "999"}, {"221", "31"}) == ((0, 3, 0), set(), files)
+
+def test_changed_otts(tmp_path):
+    counts, extracted_otts, files = extract(tmp_path, {"789", "3", "456"}, {"221", "31"})
+    assert counts == (3, 0, 0)
+
+    # Only the subtree that had the exclusion is extracted again
+    counts, extracted_otts, files = extract(tmp_path, {"789", "3", "456"}, {"221"})
+    assert counts == (1, 2, 0)
+    assert extracted_otts == {"3"}
+    assert files["3"] == "((CAA_ott311,CAB_ott312)CA_ott31,CB_ott32)C_ott3;\n"
+
+    # A new exclusion could be anywhere, so all the subtrees are extracted again, but only the changed ones are written
+    counts, extracted_otts, files = extract(tmp_path, {"789", "3", "456"}, {"221", "125"})
+    assert counts == (2, 1, 0)
+    assert extracted_otts == {"789", "3", "456"}
+    assert files["456"] == "(BBCB_ott126)BBC_ott456;\n"
+
+    # Otts that are no longer included are deleted, and new ones extracted
+    counts, extracted_otts, files = extract(tmp_path, {"789", "4"}, {"221", "125"}, threads=4)
+    assert counts == (1, 1, 2)
+    assert extracted_otts == {"4"}
+    assert sorted(files) == ["4", "789"]
+
+def test_changed_open_tree_file(tmp_path):
+    extract(tmp_path, {"789", "3"}, {"221"})
+
+    with open(tmp_path / "tree.tre", 'w') as f:
+        f.write(test_tree.replace("CB_ott32", "CB_ott32,CC_ott33"))
+    counts, extracted_otts, files = extract(tmp_path, {"789", "3"}, {"221"})
+    assert counts == (1, 1, 0)
+    assert extracted_otts == {"789", "3"}
+    assert files["3"] == "((CAA_ott311,CAB_ott312)CA_ott31,CB_ott32,CC_ott33)C_ott3;\n"
+
+def test_write_with_threads(tmp_path):
+    included_otts = {"1", "21", "123", "124", "221", "125", "126", "456", "22", "789", "311", "312", "31", "32", "3", "4"}
+    counts, extracted_otts, files = extract(tmp_path, included_otts, {"22", "31"}, threads=3)
+    assert counts == (len(included_otts), 0, 0)
+    assert files["789"] == "(BA_ott21)B_ott789;\n"
+    assert files["22"] == "((BBAA_ott123,BBAB_ott124)BAA_ott221,(BBCA_ott125,BBCB_ott126)BBC_ott456)BB_ott22;\n"
+    assert not [file for file in os.listdir(tmp_path / "output") if file.endswith('.tmp')]
+
+def test_scan_one_zoom_files(tmp_path):
+    (tmp_path / "A.PHY").write_text("(Foo_ott123@,Bar_ott~456-789-111@,AMORPHEA@)A;")
+    (tmp_path / "B.PHY").write_text("(Baz_ott5~-6@:2.5,Qux)B;")
+
+    for threads in [1, 2]:
+        included_otts, excluded_otts = get_inclusions_and_exclusions_from_one_zoom_files([tmp_path / "A.PHY", tmp_path / "B.PHY"], threads)
+        assert included_otts == {"123", "456", "5"}
+        assert excluded_otts == {"789", "111", "6"}
+
+def test_scan_skips_leading_comment(tmp_path):
+    # The token in the comment at the start of the file is ignored, with or without a token manifest
+    (tmp_path / "A.PHY").write_text("[Was Old_ott999~-7@]\n(Foo_ott123@,Bar_ott~456-789@)A;\n")
+    for token_manifest in [None, TokenManifest(str(tmp_path / "tokens.json"))]:
+        included_otts, excluded_otts = get_inclusions_and_exclusions_from_one_zoom_files([tmp_path / "A.PHY"],
+                                                                                         token_manifest=token_manifest)
+        assert (included_otts, excluded_otts) == ({"123", "456"}, {"789"})
+
+    missing_file = tmp_path / "Missing.PHY"
+    for token_manifest in [None, TokenManifest()]:
+        try:
+            get_inclusions_and_exclusions_from_one_zoom_files([missing_file], token_manifest=token_manifest)
+        except FileNotFoundError as e:
+            assert str(e) == f"Could not find the OneZoom file {missing_file}"
+        else:
+            assert False
+
+def test_scan_empty_files(tmp_path):
+    (tmp_path / "Empty.PHY").write_text("")
+    (tmp_path / "Blank.PHY").write_text("[Just a comment]\n  \n")
+    files = [tmp_path / "Empty.PHY", tmp_path / "Blank.PHY"]
+    for token_manifest in [None, TokenManifest(str(tmp_path / "tokens.json"))]:
+        assert get_inclusions_and_exclusions_from_one_zoom_files(files, token_manifest=token_manifest) == (set(), set())
+
+def test_scan_with_token_manifest(tmp_path):
+    (tmp_path / "A.PHY").write_text("(Foo_ott123@,Bar_ott~456-789-111@,AMORPHEA@)A;")
+    (tmp_path / "B.PHY").write_text("(Baz_ott5~-6@:2.5,Qux)B;")
+    manifest_file = str(tmp_path / "tokens.json")
+
+    for scanned_count in [2, 0]:
+        token_manifest = TokenManifest(manifest_file)
+        included_otts, excluded_otts = get_inclusions_and_exclusions_from_one_zoom_files(
+            [tmp_path / "A.PHY", tmp_path / "B.PHY"], 2, token_manifest=token_manifest)
+        token_manifest.save()
+        assert (included_otts, excluded_otts) == ({"123", "456", "5"}, {"789", "111", "6"})
+        assert token_manifest.scanned_count == scanned_count
+
+def test_metrics(tmp_path):
+    open_tree_file = str(tmp_path / "tree.tre")
+    with open(open_tree_file, 'w') as f:
+        f.write(test_tree)
+    metrics = Metrics()
+    extract_trees_from_open_tree_file(open_tree_file, str(tmp_path), {"789", "3"}, {"221"}, metrics=metrics)
+
+    assert set(metrics.seconds) == {'read', 'extract', 'write', 'wait for writes'}
+    assert metrics.counts['files written'] == 2
+    assert metrics.counts['bytes written'] == sum(os.path.getsize(tmp_path / f"{ott}.phy") for ott in ["789", "3"])
+    # Parsing stops at C, the last target
+    assert metrics.counts['nodes parsed'] == 15
+
+def test_metrics_phases(tmp_path):
+    open_tree_file = str(tmp_path / "tree.tre")
+    with open(open_tree_file, 'w') as f:
+        f.write(test_tree)
+
+    # Opening or mapping the tree counts as reading it, and waiting for a write to finish as writing
+    open_tree_for_extraction = get_open_trees_from_one_zoom.open_tree_for_extraction
+    write_file_atomically = get_open_trees_from_one_zoom.write_file_atomically
+
+    def slow_open_tree(*args):
+        time.sleep(0.05)
+        return open_tree_for_extraction(*args)
+
+    def slow_write(file, content):
+        time.sleep(0.05)
+        write_file_atomically(file, content)
+
+    metrics = Metrics()
+    with mock.patch.object(get_open_trees_from_one_zoom, 'open_tree_for_extraction', slow_open_tree), \
+         mock.patch.object(get_open_trees_from_one_zoom, 'write_file_atomically', slow_write):
+        extract_trees_from_open_tree_file(open_tree_file, str(tmp_path), {"1", "789", "31", "3", "4"}, set(), metrics=metrics)
+
+    assert metrics.seconds['read'] >= 0.05
+    assert metrics.seconds['extract'] < 0.05
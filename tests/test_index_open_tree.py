@@ -0,0 +1,66 @@
+'''
+Unit tests for index_open_tree, and extracting trees using the index
+'''
+
+import os
+
+from oz_tree_build.newick.extract_trees import extract_trees, extract_trees_from_file
+from oz_tree_build.newick.index_open_tree import OpenTreeIndex, build_index
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,'CB':1)C,D)Root;"
+
+def create_indexed_tree(tmp_path):
+    tree_file = str(tmp_path / "tree.tre")
+    with open(tree_file, 'w') as f:
+        f.write(test_tree)
+    build_index(tree_file)
+    return tree_file
+
+def test_lookups(tmp_path):
+    index = OpenTreeIndex.load(create_indexed_tree(tmp_path))
+
+    assert len(index) == 21
+    node_id, = index.find('456')
+    start, end, full_name_start = index.get_node_offsets(node_id)
+    assert test_tree[start:end] == '(BBCA:12.34,BBCB)BBC_ott456:78.9'
+    assert test_tree[full_name_start:end] == 'BBC_ott456:78.9'
+    assert index.find_name('BBC') == [node_id]
+    assert index.find('X') == []
+
+def test_same_as_full_parse(tmp_path):
+    tree_file = create_indexed_tree(tmp_path)
+
+    for target_taxa, excluded_taxa in [({"X", "BBC"}, set()), ({"B"}, set()), ({"C"}, {"CAA"}), ({"123", "BAA"}, set()),
+                                       ({"C", "BB"}, {"BAA", "CAA"}), ({"Root"}, {"B", "CB", "BBCA"}), ({"B", "789"}, {"BBAD"}),
+                                       ({"B", "BB"}, {"B", "BB", "BBAB", "BBCA"}), ({"Root"}, {"BB", "BAA", "BBAB"})]:
+        expected_exclusions, exclusions = {}, {}
+        expected = extract_trees(test_tree.encode(), target_taxa, excluded_taxa, applied_exclusions=expected_exclusions)
+        assert extract_trees_from_file(tree_file, target_taxa, excluded_taxa, applied_exclusions=exclusions) == expected
+        assert exclusions == expected_exclusions
+
+def test_stale_index(tmp_path):
+    tree_file = create_indexed_tree(tmp_path)
+    with open(tree_file, 'w') as f:
+        f.write("((A,B)C,D)E;")
+
+    assert OpenTreeIndex.load(tree_file) is None
+    assert extract_trees_from_file(tree_file, {"E"}, {"B"}) == {'E': b'((A)C,D)E'}
+
+def test_touched_tree_file(tmp_path):
+    tree_file = create_indexed_tree(tmp_path)
+    os.utime(tree_file, ns=(0, 0))
+
+    assert OpenTreeIndex.load(tree_file) is not None
+
+def test_invalid_index(tmp_path):
+    tree_file = create_indexed_tree(tmp_path)
+    index_file = tree_file + '.ozidx'
+    with open(index_file, 'rb') as f:
+        index_bytes = f.read()
+
+    # Truncated in the header, in the node offsets, or empty
+    for size in [60, 100, 0]:
+        with open(index_file, 'wb') as f:
+            f.write(index_bytes[:size])
+        assert OpenTreeIndex.load(tree_file) is None
+        assert extract_trees_from_file(tree_file, {"C"}, {"CAA"}) == {'C': b"((CAB):5.25,'CB':1)C"}
@@ -0,0 +1,43 @@
+'''
+Unit tests for metrics
+'''
+
+import threading
+import time
+
+from oz_tree_build.utilities.metrics import Metrics
+
+def test_phases_are_wall_clock():
+    metrics = Metrics()
+    barrier = threading.Barrier(2)
+
+    def work():
+        with metrics.timed('work'):
+            barrier.wait()
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=work) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The phase ran in two threads at once, so it took half the time of the threads
+    result = metrics.to_dict()
+    assert result['thread_seconds']['work'] >= 0.1
+    assert 0.05 <= result['phases']['work'] < result['thread_seconds']['work']
+    assert result['phases']['work'] <= result['total_seconds']
+
+def test_timed_iter():
+    metrics = Metrics()
+
+    def items():
+        time.sleep(0.02)
+        yield 1
+        time.sleep(0.02)
+        yield 2
+
+    # What's done with the items isn't timed
+    for item in metrics.timed_iter(items(), 'produce'):
+        time.sleep(0.05)
+    assert 0.04 <= metrics.seconds['produce'] < 0.09
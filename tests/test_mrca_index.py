@@ -0,0 +1,76 @@
+'''
+Unit tests for MrcaIndex
+'''
+
+import random
+
+import pytest
+
+from oz_tree_build.newick.mrca_index import MrcaIndex
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)Root;"
+
+def names(index, node_ids):
+    return [index.tree.name(node_id) for node_id in node_ids]
+
+def test_mrca():
+    index = MrcaIndex.from_newick(test_tree)
+
+    assert index.tree.name(index.mrca("BBAA", "BBCB")) == 'BB'
+    assert index.tree.name(index.mrca("123", "BBAD")) == 'BAA'
+    assert index.tree.name(index.mrca("CAA", "CB")) == 'C'
+    assert index.tree.name(index.mrca("A", "D")) == 'Root'
+    assert index.tree.name(index.mrca("BA", "BBCA", "456")) == 'B'
+    assert index.tree.name(index.mrca(456, "BBCA")) == 'BBC'
+    assert index.tree.name(index.mrca("BBB")) == 'BBB'
+    assert index.describe(index.mrca("BBCB", "BA")) == 'B_ott789'
+
+def test_mrca_of_pairs():
+    index = MrcaIndex.from_newick(test_tree)
+
+    assert names(index, index.mrca_of_pairs([("BBAA", "BBCB"), ("CAB", "CAA"), ("B", "BBBA"), ("CB", "BA")])) == ['BB', '', 'B', 'Root']
+
+def test_ancestors():
+    index = MrcaIndex.from_newick(test_tree)
+
+    assert index.is_ancestor("B", "BBAC")
+    assert index.is_ancestor("Root", "D")
+    assert index.is_ancestor("BB", "BB")
+    assert not index.is_ancestor("BBAC", "B")
+    assert not index.is_ancestor("C", "BBAC")
+    assert index.is_descendant("BBCA", "789")
+    assert not index.is_descendant("CAA", "789")
+
+def test_missing_taxon():
+    index = MrcaIndex.from_newick(test_tree)
+
+    with pytest.raises(KeyError):
+        index.mrca("A", "X")
+
+def test_same_as_parents_on_random_tree(tmp_path):
+    # Build a random tree, large enough to need several blocks
+    rng = random.Random(42)
+    clades = [f"T{i}_ott{i}" for i in range(3000)]
+    while len(clades) > 1:
+        child_count = min(rng.randint(1, 4), len(clades))
+        index = rng.randrange(len(clades) - child_count + 1)
+        clades[index:index+child_count] = [f"({','.join(clades[index:index+child_count])})"]
+    tree = clades[0] + ';'
+
+    index_file = str(tmp_path / "tree.ozmrca")
+    MrcaIndex.from_newick(tree).save(index_file)
+    index = MrcaIndex.load(index_file)
+
+    def ancestors(node_id):
+        result = []
+        while node_id != -1:
+            result.append(node_id)
+            node_id = index.tree.parent(node_id)
+        return result
+
+    pairs = [(rng.randrange(3000), rng.randrange(3000)) for i in range(1000)]
+    expected = []
+    for first, second in pairs:
+        first_ancestors = set(ancestors(index.find(first)))
+        expected.append(next(node_id for node_id in ancestors(index.find(second)) if node_id in first_ancestors))
+    assert index.mrca_of_pairs(pairs) == expected
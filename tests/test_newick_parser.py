@@ -1,4 +1,6 @@
-from oz_tree_build.newick.newick_parser import parse_tree
+import io
+
+from oz_tree_build.newick.newick_parser import map_tree_file, node_fields, parse_stream, parse_tree, visit_tree
 
 
 def test_full_parse_result():
@@ -42,3 +44,115 @@ def test_syntax_error_missing_edge_length_after_colon():
 
 def test_syntax_error_invalid_edge_length():
     verify_exception("(Blah,Foo_ott67:14z);", "'14z' is not a valid edge length")
+
+def verify_stream_matches_string(tree_string):
+    expected = list(parse_tree(tree_string))
+    for chunk_size in [1, 2, 3, 7, 1000]:
+        assert list(parse_stream(io.StringIO(tree_string), chunk_size)) == expected
+        assert list(parse_stream(io.BytesIO(tree_string.encode()), chunk_size)) == expected
+
+def test_stream_same_as_string():
+    verify_stream_matches_string("(A_ott123,B:1.2)C_ott789:5.5;")
+    verify_stream_matches_string("('Abc/def_ott123','qw e$r&ty':1.2)'C_*(ot)t789_ott987':5.5;")
+    verify_stream_matches_string("(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)Root;")
+
+def test_stream_offsets_are_seekable():
+    f = io.BytesIO(b"(Long_name_ott123:1.25,Other_name)Root;")
+    for node in parse_stream(f, 4):
+        position = f.tell()
+        f.seek(node['full_name_start_index'])
+        assert f.read(node['end'] - node['full_name_start_index']).split(b':')[0].split(b'_ott')[0].decode() == node['taxon']
+        f.seek(position)
+
+def verify_stream_exception(tree_string, exception_text):
+    try:
+        list(parse_stream(io.StringIO(tree_string), 3))
+    except SyntaxError as e:
+        assert exception_text in e.msg
+    else:
+        assert False
+
+def test_stream_syntax_errors():
+    verify_stream_exception("(A,B))(C,D);", "expected a semicolon at the end of the tree")
+    verify_stream_exception("((A,B);", "expected ',' or ')'")
+    verify_stream_exception("(Blah,Foo_ott67:14z);", "'14z' is not a valid edge length")
+    verify_stream_exception("(A,", "unexpected end of the tree")
+
+def test_bytes_same_as_string():
+    tree_string = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)'Ro ot';"
+    expected = list(parse_tree(tree_string))
+    assert [dict(node) for node in parse_tree(tree_string.encode())] == expected
+    assert [dict(node) for node in parse_tree(memoryview(tree_string.encode()))] == expected
+
+def test_bytes_offsets():
+    tree_bytes = "(É_ott1,B:1.5)C;".encode()
+    node_list = list(parse_tree(tree_bytes))
+    assert node_list[0]['taxon'] == 'É'
+    assert tree_bytes[node_list[1]['start']:node_list[1]['end']] == b'B:1.5'
+    assert node_list[1]['edge_length'] == 1.5
+
+def test_bytes_invalid_edge_length():
+    # The edge lengths are checked while scanning, even though they're only converted when they're read
+    for tree in [b"(Blah,Foo_ott67:14z);", memoryview(b"(Blah,Foo_ott67:14z);")]:
+        try:
+            list(parse_tree(tree))
+        except SyntaxError as e:
+            assert "'14z' is not a valid edge length" in e.msg
+        else:
+            assert False
+
+def test_unusual_edge_lengths():
+    # Anything float() accepts is a valid edge length
+    for tree in ["(A:-1,B:+.5,C:1.,D:2E+3)E:inf;", b"(A:-1,B:+.5,C:1.,D:2E+3)E:inf;"]:
+        assert list(parse_tree(tree, fields=('edge_length',))) == [(-1.0,), (0.5,), (1.0,), (2000.0,), (float('inf'),)]
+
+def test_fields():
+    tree_string = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,CB)C,D)'Ro ot';"
+    expected = list(parse_tree(tree_string))
+    for tree in [tree_string, tree_string.encode()]:
+        assert list(parse_tree(tree, fields=('end', 'taxon', 'ott'))) == [(node['end'], node['taxon'], node['ott']) for node in expected]
+        assert list(parse_tree(tree, fields=('edge_length',))) == [(node['edge_length'],) for node in expected]
+        assert list(parse_tree(tree, fields=node_fields)) == [tuple(node.values()) for node in expected]
+
+    # The streams give the same tuples, whether they're passed to parse_stream or parse_tree
+    for stream_type, tree in [(io.StringIO, tree_string), (io.BytesIO, tree_string.encode())]:
+        assert list(parse_stream(stream_type(tree), 7, fields=('end', 'taxon', 'ott'))) == [
+            (node['end'], node['taxon'], node['ott']) for node in expected]
+        assert list(parse_tree(stream_type(tree), fields=node_fields)) == [tuple(node.values()) for node in expected]
+        assert list(parse_tree(stream_type(tree))) == expected
+
+def test_fields_check_edge_length():
+    # The edge length is checked even when it isn't converted
+    for get_tree in [lambda: "(Blah,Foo_ott67:14z);", lambda: b"(Blah,Foo_ott67:14z);", lambda: io.BytesIO(b"(Blah,Foo_ott67:14z);")]:
+        for fields in [('ott',), ('ott', 'edge_length')]:
+            try:
+                list(parse_tree(get_tree(), fields=fields))
+            except SyntaxError as e:
+                assert "'14z' is not a valid edge length" in e.msg
+            else:
+                assert False
+
+def test_map_tree_file(tmp_path):
+    file = tmp_path / "tree.tre"
+    file.write_bytes(b"(A,B)C;")
+    with open(file, 'rb') as f:
+        assert map_tree_file(f)[:] == b"(A,B)C;"
+
+    # A stream that can't be mapped is parsed as it's read, unless random access to it is needed
+    stream = io.BytesIO(b"(A,B)C;")
+    assert map_tree_file(stream) is stream
+    assert [node['taxon'] for node in parse_tree(map_tree_file(stream))] == ['A', 'B', 'C']
+    assert map_tree_file(io.BytesIO(b"(A,B)C;"), random_access=True) == b"(A,B)C;"
+
+def test_unknown_field():
+    try:
+        parse_tree("(A,B)C;", fields=('taxon', 'colour'))
+    except ValueError as e:
+        assert 'colour' in str(e)
+    else:
+        assert False
+
+def test_visit_tree():
+    leaves = []
+    visit_tree(b"(A_ott123,B:1.2)C_ott789:5.5;", lambda node: node[1] and leaves.append(node[0]), fields=('taxon', 'is_leaf'))
+    assert leaves == ['A', 'B']
@@ -0,0 +1,59 @@
+'''
+Unit tests for ozb_file, and the memory mapped CompactTree it loads
+'''
+
+import gzip
+import io
+
+from oz_tree_build.newick.mrca_index import MrcaIndex
+from oz_tree_build.newick.newick_parser import parse_tree
+from oz_tree_build.newick.ozb_file import is_ozb_file, load_ozb, newick_to_ozb, ozb_to_newick, parse_ozb
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,'C B':1)C,D)Root;"
+
+def node_values(nodes, keys=('taxon', 'ott', 'edge_length', 'depth', 'is_leaf')):
+    return [tuple(node[key] for key in keys) for node in nodes]
+
+def create_ozb_file(tmp_path, tree=test_tree):
+    tree_file = str(tmp_path / "tree.tre")
+    with open(tree_file, 'w') as f:
+        f.write(tree)
+    newick_to_ozb(tree_file, str(tmp_path / "tree.ozb"))
+    return str(tmp_path / "tree.ozb")
+
+def test_same_nodes_as_parser(tmp_path):
+    ozb_file = create_ozb_file(tmp_path)
+
+    assert is_ozb_file(ozb_file)
+    assert list(parse_ozb(ozb_file)) == list(parse_tree(test_tree))
+
+def test_queries(tmp_path):
+    tree = load_ozb(create_ozb_file(tmp_path))
+
+    assert tree.name(tree.root) == 'Root'
+    assert [tree.name(child) for child in tree.children(tree.root)] == ['A', 'B', 'C', 'D']
+    assert tree.name(tree.parent(tree.find_ott(456))) == 'BB'
+    assert tree.find_name('C B') == tree.children(tree.find_name('C'))[1]
+    assert tree.edge_length(tree.find_name('BBCA')) == 12.34
+
+def test_round_trip(tmp_path):
+    output = io.StringIO()
+    ozb_to_newick(create_ozb_file(tmp_path), output)
+
+    # Only the formatting of the edge lengths changes
+    assert output.getvalue() == test_tree.replace("'C B':1)", "'C B':1.0)")
+    assert node_values(parse_tree(output.getvalue())) == node_values(parse_tree(test_tree))
+
+def test_compressed_newick(tmp_path):
+    tree_file = str(tmp_path / "tree.tre.gz")
+    with open(tree_file, 'wb') as f:
+        f.write(gzip.compress(test_tree.encode()))
+    newick_to_ozb(tree_file, str(tmp_path / "tree.ozb"))
+
+    assert list(parse_ozb(str(tmp_path / "tree.ozb"))) == list(parse_tree(test_tree))
+
+def test_mrca_index_from_ozb(tmp_path):
+    index = MrcaIndex.load(create_ozb_file(tmp_path))
+
+    assert index.describe(index.mrca('BBAA', 'BBCB')) == 'BB'
+    assert index.describe(index.mrca('123', 'C B')) == 'Root'
@@ -0,0 +1,57 @@
+'''
+Unit tests for split_tree
+'''
+
+from oz_tree_build.newick.newick_parser import map_tree_file, parse_tree
+from oz_tree_build.newick.split_tree import TreeChunk, match_chunk_braces, split_tree
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,'C,(B':1)C,D)Root;"
+
+def parse_in_chunks(tree, chunk_count):
+    chunks = [TreeChunk(tree, start, end) for start, end in split_tree(tree, chunk_count)]
+    nodes_per_chunk = [list(chunk.parse()) for chunk in chunks]
+
+    all_nodes = []
+    unmatched_braces = [chunk.unmatched_braces for chunk in chunks]
+    for (depth_at_start, starts), nodes in zip(match_chunk_braces(unmatched_braces), nodes_per_chunk):
+        starts = iter(starts)
+        for node in nodes:
+            node = dict(node)
+            if node['start'] is None:
+                node['start'] = next(starts)
+            node['depth'] += depth_at_start
+            all_nodes.append(node)
+    return all_nodes
+
+def test_split_points():
+    tree = "((A,B)C,(D,E)F)G;"
+    assert [tree[start:end] for start, end in split_tree(tree, 2)] == ['((A,B)C,(D', 'E)F)G']
+    assert [tree[start:end] for start, end in split_tree(tree, 1)] == ['((A,B)C,(D,E)F)G']
+
+def test_no_split_in_quoted_names():
+    tree = "('A,B,C,D,E,F,G,H',I);"
+    assert [tree[start:end] for start, end in split_tree(tree, 2)] == ["('A,B,C,D,E,F,G,H'", 'I)']
+
+def test_same_nodes_as_parse_tree():
+    for tree in [test_tree, test_tree.encode()]:
+        expected = [dict(node) for node in parse_tree(tree)]
+        for chunk_count in [1, 2, 3, 5, 10, 100]:
+            assert parse_in_chunks(tree, chunk_count) == expected
+
+def test_fields():
+    fields = ('taxon', 'start', 'end', 'depth')
+    for tree in [test_tree, test_tree.encode(), memoryview(test_tree.encode())]:
+        for start, end in split_tree(tree, 5):
+            chunk, tuple_chunk = TreeChunk(tree, start, end), TreeChunk(tree, start, end)
+            nodes = [dict(node) for node in chunk.parse()]
+            assert list(tuple_chunk.parse(fields)) == [tuple(node[field] for field in fields) for node in nodes]
+            assert tuple_chunk.unmatched_braces == chunk.unmatched_braces
+
+def test_mmap_chunks(tmp_path):
+    tree_file = tmp_path / "tree.tre"
+    tree_file.write_text(test_tree)
+    expected = [dict(node) for node in parse_tree(test_tree.encode())]
+    with open(tree_file, 'rb') as f:
+        tree = map_tree_file(f)
+        for chunk_count in [1, 3, 10]:
+            assert parse_in_chunks(tree, chunk_count) == expected
@@ -0,0 +1,101 @@
+'''
+Unit tests for taxon_catalog
+'''
+
+import os
+
+import pytest
+
+from oz_tree_build.newick.compact_tree import CompactTree
+from oz_tree_build.newick.taxon_catalog import TaxonCatalog, build_taxon_catalog, load_catalog_for_tree_stream, resolve_taxa
+
+test_tree = "(A,(BA,((BBAA_ott123,BBAB,BBAC,BBAD)BAA,(BBBA)BBB,(BBCA:12.34,BBCB)BBC_ott456:78.9)BB)B_ott789,((CAA,CAB):5.25,'CB':1)C,D_ottX,bb)Root;"
+
+def create_catalog(tmp_path, batch_size=4):
+    tree_file = str(tmp_path / "tree.tre")
+    with open(tree_file, 'w') as f:
+        f.write(test_tree)
+    build_taxon_catalog(tree_file, batch_size=batch_size)
+    return tree_file
+
+def test_same_nodes_as_parser(tmp_path):
+    with TaxonCatalog.load(create_catalog(tmp_path)) as catalog:
+        compact_tree = CompactTree.from_newick(test_tree)
+        assert len(catalog) == len(compact_tree)
+
+        for node_id, node in enumerate(compact_tree.nodes()):
+            # The catalog has everything but the edge lengths
+            del node['edge_length']
+            catalog_node, = catalog.query('node_id = ?', (node_id,))
+            assert catalog_node == {**node, 'node_id': node_id, 'parent': compact_tree.parent(node_id) if node_id != compact_tree.root else None}
+
+def test_lookups(tmp_path):
+    with TaxonCatalog.load(create_catalog(tmp_path)) as catalog:
+        node, = catalog.find('456')
+        assert test_tree[node['start']:node['end']] == '(BBCA:12.34,BBCB)BBC_ott456:78.9'
+        assert catalog.find_name('BBC') == [node]
+        assert catalog.find_ott(456) == [node]
+        assert catalog.find('X') == []
+        assert catalog.find_name('D_ottX')[0]['ott'] is None
+
+        assert [node['taxon'] for node in catalog.find_name('bb', ignore_case=True)] == ['BB', 'bb']
+        assert [node['taxon'] for node in catalog.search_prefix('bb')] == ['BB', 'bb', 'BBAA', 'BBAB', 'BBAC', 'BBAD', 'BBB',
+                                                                          'BBBA', 'BBC', 'BBCA', 'BBCB']
+        assert [node['taxon'] for node in catalog.search_prefix('BBc', limit=2)] == ['BBC', 'BBCA']
+        assert catalog.search_prefix('BBX') == []
+
+def test_resolve(tmp_path):
+    catalog_file = create_catalog(tmp_path) + '.ozdb'
+    with TaxonCatalog(catalog_file) as catalog:
+        assert catalog.resolve('BBC') == '456'
+        assert catalog.resolve('bbc') == '456'
+        assert catalog.resolve('789') == '789'
+        assert catalog.resolve('cab') == 'CAB'
+        assert catalog.resolve('bb') == 'bb'
+        assert catalog.resolve('X') is None
+
+        assert resolve_taxa(catalog, {'bbc', 'baa', 'X'}) == {'456', 'BAA', 'X'}
+
+def test_resolve_homonyms(tmp_path):
+    tree_file = str(tmp_path / "tree.tre")
+    with open(tree_file, 'w') as f:
+        f.write("((A_ott1,B)X_ott5,(C,X_ott6)Y,(D)X,x)Root;")
+    build_taxon_catalog(tree_file)
+
+    with TaxonCatalog.load(tree_file) as catalog:
+        # Only the first node is resolved for a target, but all of them for an exclusion
+        assert catalog.resolve('X') == '5'
+        assert catalog.resolve_all('X') == {'5', '6', 'X'}
+        assert catalog.resolve_all('x') == {'x'}
+        assert catalog.resolve_all('y') == {'Y'}
+        assert catalog.resolve_all('Z') == set()
+        assert resolve_taxa(catalog, {'X', 'A', 'Z'}, all_matches=True) == {'5', '6', 'X', '1', 'Z'}
+
+def test_load_catalog_for_tree_stream(tmp_path, caplog):
+    tree_file = create_catalog(tmp_path)
+    with open(tree_file, 'rb') as f:
+        with load_catalog_for_tree_stream(f, tree_file + '.ozdb') as catalog:
+            assert catalog.resolve('bbc') == '456'
+
+    # A catalog of an older version of the tree isn't used
+    with open(tree_file, 'w') as f:
+        f.write(test_tree.replace('BBC_ott456', 'BBC_ott654'))
+    with open(tree_file, 'rb') as f:
+        assert load_catalog_for_tree_stream(f, tree_file + '.ozdb') is None
+    assert "Not resolving the taxa through" in caplog.text
+
+def test_stale_catalog(tmp_path):
+    tree_file = create_catalog(tmp_path)
+
+    # Touching the file keeps the catalog, but changing it makes it stale
+    os.utime(tree_file, ns=(1, 1))
+    TaxonCatalog.load(tree_file).close()
+    with open(tree_file, 'w') as f:
+        f.write(test_tree.replace('BBAA', 'XXAA'))
+    assert TaxonCatalog.load(tree_file) is None
+    assert TaxonCatalog.load(str(tmp_path / "missing.tre")) is None
+
+def test_not_a_catalog(tmp_path):
+    tree_file = create_catalog(tmp_path)
+    with pytest.raises(ValueError):
+        TaxonCatalog(tree_file)
@@ -0,0 +1,38 @@
+'''
+Unit tests for ultrametric_to_additive
+'''
+
+import io
+
+from oz_tree_build.newick.ultrametric_to_additive import ultrametric_to_additive
+
+def convert(tree, batch_size=3):
+    outputs = []
+    for newick_tree in [tree, tree.encode()]:
+        output = io.StringIO()
+        ultrametric_to_additive(newick_tree, output, batch_size)
+        outputs.append(output.getvalue())
+    assert outputs[0] == outputs[1]
+    return outputs[0]
+
+def test_simple_tree():
+    assert convert("((A,B):7,C):20;") == "((A:7.0,B:7.0):13.0,C:20.0);"
+
+def test_zero_edge_lengths_omitted():
+    assert convert("((A:2,B:2):5,(C:5,D:1)E:5)F:5;\n") == "((A:3.0,B:3.0),(C,D:4.0)E)F;\n"
+
+def test_rounding():
+    assert convert("((A,B:1.001):3.3333,C):10;") == "((A:3.33,B:2.33):6.67,C:10.0);"
+
+def test_names_kept():
+    assert convert("((A_ott1:1,'B:b'):3,C_ott3)'R:r':4;") == "((A_ott1:2.0,'B:b':3.0):1.0,C_ott3:4.0)'R:r';"
+
+def test_single_node():
+    assert convert("A:5;") == "A;"
+
+def test_deep_tree():
+    # A caterpillar tree much deeper than the recursion limit
+    depth = 10000
+    tree = '(' * depth + 'A' + ''.join(f",B{i}):{i + 1}" for i in range(depth)) + ';'
+    expected = '(' * depth + 'A:1.0' + ''.join(f",B{i}:{i + 1}.0)" + (':1.0' if i < depth - 1 else '') for i in range(depth)) + ';'
+    assert convert(tree, batch_size=1000) == expected